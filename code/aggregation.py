@@ -0,0 +1,105 @@
+"""Aggregation of document terms
+
+The terms of a document set are added up with NumPy. Terms are interned into
+integer identifiers by a vocabulary that is shared by all requests, and each
+document keeps arrays with the identifiers, frequencies and tfidf scores of its
+terms (see Document.term_arrays()). Since documents are cached the interning
+is mostly done once per document. Adding up the terms of a set is then a matter
+of concatenating the arrays of the documents, renumbering the identifiers with
+np.unique() and summing with np.bincount(), and the top terms are selected with
+np.argpartition() rather than by sorting all terms.
+
+Building the arrays is the expensive part, it parses the stored tfidf strings
+and looks up every term in the vocabulary. For a set of 10k documents with 100
+terms each this takes more than a second the first time, and about a tenth of
+a second once the documents have their arrays.
+
+"""
+
+import numpy as np
+
+from config import TERM_VOCABULARY_SIZE
+
+
+class TermVocabulary:
+
+    """Maps terms to integer identifiers. When the vocabulary grows beyond maxsize
+    it starts over and its generation is increased, term identifiers are only
+    valid for the generation they were created in."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.generation = 0
+        self.ids = {}
+        self.terms = []
+
+    def __str__(self):
+        return f'<TermVocabulary generation={self.generation} size={len(self)}>'
+
+    def __len__(self):
+        return len(self.terms)
+
+    def intern(self, terms: list) -> np.ndarray:
+        """Return an array with the identifiers of the terms, adding terms that
+        are not in the vocabulary yet."""
+        if len(self.terms) + len(terms) > self.maxsize:
+            self.ids = {}
+            self.terms = []
+            self.generation += 1
+        ids = self.ids
+        term_ids = list(map(ids.get, terms))
+        # most terms are usually in the vocabulary already
+        if None in term_ids:
+            vocabulary = self.terms
+            for i, term in enumerate(terms):
+                if term_ids[i] is None:
+                    term_id = ids.get(term)
+                    if term_id is None:
+                        term_id = ids[term] = len(vocabulary)
+                        vocabulary.append(term)
+                    term_ids[i] = term_id
+        return np.array(term_ids, dtype=np.int64)
+
+
+def term_sums(documents: list, vocabulary: TermVocabulary):
+    """Return three arrays: the identifiers of all terms that occur in the documents
+    and their summed frequencies and tfidf scores."""
+    arrays = [doc.term_arrays(vocabulary) for doc in documents]
+    # interning may have started a new generation of the vocabulary halfway, in
+    # which case the arrays of the earlier documents are recreated
+    if any(generation != vocabulary.generation for generation, _, _, _ in arrays):
+        arrays = [doc.term_arrays(vocabulary) for doc in documents]
+    if not arrays:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+    ids = np.concatenate([term_ids for _, term_ids, _, _ in arrays])
+    freqs = np.concatenate([freqs for _, _, freqs, _ in arrays])
+    tfidfs = np.concatenate([tfidfs for _, _, _, tfidfs in arrays])
+    # the identifiers are renumbered to positions in the sorted unique identifiers,
+    # so the sums cost as much as the terms in the set and not as the vocabulary
+    term_ids, positions = np.unique(ids, return_inverse=True)
+    freq_sums = np.bincount(positions, weights=freqs, minlength=len(term_ids))
+    tfidf_sums = np.bincount(positions, weights=tfidfs, minlength=len(term_ids))
+    return term_ids, freq_sums.astype(np.int64), tfidf_sums
+
+
+def top_terms(documents: list, k: int = None, vocabulary: TermVocabulary = None) -> list:
+    """Return the k terms of the documents with the highest summed tfidf score, as
+    triples of the term, the summed frequency and the summed tfidf score, sorted
+    on the tfidf score. All terms are returned if k is None."""
+    vocabulary = VOCABULARY if vocabulary is None else vocabulary
+    term_ids, freq_sums, tfidf_sums = term_sums(documents, vocabulary)
+    if k is not None and k < len(term_ids):
+        if k <= 0:
+            return []
+        selected = np.argpartition(-tfidf_sums, k - 1)[:k]
+    else:
+        selected = np.arange(len(term_ids))
+    # sort on descending score, with ties in the order of the term identifiers
+    selected = selected[np.lexsort((term_ids[selected], -tfidf_sums[selected]))]
+    terms = vocabulary.terms
+    return [(terms[term_id], freq, tfidf) for term_id, freq, tfidf
+            in zip(term_ids[selected].tolist(), freq_sums[selected].tolist(),
+                   tfidf_sums[selected].tolist())]
+
+
+VOCABULARY = TermVocabulary(TERM_VOCABULARY_SIZE)
@@ -16,6 +16,10 @@ Get a list of documents:
 
 $ curl http://localhost:8000/api/set?ids=5783bcafcf58f176c768f5cc,58102ca2cf58f15425a75367
 
+Only returning the 20 terms with the highest tfidf scores for the set:
+
+$ curl "http://localhost:8000/api/set?ids=5783bcafcf58f176c768f5cc,58102ca2cf58f15425a75367&terms=20"
+
 Get related documents:
 
 $ curl http:/127.0.0.1:8000/api/related/54b4324ee138239d8684aeb2
@@ -35,27 +39,102 @@ Getting the second page for a search:
 $ curl -X POST "http:/127.0.0.1:8000/api/question?query=flu&page=2"
 $ curl -X POST "http:/127.0.0.1:8000/api/question?tags=biomedical&query=flu&page=2"
 
+The numbered pages stop at page 40, to get further use the page token from the
+next_token property of the pages block of the previous response:
+
+$ curl -X POST "http:/127.0.0.1:8000/api/question?query=flu&page_token=eyJxdWVyeSI6..."
+
+Asking several questions at once, the questions take the same parameters as
+/api/question except for the page token:
+
+$ curl -X POST "http:/127.0.0.1:8000/api/questions" -d '[{"query": "flu"}, {"query": "flu", "tags": "biomedical"}]'
+
+Only returning some of the fields of the documents, this also works for the
+related and set endpoints:
+
+$ curl -X POST "http:/127.0.0.1:8000/api/question?query=flu&fields=identifier,title,score"
+$ curl http:/127.0.0.1:8000/api/related/54b4324ee138239d8684aeb2?fields=identifier,title
+
+Expanding the query with synonyms and related terms that were computed in
+advance with expansions.py, and looking up expansions and completions:
+
+$ curl -X POST "http:/127.0.0.1:8000/api/question?query=flu&expand=true"
+$ curl "http:/127.0.0.1:8000/api/expansions?term=flu&tags=biomedical"
+$ curl "http:/127.0.0.1:8000/api/expansions?prefix=infl&tags=biomedical"
+
+Exporting all results of a search as newline-delimited JSON, with optional tags
+and fields parameters:
+
+$ curl "http:/127.0.0.1:8000/api/export?query=flu" > flu.ndjson
+$ curl "http:/127.0.0.1:8000/api/export?query=flu&tags=biomedical&fields=identifier,title"
+
+Checking whether the API is ready, this also shows start-up timings:
+
+$ curl http:/127.0.0.1:8000/api/ready
+
+Getting histograms of request and stage timings in the Prometheus text format,
+the timings of each request are also in its Server-Timing header:
+
+$ curl http:/127.0.0.1:8000/api/metrics
+
 """
 
+import time
+IMPORT_START = time.perf_counter()
+
 import json
+import asyncio
+import hashlib
+import logging
 
 import elasticsearch
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
+import cache
 import config
 import document
-import elastic
+import elastic_async
+import expansions
+import metrics
+import neighbours
 import ranking
-from utils import get_valid_pages, prettify
+import timing
+from elastic import search_query
+from projection import parse_fields, source_includes
+from serialize import FastJSONResponse, dumps
+from utils import get_valid_pages, prettify, encode_page_token, decode_page_token
 from exceptions import AskmeException, handle_askme_exception
 from exceptions import handle_python_exception, handle_elastic_exception
 
 DEBUG = False
 
+logger = logging.getLogger(__name__)
+
 INDEX = config.ELASTIC_INDEX
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
+
+if config.METRICS:
+    app.add_middleware(metrics.Timings)
+
+SEARCH_CACHE = cache.TTLCache(
+    config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL, config.SEARCH_CACHE_STALE)
+
+RELATED_CACHE = cache.LRUCache(config.RELATED_CACHE_SIZE)
+
+# related documents computed in advance, None if there are none
+NEIGHBOURS = neighbours.load(config.NEIGHBOURS_PATH)
+
+# synonyms and related terms computed in advance, None if there are none
+EXPANSIONS = expansions.load(config.EXPANSIONS_PATH)
+
+# set when warming up is done, the task is kept here so it is not garbage collected
+WARMED_UP = not config.WARM_UP
+WARM_UP_TASK = None
+
+timing.record('api import', time.perf_counter() - IMPORT_START)
 
 
 @app.exception_handler(Exception)
@@ -70,100 +149,441 @@ async def askme_exception_handler(request: Request, exc: Exception):
 async def elastic_exception_handler(request: Request, exc: Exception):
     return handle_elastic_exception(request, exc)
 
+@app.on_event('startup')
+async def startup():
+    """Start warming up in the background so that starting the API is not held up
+    by loading resources, /api/ready reports when warming up is done."""
+    global WARM_UP_TASK
+    if config.WARM_UP:
+        WARM_UP_TASK = asyncio.create_task(warm_up())
+
+async def warm_up():
+    global WARMED_UP
+    try:
+        with timing.timed('elasticsearch ping'):
+            if await elastic_async.ping():
+                timing.loaded('elasticsearch connection')
+    except Exception as e:
+        logger.warning(f'Could not connect to ElasticSearch: {e}')
+    try:
+        await ranking.warm_up()
+    except Exception as e:
+        logger.warning(f'Could not start the NLP pool: {e}')
+    WARMED_UP = True
+
+@app.on_event('shutdown')
+async def shutdown():
+    await elastic_async.close()
+    ranking.close()
+
 
 @app.get('/api')
-def home():
+async def home():
     return {
         "description": "AskMe API",
         "help": "Ping the /api/help endpoint for help" }
 
 @app.get('/api/help', response_class=PlainTextResponse)
-def home():
+async def home():
     return __doc__
 
+@app.get('/api/ready')
+async def ready():
+    """Report whether the API is ready to answer queries, what resources are
+    loaded and how long loading took. Returns status 503 when not ready."""
+    is_ready = WARMED_UP and ranking.ready()
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={
+            "ready": is_ready,
+            "loaded": timing.LOADED,
+            "timings": timing.TIMINGS })
+
+@app.get('/api/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    """Histograms of request durations and of the time spent in each stage of
+    handling requests, by endpoint and in the Prometheus text format."""
+    if not config.METRICS:
+        raise AskmeException(message='Metrics are switched off', status=404)
+    return PlainTextResponse(
+        metrics.METRICS.prometheus(), media_type='text/plain; version=0.0.4')
+
 @app.get('/api/error')
-def error():
+async def error():
     raise AskmeException(message="The endpoint /api/error always raises an exception")
 
 @app.post('/api/question')
-def query(tags: str = None, query: str = None, type = None, page: int=1):
-    """Search endpoint for the current web interface."""
-    # if page number is larger than MAX_PAGES or less than 1, default to 1
-    if page > config.MAX_PAGES or page < 1:
-        page = 1
+async def query(tags: str = None, query: str = None, type = None, page: int=1,
+                fields: str = None, page_token: str = None, expand: bool = False):
+    """Search endpoint for the current web interface. The fields parameter is
+    a comma-separated list of fields to return for each document. The page token
+    is the next_token from the pages block of the response for the previous page,
+    it is used to page through all results, also beyond MAX_PAGES. With expand the
+    query is expanded with synonyms and related terms, if there are any."""
+    fields = parse_fields(fields, config.FIELDS_FOR_MULTIPLE_DOCS)
     # create a list from the tags string
     if tags:
         tags = tags.split(',')
+    expand = expand and EXPANSIONS is not None and bool(query)
+    expansion_terms = EXPANSIONS.expand(query, tags) if expand else None
+    state = None
+    if page_token is not None:
+        state = decode_page_token(page_token)
+        if state['query'] != query_digest(tags, query, type, expand):
+            raise AskmeException(message='Page token is for another query', status=400)
+        page = state['page']
+    # if page number is larger than MAX_PAGES or less than 1, default to 1
+    elif page > config.MAX_PAGES or page < 1:
+        page = 1
     if DEBUG:
         print({"tags": tags, "question": query[:50], "page": page})
-    result = elastic.search(tags, query, type, page)
-    result.hits = ranking.rerank(result.docs)
-    if DEBUG:
-        print('>>>', result)
+
+    async def search():
+        # the time budget is shared by the search and the reranking
+        deadline = asyncio.get_running_loop().time() + config.REQUEST_BUDGET
+        source_fields = source_includes(fields, ranking.source_fields(query))
+        pit = after = None
+        if state is not None:
+            # the first page that is requested with a token opens the point in time
+            pit = state['pit'] or await elastic_async.open_point_in_time()
+            after = state['after']
+        result = await elastic_async.search(
+            tags, query, type, page, source_fields, timeout=config.REQUEST_BUDGET,
+            pit=pit, after=after, expansions=expansion_terms)
+        # the next page continues after the last hit in the ElasticSearch order,
+        # so this is taken before reranking
+        next_page = next_page_state(result, tags, query, type, page, expand)
+        if pit is not None and next_page is None:
+            await close_point_in_time(result.pit_id or pit)
+        with metrics.stage('rerank'):
+            result.hits, complete = await ranking.arerank(result.docs, query, deadline)
+        if DEBUG:
+            print('>>>', result)
+        return search_answer(result, complete, fields, next_page)
+
+    # pages requested with a token are not cached since the token refers to a
+    # point in time that will expire
+    if config.SEARCH_CACHE_SIZE > 0 and state is None:
+        SEARCH_CACHE.set_generation(await elastic_async.index_generation())
+        key = search_key(tags, query, type, page) + (fields, expand)
+        answer = await SEARCH_CACHE.get_or_compute(key, search, cacheable=is_cacheable)
+    else:
+        answer = await search()
+    response = question_response(query, page, answer)
+    if expand:
+        response["query"]["expansions"] = expansion_terms
+    return FastJSONResponse(response)
+
+class Question(BaseModel):
+    """A question for /api/questions, with the same fields as the parameters of
+    /api/question, except for the page token."""
+    tags: str = None
+    query: str
+    type: str = None
+    page: int = 1
+
+@app.post('/api/questions')
+async def questions(questions: list[Question], fields: str = None):
+    """Batch search endpoint. The body is a JSON list of questions. The questions
+    that are not in the search cache are sent to ElasticSearch with one request
+    to the _msearch API and their results are reranked together. The response
+    has the results for each question in the order of the questions, questions
+    that failed have an error instead of documents."""
+    if len(questions) > config.MAX_QUESTIONS:
+        raise AskmeException(
+            message=f'Too many questions, the maximum is {config.MAX_QUESTIONS}', status=400)
+    fields = parse_fields(fields, config.FIELDS_FOR_MULTIPLE_DOCS)
+    deadline = asyncio.get_running_loop().time() + config.REQUEST_BUDGET
+    searches = []
+    for question in questions:
+        tags = question.tags.split(',') if question.tags else None
+        page = question.page if 1 <= question.page <= config.MAX_PAGES else 1
+        searches.append((tags, question.query, question.type, page))
+    keys = [search_key(*search) + (fields, False) for search in searches]
+    answers = [None] * len(searches)
+    use_cache = config.SEARCH_CACHE_SIZE > 0
+    if use_cache:
+        SEARCH_CACHE.set_generation(await elastic_async.index_generation())
+        for n, key in enumerate(keys):
+            answer, state = SEARCH_CACHE.lookup(key)
+            if state == cache.FRESH:
+                answers[n] = answer
+    todo = [n for n, answer in enumerate(answers) if answer is None]
+    if todo:
+        source_fields = source_includes(
+            fields, *[ranking.source_fields(searches[n][1]) for n in todo])
+        results = await elastic_async.msearch(
+            [searches[n] for n in todo], source_fields, timeout=config.REQUEST_BUDGET)
+        found = []
+        for n, result in zip(todo, results):
+            if isinstance(result, dict):
+                answers[n] = {"error": result}
+            else:
+                found.append((n, result))
+        with metrics.stage('rerank'):
+            reranked = await ranking.arerank_many(
+                [(result.docs, searches[n][1]) for n, result in found], deadline)
+        for (n, result), (hits, complete) in zip(found, reranked):
+            next_page = next_page_state(result, *searches[n])
+            result.hits = hits
+            answers[n] = search_answer(result, complete, fields, next_page)
+            if use_cache and is_cacheable(answers[n]):
+                SEARCH_CACHE.put(keys[n], answers[n])
+    responses = []
+    for (_, query, _, page), answer in zip(searches, answers):
+        if "error" in answer:
+            responses.append({"query": { "question": query }, "error": answer["error"]})
+        else:
+            responses.append(question_response(query, page, answer))
+    return FastJSONResponse({"questions": responses})
+
+async def close_point_in_time(pit: str):
+    """Close the point in time of a chain of page tokens once the last page is
+    served. Chains that are abandoned before that keep their point in time until
+    it expires after PIT_KEEP_ALIVE. A failure is logged, since the page itself
+    was found."""
+    try:
+        await elastic_async.close_point_in_time(pit)
+    except (elasticsearch.ApiError, elasticsearch.TransportError, AskmeException) as e:
+        logger.warning(f'Closing point in time failed: {e}')
+
+def next_page_state(result, tags: list, query: str, type: str, page: int,
+                    expand: bool = False):
+    """Return the state needed for the page token of the next page, or None if
+    there are no more pages. The count of all hits is capped, with a capped count
+    we just assume there are more pages."""
+    if len(result.docs) == config.MAX_RESULTS and (
+            result.total_hits > page * config.MAX_RESULTS
+            or result.total_hits >= config.TRACK_TOTAL_HITS):
+        return {
+            "query": query_digest(tags, query, type, expand), "page": page + 1,
+            "pit": result.pit_id, "after": result.last_sort }
+    return None
+
+def search_answer(result, complete: bool, fields: tuple, next_page: dict):
+    """The answer for a search, this is what goes into the search cache."""
+    return {
+        "documents": [doc.as_json(fields=fields) for doc in result.hits],
+        "total_hits": result.total_hits,
+        "next_page": next_page,
+        "reranked": "complete" if complete else "partial",
+        "timed_out": result.timed_out }
+
+def is_cacheable(answer: dict):
+    # answers that ran out of time are not cached
+    return answer["reranked"] == "complete" and not answer["timed_out"]
+
+def question_response(query: str, page: int, answer: dict):
+    pages = get_valid_pages(answer["total_hits"], page)
+    if answer["next_page"] is not None:
+        pages["next_token"] = encode_page_token(answer["next_page"])
     return {
         "query": { "question": query },
-        "documents": [doc.as_json(single_doc=False) for doc in result.hits],
-        "pages": get_valid_pages(result.total_hits, page) }
+        "documents": answer["documents"],
+        "pages": pages,
+        "reranked": answer["reranked"],
+        "timed_out": answer["timed_out"] }
+
+def query_digest(tags: list, query: str, type: str, expand: bool = False):
+    """Short digest of the search parameters, stored in page tokens to check that
+    the token is used for the same search."""
+    key = repr(search_key(tags, query, type, None) + ((True,) if expand else ()))
+    return hashlib.blake2b(key.encode('utf8'), digest_size=8).hexdigest()
+
+@app.get('/api/export')
+async def export(query: str, tags: str = None, type = None, fields: str = None):
+    """Stream all documents that match the query as newline-delimited JSON, one
+    document per line in order of score. Documents are fetched in batches while
+    the response is being sent, so the result set is never all in memory."""
+    fields = parse_fields(fields, config.FIELDS_FOR_MULTIPLE_DOCS)
+    if tags:
+        tags = tags.split(',')
+    es_query = search_query(tags, query, type)
+    batches = elastic_async.scan(
+        es_query, source_includes(fields), config.EXPORT_BATCH_SIZE)
+    # get the first batch before sending anything, so that if ElasticSearch is
+    # not available we can still respond with an error
+    docs = await anext(batches, None)
+
+    async def lines():
+        nonlocal docs
+        try:
+            while docs is not None:
+                with metrics.stage('serialize'):
+                    chunk = b''.join(doc.json_bytes(fields) + b'\n' for doc in docs)
+                yield chunk
+                docs = await anext(batches, None)
+        finally:
+            await batches.aclose()
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+def search_key(tags: list, query: str, type: str, page: int):
+    """Normalize the search parameters into a key for the search cache."""
+    tags = tuple(sorted(set(tag.strip() for tag in tags))) if tags else ()
+    query = ' '.join(query.lower().split()) if query else query
+    type = 'exact' if type == 'exact' else None
+    return (tags, query, type, page)
+
+@app.get('/api/expansions')
+async def get_expansions(term: str = None, prefix: str = None, tags: str = None,
+                         limit: int = 10):
+    """Return the synonyms and related terms of a term, or the terms that start
+    with a prefix. With tags the tables for the first tag that has the term are
+    used, otherwise the tables for all documents."""
+    if EXPANSIONS is None:
+        raise AskmeException(message='There are no query expansions', status=404)
+    domains = (tags.split(',') if tags else []) + [expansions.ALL]
+    if prefix is not None:
+        for tag in domains:
+            completions = EXPANSIONS.complete(prefix, tag, limit)
+            if completions:
+                break
+        return {"query": {"prefix": prefix, "tag": tag}, "terms": completions}
+    if term is None:
+        raise AskmeException(message='Give a term or a prefix', status=400)
+    for tag in domains:
+        if EXPANSIONS.row(term, tag) is not None:
+            break
+    return {
+        "query": {"term": term, "tag": tag},
+        "synonyms": EXPANSIONS.synonyms(term, tag),
+        "related": [{"term": related, "score": score}
+                    for related, score in EXPANSIONS.related(term, tag, limit)],
+        "expansions": EXPANSIONS.expand(term, tags.split(',') if tags else None) }
 
 @app.get('/api/related/{doc_id}')
-def get_related(doc_id: str, pretty: bool = False):
-    result = elastic.get_document(doc_id)
-    doc = result.first_doc()
-    query = f'{doc.title} {doc.terms_as_string()}'
-    result = elastic.search(None, query)
-    docs = document.DocumentSet(result.docs)
-    answer = {
-        "query": { "doc_id": doc_id, "terms": query },
-        "documents": [d.as_json(single_doc=False) for d in docs.documents] }
+async def get_related(doc_id: str, pretty: bool = False, fields: str = None):
+    """Return documents related to the document. These are taken from the related
+    documents that were computed in advance if there are any for the document, and
+    otherwise they are found with a more_like_this query that refers to the
+    document. Lists of related documents are cached until the index changes."""
+    fields = parse_fields(fields, config.FIELDS_FOR_MULTIPLE_DOCS)
+    key = (doc_id, fields)
+    RELATED_CACHE.set_generation(await elastic_async.index_generation())
+    answer = RELATED_CACHE.get(key)
+    if answer is None:
+        neighbours = NEIGHBOURS.lookup(doc_id) if NEIGHBOURS is not None else None
+        if neighbours is not None:
+            result = await elastic_async.get_documents([i for i, _ in neighbours])
+            scores = dict(neighbours)
+            # documents may come from the document cache, so the similarity is
+            # added to the JSON and not to the document
+            documents = [doc.as_json(fields=fields) for doc in result.docs]
+            for doc, doc_json in zip(result.docs, documents):
+                for score_field in ('score', 'nscore'):
+                    if score_field in doc_json:
+                        doc_json[score_field] = scores[doc.identifier]
+            answer = {
+                "query": { "doc_id": doc_id, "precomputed": True },
+                "documents": documents }
+        else:
+            result = await elastic_async.related(doc_id, source_includes(fields))
+            answer = {
+                "query": { "doc_id": doc_id, "precomputed": False },
+                "documents": [doc.as_json(fields=fields) for doc in result.docs] }
+        if not result.timed_out:
+            RELATED_CACHE.put(key, answer)
     if pretty:
-        answer = prettify(answer)
-    return answer
+        return prettify(answer)
+    return FastJSONResponse(answer)
 
 @app.get('/api/set')
-def get_set(ids: str):
+async def get_set(ids: str, fields: str = None, terms: int = None):
+    """Return the documents for a comma-separated list of identifiers and the terms
+    of the set, or only the top terms if terms is given. The response is streamed,
+    documents are sent as soon as they are retrieved and the terms of the set
+    follow at the end. Identifiers that could not be retrieved or that do not exist
+    are listed with the reason in the errors property."""
+    source_fields = None
+    if fields:
+        fields = parse_fields(fields, config.FIELDS_FOR_SET)
+        # the terms are always needed for the term counts of the set
+        source_fields = source_includes(fields, ('terms',))
+    else:
+        fields = config.FIELDS_FOR_SET
     doc_ids = [identifier for identifier in ids.split(',')]
-    result = elastic.get_documents(doc_ids)
-    if result.error:
-        if DEBUG:
-            result.error_details.pp()
-        raise AskmeException(
-            result.error_details.reason(),
-            details=result.error_details.details)
-    doc_set = document.DocumentSet(result.docs)
-    return {
-        "query": { "index": INDEX, "ids": ids },
-        "documents": doc_set.documents,
-        "terms": doc_set.sorted_terms() }
+    chunks = elastic_async.iter_documents(doc_ids, source_fields)
+    # get the first chunk before sending anything, so that if ElasticSearch is
+    # not available we can still respond with an error
+    chunk = await anext(chunks, None)
+
+    async def body():
+        nonlocal chunk
+        doc_set = document.DocumentSet([])
+        errors = []
+        separator = b''
+        try:
+            yield b'{"query":' + dumps({"index": INDEX, "ids": ids}) + b',"documents":['
+            try:
+                while chunk is not None:
+                    docs, chunk_errors = chunk
+                    doc_set.add(docs)
+                    errors.extend(chunk_errors)
+                    if docs:
+                        with metrics.stage('serialize'):
+                            docs_json = separator + b','.join(doc.json_bytes(fields) for doc in docs)
+                        yield docs_json
+                        separator = b','
+                    chunk = await anext(chunks, None)
+            except (elasticsearch.ApiError, elasticsearch.TransportError, AskmeException) as e:
+                # the response has started, so the identifiers that were not
+                # retrieved yet are listed as errors and the JSON is completed
+                logger.warning(f'Retrieving documents for /api/set failed: {e}')
+                handled = set(doc.identifier for doc in doc_set.documents)
+                handled.update(error['id'] for error in errors)
+                reason = e.message if hasattr(e, 'message') else str(e)
+                errors.extend({"id": doc_id, "type": "request_failed", "reason": reason}
+                              for doc_id in dict.fromkeys(doc_ids) if doc_id not in handled)
+            with metrics.stage('serialize'):
+                end = (b'],"terms":' + dumps(doc_set.sorted_terms(terms))
+                       + b',"errors":' + dumps(errors) + b'}')
+            yield end
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(body(), media_type='application/json')
 
 @app.get('/api/doc/{doc_id}')
-def get_document(doc_id: str, pretty: bool = False):
+async def get_document(doc_id: str, pretty: bool = False):
     """Return the document source or an empty dictionary if no such document exists."""
-    result = elastic.get_document(doc_id)
+    result = await elastic_async.get_document(doc_id)
     if result.total_hits:
-        response = result.docs[0]
-        response.terms = response.sorted_terms()
+        # documents may come from the document cache, so do not change them
+        doc = result.docs[0]
         if pretty:
-            response = prettify(response.as_json(single_doc=True))
-        return response
+            response = doc.as_json(single_doc=True)
+            response['terms'] = doc.sorted_terms()
+            return prettify(response)
+        return FastJSONResponse(
+            dict(doc.as_json(fields=config.FIELDS_FOR_SET), terms=doc.sorted_terms()))
     else:
         return {}
 
 @app.get('/api/rawdoc/{doc_id}')
-def get_raw_document(doc_id: str, pretty: bool = False):
-    """Return the raw Elasticsearch response for the document query."""
-    result = elastic.get_raw_document(doc_id)
+async def get_raw_document(doc_id: str, pretty: bool = False):
+    """Return the raw Elasticsearch hit for the document, wrapped in the hits
+    structure of a search response."""
+    result = await elastic_async.get_raw_document(doc_id)
     if pretty:
-        result = prettify(result.body)
+        result = prettify(result)
     return result
 
 @app.get('/api/doc/{doc_id}/{field}')
-def get_field(doc_id: str, field: str):
+async def get_field(doc_id: str, field: str):
     """Return the value of the field for the document as a field:value pair. Returns
-    the empty dictionary if the document does not exist, returns field:null if the
-    field does not exist."""
-    result = elastic.get_document(doc_id)
+    the empty dictionary if the document does not exist and field:null for fields
+    that do not exist. Private attributes and methods of documents give status 400."""
+    if field.startswith('_') or callable(getattr(document.Document, field, None)):
+        raise AskmeException(
+            f"Not a document field: {field}",
+            status=400,
+            details={"allowed_fields": list(config.FIELDS_FOR_SET)})
+    result = await elastic_async.get_document(doc_id, fields=[field])
     if result.total_hits > 0:
         doc = result.docs[0]
-        return {field: getattr(doc, field, None)} 
+        if field not in config.FIELDS_FOR_SET:
+            return {field: None}
+        return {field: getattr(doc, field)}
     else:
         return {}
@@ -0,0 +1,391 @@
+"""Load and latency benchmark for the API
+
+Sends a mix of requests to /api/question, /api/doc, /api/related and /api/set
+from a number of concurrent clients and reports the throughput and the p50, p95
+and p99 latencies for each endpoint. The requests are generated from a list of
+questions with a seeded random generator, so two runs with the same settings
+send the same requests in the same order. The document identifiers for the
+document, related and set requests are taken from the results of a warm-up round
+that asks each question once.
+
+By default the API runs in this process and requests are sent to it without a
+network in between. Give --memory to use the memory backend instead of
+ElasticSearch (see memory_backend.py), or --url to benchmark a running server:
+
+$ python benchmark.py
+$ python benchmark.py --memory /data/elastic-biomedical-001.json
+$ python benchmark.py --url http://localhost:8000 --requests 5000 --concurrency 32
+$ python benchmark.py --mix question=10,doc=1 --queries questions.txt
+
+The time spent in ElasticSearch, in creating Documents, in reranking and in
+serializing is also reported for each endpoint. This is taken from the
+Server-Timing headers of the responses, so it needs METRICS switched on in the
+API. For streamed responses the headers only have the time spent before the
+response started.
+
+Questions, documents and sets are cached by the API, and most requests repeat a
+question or a document of an earlier request. Requests that use a cache key that
+no earlier request used are reported as cold and the others as warm, the cold
+ones go through searching, reranking and serializing and the warm ones mostly
+test the caches. With --no-cache the caches of the API in this process are
+switched off, so that all requests go through the whole path and the report
+does not split them:
+
+$ python benchmark.py --memory /data/elastic-biomedical-001.json --no-cache
+
+Results can be saved and later runs compared to them, the exit status is 1 if a
+latency or the throughput got worse by more than the tolerance. This compares
+all requests as well as the cold and the warm requests:
+
+$ python benchmark.py --save baseline.json
+$ python benchmark.py --baseline baseline.json --tolerance 10
+
+The questions file has one question per line, optionally followed by a tab and
+a comma-separated list of tags.
+
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+from collections import defaultdict
+
+import httpx
+import numpy as np
+
+import config
+
+
+ENDPOINTS = ('question', 'doc', 'related', 'set')
+
+MIX = {'question': 60, 'doc': 15, 'related': 10, 'set': 15}
+
+QUESTIONS = [
+    'flu', 'influenza vaccine', 'covid transmission', 'heart disease', 'breast cancer',
+    'cancer immunotherapy', 'gene expression', 'protein folding', 'alzheimer disease',
+    'antibiotic resistance', 'malaria', 'diabetes treatment', 'stem cells', 'obesity',
+    'climate change', 'sea level rise', 'glacier', 'volcanic eruption', 'earthquake',
+    'sediment', 'fossil record', 'groundwater', 'mars', 'mars rover', 'water on mars',
+    'molecular dynamics', 'quantum chemistry', 'laser spectroscopy', 'crystal structure',
+    'machine learning', 'neural network', 'climate model']
+
+# the fields requested from /api/question in the warm-up round
+ID_FIELDS = 'identifier'
+
+PERCENTILES = (50, 95, 99)
+
+
+def parse_server_timing(header: str) -> dict:
+    """Return a dictionary from stage names to milliseconds for a Server-Timing
+    header, see metrics.py for the stages."""
+    timings = {}
+    for metric in header.split(','):
+        name, _, parameters = metric.strip().partition(';')
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.strip().partition('=')
+            if key == 'dur':
+                timings[name] = float(value)
+    return timings
+
+
+def read_questions(path: str) -> list:
+    """Return a list of pairs of a question and a tags string or None."""
+    if path is None:
+        return [(question, None) for question in QUESTIONS]
+    questions = []
+    with open(path) as fh:
+        for line in fh:
+            question, _, tags = line.rstrip('\n').partition('\t')
+            if question.strip():
+                questions.append((question.strip(), tags.strip() or None))
+    return questions
+
+
+def parse_mix(mix: str) -> dict:
+    weights = dict(MIX)
+    if mix:
+        weights = {endpoint: 0 for endpoint in ENDPOINTS}
+        for item in mix.split(','):
+            endpoint, _, weight = item.partition('=')
+            if endpoint not in ENDPOINTS:
+                raise ValueError(f'unknown endpoint {endpoint!r}')
+            weights[endpoint] = float(weight or 1)
+    return weights
+
+
+def question_request(rng: random.Random, questions: list):
+    question, tags = rng.choice(questions)
+    if tags is None and rng.random() < 0.3:
+        tags = rng.choice(config.TAGS)
+    params = {'query': question}
+    if tags:
+        params['tags'] = tags
+    if rng.random() < 0.1:
+        params['type'] = 'exact'
+    # most people only look at the first page
+    params['page'] = rng.choices((1, 2, 3), weights=(80, 15, 5))[0]
+    return ('question', 'POST', '/api/question', params)
+
+
+def make_requests(seed: int, n: int, weights: dict, questions: list, doc_ids: list) -> list:
+    """Return a list of n requests, each a tuple of the endpoint, the method, the
+    path and the parameters."""
+    rng = random.Random(seed)
+    if not doc_ids:
+        weights = {endpoint: weight for endpoint, weight in weights.items()
+                   if endpoint == 'question'}
+    endpoints = list(weights)
+    requests = []
+    for endpoint in rng.choices(endpoints, weights=[weights[e] for e in endpoints], k=n):
+        if endpoint == 'question':
+            requests.append(question_request(rng, questions))
+        elif endpoint == 'doc':
+            requests.append(('doc', 'GET', f'/api/doc/{rng.choice(doc_ids)}', {}))
+        elif endpoint == 'related':
+            requests.append(('related', 'GET', f'/api/related/{rng.choice(doc_ids)}', {}))
+        else:
+            ids = rng.sample(doc_ids, min(len(doc_ids), rng.randint(2, config.MAX_RESULTS)))
+            requests.append(('set', 'GET', '/api/set', {'ids': ','.join(ids)}))
+    return requests
+
+
+async def collect_ids(client: httpx.AsyncClient, questions: list) -> list:
+    """Ask each question once and return the identifiers of all documents found."""
+    doc_ids = {}
+    for question, tags in questions:
+        params = {'query': question, 'fields': ID_FIELDS}
+        if tags:
+            params['tags'] = tags
+        response = await client.post('/api/question', params=params)
+        if response.status_code == 200:
+            for doc in response.json().get('documents', []):
+                doc_ids[doc['identifier']] = True
+    return sorted(doc_ids)
+
+
+def cache_keys(request: tuple) -> list:
+    """Return the keys of the API caches that the request uses: the search cache
+    for questions, the document cache for documents and sets and the cache of
+    related documents."""
+    endpoint, _, path, params = request
+    if endpoint == 'question':
+        return [('question', tuple(sorted(params.items())))]
+    if endpoint == 'set':
+        return [('doc', doc_id) for doc_id in params['ids'].split(',')]
+    return [(endpoint, path.rsplit('/', 1)[-1])]
+
+
+def label_cold(requests: list, no_cache: bool = False) -> list:
+    """Return for each request whether it is cold, that is whether it uses a cache
+    key that no earlier request used. Warm requests are mostly answered from the
+    caches of the API. With the caches switched off all requests are cold."""
+    seen = set()
+    labels = []
+    for request in requests:
+        keys = cache_keys(request)
+        labels.append(no_cache or not seen.issuperset(keys))
+        seen.update(keys)
+    return labels
+
+
+async def run(client: httpx.AsyncClient, requests: list, concurrency: int, cold: list):
+    """Send the requests from concurrent workers and return the wall time and for
+    each endpoint a list of latencies, the number of errors and the lists of
+    stage timings from the Server-Timing headers. Latencies and errors are also
+    kept separately for cold and warm requests, under (endpoint, 'cold') and
+    (endpoint, 'warm')."""
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    stages = defaultdict(lambda: defaultdict(list))
+    queue = iter(zip(requests, cold))
+
+    async def worker():
+        for (endpoint, method, path, params), is_cold in queue:
+            temperature = 'cold' if is_cold else 'warm'
+            t0 = time.perf_counter()
+            try:
+                response = await client.request(method, path, params=params)
+                failed = response.status_code >= 400
+                timings = parse_server_timing(response.headers.get('server-timing', ''))
+                for name, milliseconds in timings.items():
+                    stages[endpoint][name].append(milliseconds)
+            except httpx.HTTPError:
+                failed = True
+            latency = time.perf_counter() - t0
+            latencies[endpoint].append(latency)
+            latencies[(endpoint, temperature)].append(latency)
+            if failed:
+                errors[endpoint] += 1
+                errors[(endpoint, temperature)] += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return time.perf_counter() - t0, latencies, errors, stages
+
+
+def summarize(latencies: list, errors: int, seconds: float) -> dict:
+    values = np.array(latencies) * 1000
+    summary = {'requests': len(values), 'errors': errors,
+               'throughput': round(len(values) / seconds, 2),
+               'mean_ms': round(float(values.mean()), 3)}
+    for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f'p{percentile}_ms'] = round(float(value), 3)
+    return summary
+
+
+def summarize_stages(stages: dict, requests: int) -> dict:
+    """Return the mean and p95 of the stage timings in milliseconds, the mean is
+    taken over all requests, including those that did not have the stage."""
+    summary = {}
+    for name, values in sorted(stages.items()):
+        summary[name] = {'mean_ms': round(sum(values) / requests, 3),
+                         'p95_ms': round(float(np.percentile(values, 95)), 3)}
+    return summary
+
+
+async def benchmark(args) -> dict:
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        startup = shutdown = None
+    else:
+        if args.memory:
+            config.SEARCH_BACKEND = 'memory'
+            config.MEMORY_BACKEND_FILES = args.memory
+        if args.no_cache:
+            # the caches are created when the API is imported
+            config.SEARCH_CACHE_SIZE = 0
+            config.DOCUMENT_CACHE_SIZE = 0
+            config.DOCUMENT_CACHE_PATH = None
+            config.RELATED_CACHE_SIZE = 0
+        import api
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=api.app),
+            base_url='http://benchmark', timeout=args.timeout)
+        startup, shutdown = api.app.router.startup, api.app.router.shutdown
+    if startup is not None:
+        await startup()
+    try:
+        questions = read_questions(args.queries)
+        doc_ids = await collect_ids(client, questions)
+        weights = parse_mix(args.mix)
+        requests = make_requests(args.seed, args.requests, weights, questions, doc_ids)
+        cold = label_cold(requests, args.no_cache)
+        seconds, latencies, errors, stages = await run(client, requests, args.concurrency, cold)
+    finally:
+        await client.aclose()
+        if shutdown is not None:
+            await shutdown()
+    all_latencies = [latency for endpoint in ENDPOINTS for latency in latencies[endpoint]]
+    caches = {}
+    # without caches all requests are cold and the split would repeat the totals
+    for temperature in () if args.no_cache else ('cold', 'warm'):
+        values = [latency for endpoint in ENDPOINTS for latency in latencies[(endpoint, temperature)]]
+        if values:
+            caches[temperature] = {
+                endpoint: summarize(latencies[(endpoint, temperature)],
+                                    errors[(endpoint, temperature)], seconds)
+                for endpoint in ENDPOINTS if latencies[(endpoint, temperature)]}
+            caches[temperature]['total'] = summarize(
+                values, sum(errors[(endpoint, temperature)] for endpoint in ENDPOINTS), seconds)
+    return {
+        'settings': {
+            'url': args.url, 'backend': 'memory' if args.memory else config.SEARCH_BACKEND,
+            'caches': not args.no_cache,
+            'requests': args.requests, 'concurrency': args.concurrency,
+            'seed': args.seed, 'mix': weights, 'questions': len(questions),
+            'documents': len(doc_ids), 'python': platform.python_version(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+        'seconds': round(seconds, 3),
+        'total': summarize(all_latencies, sum(errors.values()), seconds),
+        'endpoints': {endpoint: summarize(latencies[endpoint], errors[endpoint], seconds)
+                      for endpoint in ENDPOINTS if latencies[endpoint]},
+        'caches': caches,
+        'stages': {endpoint: summarize_stages(stages[endpoint], len(latencies[endpoint]))
+                   for endpoint in ENDPOINTS if stages[endpoint]}}
+
+
+def report_rows(results: dict) -> list:
+    """Return pairs of a row name and a summary, for all requests and for the cold
+    and warm requests."""
+    rows = list(results['endpoints'].items()) + [('total', results['total'])]
+    for temperature, summaries in results.get('caches', {}).items():
+        rows.extend((f'{name} {temperature}', summary) for name, summary in summaries.items())
+    return rows
+
+
+def print_report(results: dict):
+    caches = 'on' if results['settings'].get('caches', True) else 'off'
+    print(f"\n{results['settings']['requests']} requests with concurrency "
+          f"{results['settings']['concurrency']} in {results['seconds']} seconds, "
+          f"caches {caches}\n")
+    columns = ('requests', 'errors', 'throughput', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')
+    print(f"{'':16}" + ''.join(f'{column:>12}' for column in columns))
+    for name, summary in report_rows(results):
+        print(f'{name:16}' + ''.join(f'{summary[column]:>12}' for column in columns))
+    if results['stages']:
+        print(f"\n{'':16}{'stage':>12}{'mean_ms':>12}{'p95_ms':>12}")
+        for endpoint, stages in results['stages'].items():
+            for name, summary in stages.items():
+                print(f"{endpoint:16}{name:>12}{summary['mean_ms']:>12}{summary['p95_ms']:>12}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the changes relative to the baseline and return True if nothing got
+    worse by more than the tolerance, which is a percentage."""
+    print(f"\ncompared to the baseline of {baseline['settings']['date']}\n")
+    if baseline['settings'].get('caches', True) != results['settings']['caches']:
+        print('warning: the caches were switched on in one run and off in the other\n')
+    print(f"{'':16}{'metric':>12}{'baseline':>12}{'current':>12}{'change':>10}")
+    ok = True
+    baseline_rows = dict(report_rows(baseline))
+    for name, summary in report_rows(results):
+        base = baseline_rows.get(name)
+        if base is None:
+            continue
+        for metric in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = base[metric], summary[metric]
+            change = (new - old) / old * 100 if old else 0.0
+            # for throughput higher is better, for latencies lower is better
+            worse = -change if metric == 'throughput' else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  worse'
+                ok = False
+            print(f'{name:16}{metric:>12}{old:>12}{new:>12}{change:>+9.1f}%{flag}')
+    return ok
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="benchmark a running server instead of the API in this process")
+    parser.add_argument("--memory", nargs='+', metavar='FILE', help="use the memory backend with these bulk files")
+    parser.add_argument("--requests", default=1000, type=int, help="number of requests")
+    parser.add_argument("--concurrency", default=8, type=int, help="number of concurrent clients")
+    parser.add_argument("--mix", help="endpoint weights, for example question=60,doc=15,related=10,set=15")
+    parser.add_argument("--queries", help="file with questions, one per line")
+    parser.add_argument("--seed", default=42, type=int, help="seed for generating the requests")
+    parser.add_argument("--timeout", default=30.0, type=float, help="request timeout in seconds")
+    parser.add_argument("--save", metavar='FILE', help="save the results as JSON")
+    parser.add_argument("--baseline", metavar='FILE', help="compare with saved results")
+    parser.add_argument("--tolerance", default=10.0, type=float, help="allowed change in percent")
+    parser.add_argument("--no-cache", action='store_true', help="switch off the caches of the API")
+    args = parser.parse_args()
+    if args.no_cache and args.url:
+        parser.error('--no-cache only works for the API in this process, '
+                     'switch off the caches in config.py of the server')
+
+    results = asyncio.run(benchmark(args))
+    print_report(results)
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
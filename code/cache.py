@@ -0,0 +1,292 @@
+"""Caches used by the API
+
+LRUCache is a plain size bounded cache. TTLCache adds expiry to that and knows
+how to serve stale entries while a new value is computed in the background.
+DocumentCache holds documents by identifier, it has an LRU cache in memory and
+an optional SQLite database on disk that is shared by all API worker processes.
+All caches can be tied to the generation of the ElasticSearch index, when the
+index changes all entries are dropped.
+
+"""
+
+import os
+import time
+import json
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from document import Document, SOURCE_FIELDS
+
+
+logger = logging.getLogger(__name__)
+
+MISS = 'miss'
+FRESH = 'fresh'
+STALE = 'stale'
+
+
+class LRUCache:
+
+    """Dictionary-like cache that evicts the least recently used entries when
+    more than maxsize entries are stored."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.generation = None
+        self.data = OrderedDict()
+
+    def __str__(self):
+        return f'<{self.__class__.__name__} size={len(self)} maxsize={self.maxsize}>'
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            self.data.move_to_end(key)
+            return self.data[key]
+        except KeyError:
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def set_generation(self, generation):
+        """Drop all entries if the generation of the index changed."""
+        if generation != self.generation:
+            if self.generation is not None:
+                logger.info(f'{self} invalidated, index generation changed')
+            self.clear()
+            self.generation = generation
+
+
+class TTLCache(LRUCache):
+
+    """LRU cache where entries are fresh for ttl seconds and after that can still
+    be served for another stale seconds while they are being refreshed."""
+
+    def __init__(self, maxsize: int, ttl: float, stale: float = 0):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.stale = stale
+        # futures for values that are being computed, used so that concurrent
+        # requests for the same key only compute the value once
+        self.pending = {}
+
+    def put(self, key, value):
+        super().put(key, (value, time.monotonic()))
+
+    def lookup(self, key):
+        """Return a pair of the value and the state of the entry, where the state
+        is one of MISS, FRESH or STALE."""
+        entry = super().get(key)
+        if entry is None:
+            return None, MISS
+        value, stored_at = entry
+        age = time.monotonic() - stored_at
+        if age <= self.ttl:
+            return value, FRESH
+        if age <= self.ttl + self.stale:
+            return value, STALE
+        self.pop(key)
+        return None, MISS
+
+    async def get_or_compute(self, key, compute, cacheable=None):
+        """Return the cached value for the key, computing it by awaiting compute()
+        if there is no usable entry. Stale entries are returned right away and a
+        refresh is started in the background. If cacheable is given it is called
+        on a computed value to decide whether the value can be stored."""
+        value, state = self.lookup(key)
+        if state == FRESH:
+            return value
+        if state == STALE:
+            if key not in self.pending:
+                # the request does not wait for the refresh
+                self.pending[key] = metrics.detached(
+                    self._compute(key, compute, cacheable))
+                self.pending[key].add_done_callback(self._log_failure)
+            return value
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(
+                self._compute(key, compute, cacheable))
+        return await asyncio.shield(self.pending[key])
+
+    async def _compute(self, key, compute, cacheable=None):
+        generation = self.generation
+        try:
+            value = await compute()
+            # do not store values computed against an index that has since changed
+            if generation == self.generation and (cacheable is None or cacheable(value)):
+                self.put(key, value)
+            return value
+        finally:
+            self.pending.pop(key, None)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f'Refreshing cache entry failed: {future.exception()}')
+
+
+class DocumentCache:
+
+    """Two-tier cache of Documents keyed on the document identifier. The first
+    tier is an in-process LRU cache with Document objects, the second tier is
+    an optional SQLite database with the JSON of the ElasticSearch hits, which
+    is shared between processes. Documents in the cache should be treated as
+    read-only since they are shared between requests.
+
+    The database is only used from one thread per process, so that the event
+    loop is not held up by disk access. Lookups in the database are awaited,
+    writes are queued on that thread and put_many() does not wait for them."""
+
+    def __init__(self, maxsize: int, path: str = None):
+        self.memory = LRUCache(maxsize)
+        self.path = path
+        self.generation = None
+        # the connection and the thread that uses it are created lazily and per
+        # process since SQLite connections should not be shared by forked workers
+        self._connection = None
+        self._executor = None
+        self._pid = None
+
+    def __str__(self):
+        return f'<DocumentCache memory={len(self.memory)} path={self.path}>'
+
+    def __len__(self):
+        return len(self.memory)
+
+    def executor(self) -> ThreadPoolExecutor:
+        """Return the executor with the one thread that uses the database, or None
+        if there is no database."""
+        if self.path is None:
+            return None
+        if self._executor is None or self._pid != os.getpid():
+            self._connection = None
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='document-cache')
+            self._pid = os.getpid()
+        return self._executor
+
+    def connection(self):
+        # only called on the thread of the executor
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=5)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS documents '
+                '(id TEXT PRIMARY KEY, generation TEXT, hit TEXT)')
+        return self._connection
+
+    def submit(self, function, *args):
+        """Queue a write to the database, failures are logged."""
+        future = self.executor().submit(function, *args)
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f'Writing to the document cache failed: {future.exception()}')
+
+    def set_generation(self, generation):
+        if generation != self.generation:
+            self.memory.set_generation(generation)
+            if self.path is not None:
+                self.submit(self._delete_other_generations, generation)
+            self.generation = generation
+
+    def _delete_other_generations(self, generation):
+        with self.connection() as connection:
+            connection.execute('DELETE FROM documents WHERE generation != ?', (generation,))
+
+    async def get(self, doc_id: str):
+        return (await self.get_many([doc_id])).get(doc_id)
+
+    async def get_many(self, doc_ids: list) -> dict:
+        """Return a dictionary with the Documents found in the cache, indexed on
+        the document identifier."""
+        found = {}
+        missing = []
+        for doc_id in doc_ids:
+            doc = self.memory.get(doc_id)
+            if doc is None:
+                missing.append(doc_id)
+            else:
+                found[doc_id] = doc
+        if missing and self.path is not None:
+            hits = await asyncio.get_running_loop().run_in_executor(
+                self.executor(), self._read, self.generation, missing)
+            for hit in hits:
+                doc = Document(hit)
+                self.memory.put(doc.identifier, doc)
+                found[doc.identifier] = doc
+        return found
+
+    def _read(self, generation, doc_ids: list) -> list:
+        hits = []
+        connection = self.connection()
+        # stay well below the limit on the number of SQL variables
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i+500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = connection.execute(
+                f'SELECT hit FROM documents WHERE generation = ? AND id IN ({placeholders})',
+                [generation] + chunk)
+            hits.extend(json.loads(hit) for (hit,) in rows)
+        return hits
+
+    def put(self, hit: dict) -> Document:
+        """Create a Document from an ElasticSearch hit, add it to the cache and
+        return it. The hit should have all fields from document.SOURCE_FIELDS,
+        other source fields are not stored on disk."""
+        docs = self.put_many([hit])
+        return docs[0] if docs else None
+
+    def put_many(self, hits: list) -> list:
+        """Like put() but for a list of hits, hits for documents that were not
+        found are skipped."""
+        docs = []
+        rows = []
+        for hit in hits:
+            # skip identifiers that ES.mget() could not find
+            if not hit.get('found', True):
+                continue
+            source = hit['_source']
+            stored_hit = {
+                '_id': hit['_id'],
+                '_source': {f: source[f] for f in SOURCE_FIELDS if f in source}}
+            doc = Document(hit)
+            self.memory.put(doc.identifier, doc)
+            docs.append(doc)
+            rows.append((doc.identifier, self.generation, json.dumps(stored_hit)))
+        if rows and self.path is not None:
+            self.submit(self._write, rows)
+        return docs
+
+    def _write(self, rows: list):
+        with self.connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?)', rows)
+
+    def flush(self):
+        """Wait for the writes that were queued so far."""
+        if self.path is not None:
+            self.executor().submit(lambda: None).result()
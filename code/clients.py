@@ -0,0 +1,154 @@
+"""ElasticSearch clients
+
+All modules get their ElasticSearch client from here. There is one synchronous
+and one asynchronous client per process, each with its own connection pool, and
+both are created on first use with the settings in config.py:
+
+ELASTIC_HOSTS                requests are spread over these nodes
+ELASTIC_NODE_SELECTOR        how a node is picked, 'round_robin' or 'random'
+ELASTIC_CONNECTIONS_PER_NODE size of the connection pool for each node
+ELASTIC_HTTP_COMPRESS        gzip request and response bodies
+ELASTIC_REQUEST_TIMEOUT      default request timeout in seconds
+ELASTIC_TIMEOUTS             request timeouts for specific ElasticSearch APIs
+ELASTIC_MAX_RETRIES          retries on connection errors and the statuses
+ELASTIC_RETRY_ON_STATUS      in ELASTIC_RETRY_ON_STATUS, and on timeouts if
+ELASTIC_RETRY_ON_TIMEOUT     ELASTIC_RETRY_ON_TIMEOUT is set
+ELASTIC_SNIFF                find the nodes of the cluster at start-up and
+ELASTIC_SNIFF_INTERVAL       when a node fails, at most once per interval
+
+Connections are kept alive and reused by the pool. With SEARCH_BACKEND set to
+'memory' the clients are replaced by the memory backend.
+
+Pass the name of the ElasticSearch API to client() or async_client() to get a
+client with the timeout for that API:
+
+client('search').search(index=INDEX, query=query)
+
+The methods of the clients that AskMe uses are listed in the SearchBackend
+protocol, the ElasticSearch clients and the memory backend all provide them.
+Code that needs another method of the client should add it to the protocol and
+to the memory backend.
+
+"""
+
+from typing import Protocol, runtime_checkable
+
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+
+import config
+import timing
+
+
+class Indices(Protocol):
+
+    """The part of the indices namespace of a client that AskMe uses."""
+
+    def get(self, *, index: str, **kwargs): ...
+
+    def get_settings(self, *, index: str, **kwargs): ...
+
+    def stats(self, *, index: str, metric: str, **kwargs): ...
+
+
+@runtime_checkable
+class SearchBackend(Protocol):
+
+    """The part of the ElasticSearch client that AskMe uses, with the arguments
+    that are used. Responses have the structure of ElasticSearch responses. For
+    the asynchronous clients the methods are coroutines."""
+
+    indices: Indices
+
+    def options(self, **kwargs) -> 'SearchBackend': ...
+
+    def ping(self, **kwargs): ...
+
+    def close(self): ...
+
+    def search(self, *, index: str = None, query: dict = None, size: int = None,
+               from_: int = None, sort: list = None, search_after: list = None,
+               pit: dict = None, timeout: str = None, track_total_hits=None,
+               source=None, source_includes: list = None, **kwargs): ...
+
+    def msearch(self, *, searches: list, index: str = None, **kwargs): ...
+
+    def mget(self, *, index: str, ids: list, source=None,
+             source_includes: list = None, **kwargs): ...
+
+    def get(self, *, index: str, id: str, source=None,
+            source_includes: list = None, **kwargs): ...
+
+    def open_point_in_time(self, *, index: str, keep_alive: str, **kwargs): ...
+
+    def close_point_in_time(self, *, id: str, **kwargs): ...
+
+
+# The clients are created on first use
+_CLIENT = None
+_ASYNC_CLIENT = None
+
+
+def client_options() -> dict:
+    """Return the keyword arguments for creating a client."""
+    options = {
+        'hosts': list(config.ELASTIC_HOSTS),
+        'basic_auth': (config.ELASTIC_USER, config.ELASTIC_PASSWORD),
+        'node_selector_class': config.ELASTIC_NODE_SELECTOR,
+        'connections_per_node': config.ELASTIC_CONNECTIONS_PER_NODE,
+        'http_compress': config.ELASTIC_HTTP_COMPRESS,
+        'request_timeout': config.ELASTIC_REQUEST_TIMEOUT,
+        'max_retries': config.ELASTIC_MAX_RETRIES,
+        'retry_on_status': tuple(config.ELASTIC_RETRY_ON_STATUS),
+        'retry_on_timeout': config.ELASTIC_RETRY_ON_TIMEOUT }
+    if config.ELASTIC_SNIFF:
+        options.update({
+            'sniff_on_start': True,
+            'sniff_on_node_failure': True,
+            'min_delay_between_sniffing': config.ELASTIC_SNIFF_INTERVAL })
+    return options
+
+
+def with_timeout(es, api: str = None):
+    """Return the client with the request timeout for the API, if there is one."""
+    timeout = config.ELASTIC_TIMEOUTS.get(api) if api is not None else None
+    if timeout is None:
+        return es
+    return es.options(request_timeout=timeout)
+
+
+def client(api: str = None) -> SearchBackend:
+    """Return the ElasticSearch client, creating it if needed."""
+    global _CLIENT
+    if _CLIENT is None:
+        if config.SEARCH_BACKEND == 'memory':
+            import memory_backend
+            with timing.timed('memory backend'):
+                _CLIENT = memory_backend.client()
+        else:
+            with timing.timed('elasticsearch client'):
+                _CLIENT = Elasticsearch(**client_options())
+            timing.loaded('elasticsearch')
+    return with_timeout(_CLIENT, api)
+
+
+def async_client(api: str = None) -> SearchBackend:
+    """Return the asynchronous ElasticSearch client, creating it if needed."""
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None:
+        if config.SEARCH_BACKEND == 'memory':
+            import memory_backend
+            with timing.timed('memory backend'):
+                _ASYNC_CLIENT = memory_backend.async_client()
+        else:
+            with timing.timed('async elasticsearch client'):
+                _ASYNC_CLIENT = AsyncElasticsearch(**client_options())
+            timing.loaded('async elasticsearch')
+    return with_timeout(_ASYNC_CLIENT, api)
+
+
+async def close():
+    """Close the connections of the asynchronous client."""
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is not None:
+        await _ASYNC_CLIENT.close()
+        _ASYNC_CLIENT = None
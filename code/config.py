@@ -3,23 +3,115 @@ ELASTIC_HOST = 'localhost'
 ELASTIC_PORT = 9200
 ELASTIC_INDEX = 'xdd'
 
-# Edit as needed. The askme user should at least have the viewer role.
+# Edit as needed. The askme user should at least have the viewer role. To notice
+# changes to the index (see INDEX_GENERATION_INTERVAL) it also needs the monitor
+# privilege on the index, without it the caches are not emptied when it changes.
 ELASTIC_USER = 'askme'
 ELASTIC_PASSWORD = 'pw-askme'
 
+# ElasticSearch nodes, requests are spread over all nodes. The node selector is
+# 'round_robin' or 'random'. With sniffing the client asks the cluster for all
+# its nodes at start-up and when a node fails, at most once per interval.
+ELASTIC_HOSTS = [f'http://{ELASTIC_HOST}:{ELASTIC_PORT}']
+ELASTIC_NODE_SELECTOR = 'round_robin'
+ELASTIC_SNIFF = False
+ELASTIC_SNIFF_INTERVAL = 10.0
+
+# Number of connections each process keeps open to each node, and whether request
+# and response bodies are compressed.
+ELASTIC_CONNECTIONS_PER_NODE = 10
+ELASTIC_HTTP_COMPRESS = False
+
+# Request timeouts in seconds, with timeouts for specific ElasticSearch APIs. The
+# searches of /api/question also have a time budget that ElasticSearch keeps to
+# itself, see REQUEST_BUDGET.
+ELASTIC_REQUEST_TIMEOUT = 10.0
+ELASTIC_TIMEOUTS = {
+    'search': 10.0, 'msearch': 20.0, 'mget': 10.0, 'get': 5.0, 'count': 5.0,
+    'open_point_in_time': 5.0, 'close_point_in_time': 5.0 }
+
+# Requests are retried on connection errors and on these statuses, and on
+# timeouts if ELASTIC_RETRY_ON_TIMEOUT is set.
+ELASTIC_MAX_RETRIES = 3
+ELASTIC_RETRY_ON_STATUS = (502, 503, 504)
+ELASTIC_RETRY_ON_TIMEOUT = False
+
+# The search backend, 'elasticsearch' or 'memory'. The memory backend is a small
+# search engine that runs inside the API process and that loads its documents
+# from files in the format of the ElasticSearch bulk API, which are the files
+# that are loaded into ElasticSearch. It is meant for testing, benchmarking and
+# profiling without an ElasticSearch server, see memory_backend.py.
+SEARCH_BACKEND = 'elasticsearch'
+MEMORY_BACKEND_FILES = ()
+
 # List of tags to display in the Flask interface, this is not used by the
 # React website and is not as up-to-date.
 TAGS = ('biomedical', 'geoarchive', 'molecular_physics')
 
 # Number of tokens we allow in the summary, set to a number that keeps processing
-# of a query below 0.5 seconds.
+# of a query below 0.5 seconds when the reranker uses NLP.
 SUMMARY_SIZE = 500
 
+# Weights for the features that the reranker combines into the nscore of a
+# document: the ElasticSearch score, the cosine similarity of the tfidf weights
+# of the document terms with the query terms, the share of query terms that are
+# terms of the document, and matches of the query in the parsed summary. All of
+# these are scaled to a maximum of 1.0 over the hits before they are combined.
+RERANK_WEIGHTS = {'elastic': 1.0, 'cosine': 0.5, 'coverage': 0.5, 'summary': 0.5}
+
+# Whether the reranker runs spaCy over the summaries. This is much slower than
+# the rest of the reranking and it is switched off by default. The NLP settings
+# below only matter if this is switched on.
+RERANK_NLP = False
+
 # Maximum number of documents to run NLP over (for ranking). In the past 20 seemed 
 # to be a good cut off, with benefits in evaluation most pronounced over the first
 # 20 documents.
 MAX_DOCUMENTS_FOR_NLP = 20
 
+# Time budget in seconds for a query. This is handed to ElasticSearch as the
+# search timeout and is the deadline for the NLP part of reranking. When time
+# runs out the documents that were not processed keep the ElasticSearch order
+# and the response says that reranking was partial.
+REQUEST_BUDGET = 0.5
+
+# Whether the API loads its resources (the ElasticSearch connection and, if NLP
+# is used, the NLP worker processes) right after starting up. Otherwise they are
+# loaded when first needed. The /api/ready endpoint reports on this.
+WARM_UP = True
+
+# Number of worker processes the API uses for NLP processing, each process has
+# its own copy of the spaCy model. Summaries are handed to the workers in chunks
+# of NLP_CHUNK_SIZE, a smaller size means less work is lost when time runs out.
+NLP_POOL_SIZE = 1
+NLP_CHUNK_SIZE = 5
+
+# Components of the spaCy pipeline that are not loaded because the ranker does
+# not use them. The tagger, attribute ruler and lemmatizer are kept, as is the
+# tok2vec component since the tagger depends on it.
+NLP_EXCLUDE = ("ner", "parser")
+
+# Summaries are parsed in batches of this size with nlp.pipe(). For batches with
+# at least NLP_MULTIPROCESS_THRESHOLD texts the work is spread over NLP_PROCESSES
+# processes, this is useful for large batch jobs but not for regular queries.
+NLP_BATCH_SIZE = 64
+NLP_PROCESSES = 1
+NLP_MULTIPROCESS_THRESHOLD = 500
+
+# Parsed summaries can be cached on disk so that summaries of documents that come
+# back for many queries are only parsed once. Set NLP_CACHE_PATH to a file name to
+# use the cache, for example '/tmp/askme-parses.db', the cache is shared by all
+# processes on the host and can be filled in advance with nlpcache.py. The cache
+# holds at most NLP_CACHE_SIZE parses on disk and NLP_CACHE_MEMORY in memory.
+NLP_CACHE_PATH = None
+NLP_CACHE_SIZE = 200000
+NLP_CACHE_MEMORY = 1000
+
+# Time in seconds that the API waits to collect the documents of concurrent
+# queries so they can be reranked in one batch. With 0 every query is reranked
+# by itself.
+RERANK_BATCH_WINDOW = 0
+
 # maximum number of results to print
 MAX_RESULTS = 20
 
@@ -28,6 +120,81 @@ MAX_RESULTS = 20
 # set this as limit for now (need to decide on max pages wanted for performance reasons)
 MAX_PAGES = 40
 
+# maximum number of questions in one request to /api/questions
+MAX_QUESTIONS = 50
+
+# Counting all matches of a query is expensive and we only need the count to
+# create the links to numbered pages, so we stop counting at this number.
+TRACK_TOTAL_HITS = MAX_RESULTS * MAX_PAGES
+
+# Pages beyond the numbered pages are reached with the page tokens returned in
+# the pages block of /api/question, these use an ElasticSearch point in time that
+# is kept alive for this long after each page. The point in time is closed when
+# the last page is served, when paging stops earlier it expires after this time.
+PIT_KEEP_ALIVE = '5m'
+
+# Number of hits fetched from ElasticSearch at a time when /api/export streams
+# all results of a query, only one batch is held in memory.
+EXPORT_BATCH_SIZE = 1000
+
+# Results of /api/question are cached. The cache holds at most this many queries,
+# entries are fresh for SEARCH_CACHE_TTL seconds and can be served for another
+# SEARCH_CACHE_STALE seconds while they are refreshed in the background. Set the
+# size to 0 to switch off the cache.
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_STALE = 600
+
+# Documents returned by /api/doc, /api/set and /api/related are cached by their
+# identifier. The first tier is an in-memory LRU cache per API worker, holding at
+# most DOCUMENT_CACHE_SIZE documents. The second tier is an SQLite database that
+# is shared by all workers on a host, set DOCUMENT_CACHE_PATH to a file name to
+# use it, for example '/tmp/askme-documents.db'.
+DOCUMENT_CACHE_SIZE = 5000
+DOCUMENT_CACHE_PATH = None
+
+# Documents for /api/set that are not cached are retrieved with multi-get requests
+# for at most MGET_CHUNK_SIZE documents each, with at most MGET_CONCURRENCY of
+# those requests running at the same time.
+MGET_CHUNK_SIZE = 250
+MGET_CONCURRENCY = 4
+
+# Terms are mapped to integers when the terms of a document set are added up. The
+# mapping is shared by all requests and starts over when it holds more than this
+# number of terms.
+TERM_VOCABULARY_SIZE = 1000000
+
+# Related documents are found with a more_like_this query on these fields, using
+# at most RELATED_MAX_TERMS of the terms with the highest tfidf scores in the
+# document. Lists of related documents are cached for RELATED_CACHE_SIZE documents.
+RELATED_FIELDS = ('title', 'abstract')
+RELATED_MAX_TERMS = 25
+RELATED_CACHE_SIZE = 5000
+
+# Directory with the related documents that were computed in advance with
+# neighbours.py, set to None to always search for related documents.
+NEIGHBOURS_PATH = None
+
+# Directory with the synonyms and related terms that were computed in advance
+# with expansions.py, set to None to switch off query expansion. An expanded query
+# gets at most EXPANSION_TERMS related terms, and the expansion terms count for
+# less than the terms of the query itself.
+EXPANSIONS_PATH = None
+EXPANSION_TERMS = 3
+EXPANSION_SYNONYMS = 5
+EXPANSION_BOOST = 0.5
+
+# Caches are emptied when the index changes (for example after a data drop). This
+# is how often in seconds we check ElasticSearch for changes to the index.
+INDEX_GENERATION_INTERVAL = 10
+
+# Timings of the stages of handling a request (ElasticSearch, creating Documents,
+# reranking and serialization). These are returned in the Server-Timing header
+# of responses and collected in histograms for /api/metrics, with the buckets
+# below in seconds. Switch this off to skip all timing.
+METRICS = True
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
 # Fields to search when doing a basic text search
 SEARCH_FIELDS = ('title', 'abstract', 'content')
 
@@ -44,3 +211,7 @@ FIELDS_FOR_MULTIPLE_DOCS = RETURN_FIELDS + ('score', 'nscore')
 # become irrelevant, but terms are added. Do not change these unless you know what 
 # you are doing and know how to change code in document.py.
 FIELDS_FOR_SINGLE_DOC = RETURN_FIELDS + ('terms',)
+
+# List of fields included for documents returned by the /api/set endpoint. This
+# is what you get for multiple documents plus the entities and terms.
+FIELDS_FOR_SET = FIELDS_FOR_MULTIPLE_DOCS + ('entities', 'terms')
@@ -0,0 +1,126 @@
+"""Fixtures shared by the tests
+
+The tests that need a search backend use the memory backend (see memory_backend.py)
+with the documents below, so they run without ElasticSearch. Run the tests from
+this directory:
+
+$ python -m pytest
+
+"""
+
+import json
+
+import pytest
+
+import config
+
+
+def terms(*triples):
+    # terms are stored with the frequency and tfidf score as strings
+    return [[term, str(freq), str(tfidf)] for term, freq, tfidf in triples]
+
+
+DOCUMENTS = {
+    'd1': {
+        'title': 'Influenza vaccine trials in children',
+        'abstract': 'A study of influenza vaccines and flu transmission in children.',
+        'content': 'The influenza vaccine reduced flu cases. Vaccine trials ran for two years.',
+        'tags': ['biomedical'], 'year': 2019, 'url': 'https://example.org/d1',
+        'authors': ['Ann Smith'],
+        'summary': 'Influenza vaccine trials in children reduced flu cases.',
+        'entities': {'DISEASE': ['influenza']},
+        'terms': terms(('influenza', 3, 0.9), ('vaccine', 3, 0.8), ('flu', 1, 0.3),
+                       ('children', 2, 0.2))},
+    'd2': {
+        'title': 'Flu transmission in schools',
+        'abstract': 'How the flu spreads between children in schools.',
+        'content': 'Flu transmission in schools is high. Flu cases peak in winter.',
+        'tags': ['biomedical'], 'year': 2020, 'url': 'https://example.org/d2',
+        'authors': ['Bo Jones'],
+        'summary': 'Flu transmission in schools peaks in winter.',
+        'entities': {'DISEASE': ['flu']},
+        'terms': terms(('flu', 4, 0.9), ('transmission', 2, 0.7), ('schools', 2, 0.5),
+                       ('children', 1, 0.2))},
+    'd3': {
+        'title': 'Heart disease and diet',
+        'abstract': 'Diet is a risk factor for heart disease.',
+        'content': 'Patients with heart disease changed their diet.',
+        'tags': ['biomedical'], 'year': 2018, 'url': 'https://example.org/d3',
+        'authors': ['Cy Lee'],
+        'summary': 'Diet and heart disease.',
+        'entities': {'DISEASE': ['heart disease']},
+        'terms': terms(('heart disease', 2, 0.9), ('diet', 2, 0.8), ('patients', 1, 0.1))},
+    'd4': {
+        'title': 'Water on Mars',
+        'abstract': 'Evidence for liquid water on Mars from the rover.',
+        'content': 'The Mars rover found minerals that formed in water.',
+        'tags': ['mars'], 'year': 2021, 'url': 'https://example.org/d4',
+        'authors': ['Di Park'],
+        'summary': 'The rover found evidence for water on Mars.',
+        'entities': {'LOCATION': ['Mars']},
+        'terms': terms(('water', 3, 0.9), ('mars', 2, 0.6), ('rover', 1, 0.4))},
+    'd5': {
+        'title': 'Mars rover geology',
+        'abstract': 'Rocks and sediment studied by the Mars rover.',
+        'content': 'Sediment layers on Mars were formed by water and wind.',
+        'tags': ['mars', 'geoarchive'], 'year': 2022, 'url': 'https://example.org/d5',
+        'authors': ['Ed Kim'],
+        'summary': 'The Mars rover studied sediment.',
+        'entities': {'LOCATION': ['Mars']},
+        'terms': terms(('rover', 3, 0.9), ('mars', 2, 0.6), ('sediment', 2, 0.5),
+                       ('water', 1, 0.2))},
+    'd6': {
+        'title': 'Glacier retreat and sea level',
+        'abstract': 'Glaciers retreat and the sea level rises.',
+        'content': 'Melting glaciers add water to the sea.',
+        'tags': ['geoarchive'], 'year': 2017, 'url': 'https://example.org/d6',
+        'authors': ['Flo Ng'],
+        'summary': 'Glacier retreat raises the sea level.',
+        'entities': {},
+        'terms': terms(('glacier', 3, 0.9), ('sea level', 2, 0.7), ('water', 1, 0.1))},
+}
+
+
+def write_bulk(path, documents: dict):
+    with open(path, 'w') as fh:
+        for doc_id, source in documents.items():
+            fh.write(json.dumps({'index': {'_id': doc_id}}) + '\n')
+            fh.write(json.dumps(source) + '\n')
+    return str(path)
+
+
+@pytest.fixture
+def bulk_file(tmp_path):
+    return write_bulk(tmp_path / 'bulk.json', DOCUMENTS)
+
+
+@pytest.fixture
+def backend(monkeypatch, bulk_file):
+    """Switch to the memory backend with DOCUMENTS loaded and start with empty
+    clients and caches. Returns the MemoryClient."""
+    import api
+    import cache
+    import clients
+    import elastic_async
+    import memory_backend
+    monkeypatch.setattr(config, 'SEARCH_BACKEND', 'memory')
+    monkeypatch.setattr(config, 'MEMORY_BACKEND_FILES', [bulk_file])
+    monkeypatch.setattr(memory_backend, '_CLIENT', None)
+    monkeypatch.setattr(clients, '_CLIENT', None)
+    monkeypatch.setattr(clients, '_ASYNC_CLIENT', None)
+    monkeypatch.setattr(elastic_async, '_generation', None)
+    monkeypatch.setattr(elastic_async, '_generation_checked', None)
+    monkeypatch.setattr(elastic_async, 'DOCUMENTS', cache.DocumentCache(config.DOCUMENT_CACHE_SIZE))
+    monkeypatch.setattr(api, 'SEARCH_CACHE', cache.TTLCache(
+        config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL, config.SEARCH_CACHE_STALE))
+    monkeypatch.setattr(api, 'RELATED_CACHE', cache.LRUCache(config.RELATED_CACHE_SIZE))
+    return memory_backend.client()
+
+
+@pytest.fixture
+def api_client(backend):
+    """A test client for the API running on the memory backend."""
+    from fastapi.testclient import TestClient
+    import api
+    with TestClient(api.app) as client:
+        yield client
@@ -1,30 +1,77 @@
+from math import sqrt
 from operator import itemgetter
 
+import numpy as np
+
+import serialize
+from aggregation import VOCABULARY, top_terms
 from config import SUMMARY_SIZE, FIELDS_FOR_MULTIPLE_DOCS, FIELDS_FOR_SINGLE_DOC
 
 
+# Fields from the ElasticSearch source that are used by Document, other fields
+# like the abstract and the content do not need to be retrieved.
+SOURCE_FIELDS = (
+	'tags', 'year', 'title', 'url', 'authors', 'summary', 'entities', 'terms')
+
+
 class Document():
 
-	"""Object created from a hit in the ElasticSearch response."""
+	"""Object created from a hit in the ElasticSearch response. Documents are created
+	for every hit, so they are kept small and the summary, terms and entities are
+	only taken from the source when they are first used."""
+
+	__slots__ = (
+		'identifier', 'score', 'nscore', 'tags', 'year', 'title', 'url', 'authors',
+		'_source', '_summary', '_terms', '_entities', '_term_vector', '_term_arrays',
+		'_json')
 
 	def __init__(self, hit: dict):
 		self.identifier = hit['_id']
+		# the source is missing when it was switched off in the request
+		source = hit.get('_source', {})
 		self.score = hit.get('_score', 0)
 		self.nscore = hit.get('_score', 0)
-		self.tags = hit['_source'].get('tags')
-		self.year = hit['_source'].get('year')
-		self.title = hit['_source'].get('title', '')
-		self.url = hit['_source'].get('url', '')
-		self.authors = hit['_source'].get('authors', [])
-		# take the summary of the abstract and text, to cut down the size of the
-		# object returned
-		full_summary = hit['_source'].get('summary', '')
-		# TODO: this now assumes whitespace is always a space (no newlines or tabs),
-		# which may change at any time
-		self.summary = ' '.join(full_summary.split()[:SUMMARY_SIZE])
-		self.entities = hit['_source'].get('entities', {})
-		self.terms = hit['_source'].get('terms', [])
-		self.restore_types()
+		self.tags = source.get('tags')
+		self.year = source.get('year')
+		self.title = source.get('title', '')
+		self.url = source.get('url', '')
+		self.authors = source.get('authors', [])
+		self._source = source
+		# created by the summary, terms and entities properties
+		self._summary = None
+		self._terms = None
+		self._entities = None
+		# created by term_weights() when the document is reranked
+		self._term_vector = None
+		# created by term_arrays() when the terms of a document set are added up
+		self._term_arrays = None
+		# created by json_bytes()
+		self._json = None
+
+	@property
+	def summary(self):
+		"""The summary of the abstract and text, cut down to SUMMARY_SIZE tokens to
+		cut down the size of the object returned."""
+		if self._summary is None:
+			full_summary = self._source.get('summary', '')
+			# with maxsplit the text after the tokens we keep is not split, it
+			# ends up as the last element which we leave out
+			tokens = full_summary.split(maxsplit=SUMMARY_SIZE)[:SUMMARY_SIZE]
+			self._summary = ' '.join(tokens)
+		return self._summary
+
+	@property
+	def terms(self):
+		if self._terms is None:
+			self._terms = self._source.get('terms', [])
+			self.restore_types()
+		return self._terms
+
+	@property
+	def entities(self):
+		if self._entities is None:
+			self._entities = self._source.get('entities', {})
+		return self._entities
 
 	def __str__(self):
 		return (f'<Document id={self.identifier} score={self.score:.4f}' \
@@ -33,7 +80,7 @@ class Document():
 	def restore_types(self):
 		"""For terms the frequency and tfidf were stored as strings, here we
 		restore them back to integers and floats."""
-		for term_triple in self.terms:
+		for term_triple in self._terms:
 			term_triple[1] = int(term_triple[1])
 			term_triple[2] = float(term_triple[2])
 
@@ -49,12 +96,58 @@ class Document():
 	def terms_as_string(self):
 		return ' '.join([term[0] for term in self.terms])
 
-	def as_json(self, single_doc=True):
+	def term_weights(self):
+		"""Return a dictionary from the lower-cased terms to their tfidf scores and the
+		Euclidean norm of those scores. This is used by the reranker, which only looks
+		up the query terms, so the scores are left as they were stored (usually as
+		strings) and the types of all terms are not restored. Calculated once for each
+		document."""
+		if self._term_vector is None:
+			terms = self._terms if self._terms is not None else self._source.get('terms', [])
+			weights = {term.lower(): tfidf for term, _, tfidf in terms}
+			scores = np.array(list(weights.values()), dtype=np.float64)
+			self._term_vector = (weights, sqrt(float(np.dot(scores, scores))))
+		return self._term_vector
+
+	@staticmethod
+	def source_fields(fields: list) -> list:
+		"""Return the fields from the ElasticSearch source that are needed to fill
+		in the given Document attributes. Attributes like identifier and score are
+		not taken from the source."""
+		return [field for field in fields if field in SOURCE_FIELDS]
+
+	def as_json(self, single_doc=True, fields=None):
 		"""Fields that are included are different depending whether we are returning
-		the JSON of a single document or wether this document is part of a list."""
-		fields = FIELDS_FOR_SINGLE_DOC if single_doc else FIELDS_FOR_MULTIPLE_DOCS
+		the JSON of a single document or wether this document is part of a list.
+		The fields can also be given explicitly."""
+		if fields is None:
+			fields = FIELDS_FOR_SINGLE_DOC if single_doc else FIELDS_FOR_MULTIPLE_DOCS
 		return { field: getattr(self, field) for field in fields }
 
+	def json_bytes(self, fields: tuple) -> bytes:
+		"""Return the serialized JSON of as_json() for the fields. The result is kept
+		and reused for documents from the document cache that are returned again
+		with the same fields, the scores are part of the key since reranking can
+		change the nscore."""
+		key = (fields, self.score, self.nscore)
+		if self._json is None or self._json[0] != key:
+			self._json = (key, serialize.dumps(self.as_json(fields=fields)))
+		return self._json[1]
+
+	def term_arrays(self, vocabulary):
+		"""Return the generation of the vocabulary and arrays with the identifiers,
+		frequencies and tfidf scores of the terms, where the identifiers are taken
+		from the vocabulary. The arrays are kept until the generation changes. The
+		arrays are built from the stored terms, without restoring their types first."""
+		if self._term_arrays is None or self._term_arrays[0] != vocabulary.generation:
+			stored = self._terms if self._terms is not None else self._source.get('terms', [])
+			terms, freqs, tfidfs = zip(*stored) if stored else ((), (), ())
+			term_ids = vocabulary.intern(terms)
+			self._term_arrays = (
+				vocabulary.generation, term_ids,
+				np.array(freqs, dtype=np.float64), np.array(tfidfs, dtype=np.float64))
+		return self._term_arrays
+
 	def display_fields(self):
 		"""Return a list of basic fields to be displayed in the Flask application.
 		Each field is a pair of a field name and field value."""
@@ -78,14 +171,16 @@ class DocumentSet:
 	# TODO: use this in SearchResult
 
 	def __init__(self, documents):
-		self.documents = documents
-		self.terms = {}
-		for doc in self.documents:
-			for term in doc.terms:
-				if not term[0] in self.terms:
-					self.terms[term[0]] = [0,0]
-					self.terms[term[0]][0] += term[1]
-					self.terms[term[0]][1] += term[2]
+		self.documents = []
+		self.add(documents)
+
+	def add(self, documents):
+		"""Add documents to the set. The terms of the documents are interned right
+		away so that documents can be added while others are still coming in and
+		only the sums are left for sorted_terms()."""
+		self.documents.extend(documents)
+		for doc in documents:
+			doc.term_arrays(VOCABULARY)
 
 	def __len__(self):
 		return len(self.documents)
@@ -93,6 +188,13 @@ class DocumentSet:
 	def __str__(self):
 		return f'<DocumentSet with {len(self)} documents>'
 
-	def sorted_terms(self):
-		terms = [(term, freq, tfidf) for term, (freq, tfidf) in self.terms.items()]
-		return list(sorted(terms, key=itemgetter(2), reverse=True))
+	def as_json(self, fields=None, terms: int = None):
+		return {
+			"documents": [doc.as_json(single_doc=False, fields=fields) for doc in self.documents],
+			"terms": self.sorted_terms(terms) }
+
+	def sorted_terms(self, k: int = None):
+		"""Return the terms of all documents, with frequencies and tfidf scores
+		added up over the documents, sorted on the tfidf score. Only the top k
+		terms are returned if k is given."""
+		return top_terms(self.documents, k)
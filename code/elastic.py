@@ -3,8 +3,9 @@ import sys, warnings, argparse, pprint
 from elasticsearch import Elasticsearch, ElasticsearchWarning
 from elastic_transport import ObjectApiResponse
 
+import clients
 import config
-from document import Document
+from document import Document, SOURCE_FIELDS
 
 
 # Suppressing the security warning, this is here in case you run this with an
@@ -19,79 +20,195 @@ from document import Document
 #        'port': config.ELASTIC_PORT,
 #        'scheme': 'http'}])
 
-ES = Elasticsearch(
-        [f'http://{config.ELASTIC_HOST}:{config.ELASTIC_PORT}'],
-        http_auth=(config.ELASTIC_USER, config.ELASTIC_PASSWORD))
+INDEX = config.ELASTIC_INDEX
 
 
-INDEX = config.ELASTIC_INDEX
+def client(api: str = None) -> Elasticsearch:
+    """Return the shared ElasticSearch client, with the timeout for the API if
+    one is given, see clients.py."""
+    return clients.client(api)
 
+def __getattr__(name: str):
+    # the client used to be created at import time as elastic.ES, this keeps that
+    # name working while still creating the client lazily
+    if name == 'ES':
+        return client()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 def indices(index='*'):
-    return list(ES.indices.get(index=index).keys())
+    return list(client().indices.get(index=index).keys())
 
 def settings(index='*'):
-    return ES.indices.get_settings(index=index)
-
-def get_document(doc_id: str):
-    query = {'match': {'_id': doc_id}}
-    result = ES.search(index=INDEX, size=config.MAX_RESULTS, query=query)
+    return client().indices.get_settings(index=index)
+
+def get_document(doc_id: str, fields: list = SOURCE_FIELDS):
+    """Get a document by its identifier, using a realtime GET that is routed to
+    the shard with the document instead of searching all shards. Only the source
+    fields given are retrieved."""
+    result = client('get').options(ignore_status=404).get(
+        index=INDEX, id=doc_id, realtime=True, **source_filter(fields))
     return SearchResult(result)
 
 def get_raw_document(doc_id: str):
-    query = {'match': {'_id': doc_id}}
-    return ES.search(index=INDEX, size=config.MAX_RESULTS, query=query)
+    result = client('get').options(ignore_status=404).get(index=INDEX, id=doc_id, realtime=True)
+    return hits_envelope(result)
 
 def get_documents(doc_ids: list):
-    result = ES.mget(
+    result = client('mget').mget(
         index=INDEX,
-        body={'ids': doc_ids},
-        source_excludes=['abstract', 'text'])
+        ids=doc_ids,
+        source_includes=list(SOURCE_FIELDS))
     return SearchResult(result)
 
 def search(tags: list, term: str, type: str=None, page: int=1):
+    query = search_query(tags, term, type)
+    # offset for documents returned
+    skip = config.MAX_RESULTS * (page - 1)
+    result = client('search').search(
+        index=INDEX, size=config.MAX_RESULTS, query=query, from_=skip,
+        track_total_hits=config.TRACK_TOTAL_HITS)
+    return SearchResult(result)
+
+def scan(query: dict, source_fields: list = SOURCE_FIELDS, batch_size: int = 1000,
+         index: str = INDEX):
+    """Generate all hits for the query in batches of Documents, in order of score.
+    This walks the hits with a point in time and search_after, so only one batch
+    is in memory at a time and the index is seen as it was when we started."""
+    pit = client('open_point_in_time').open_point_in_time(
+        index=index, keep_alive=config.PIT_KEEP_ALIVE)['id']
+    after = None
+    try:
+        while True:
+            result = client('search').search(
+                size=batch_size, query=query, track_total_hits=False,
+                pit={'id': pit, 'keep_alive': config.PIT_KEEP_ALIVE},
+                sort=['_score', '_shard_doc'], search_after=after,
+                **source_filter(source_fields))
+            result = SearchResult(result)
+            if not result.docs:
+                break
+            pit = result.pit_id or pit
+            after = result.last_sort
+            yield result.docs
+    finally:
+        client('close_point_in_time').close_point_in_time(id=pit)
+
+def source_filter(fields: list) -> dict:
+    """Return the keyword arguments that restrict the source to the fields."""
+    return {'source_includes': list(fields)} if fields else {'source': False}
+
+def hits_envelope(get_response: ObjectApiResponse) -> dict:
+    """Wrap the response of ES.get() in the hits structure of a search response,
+    this is what the /api/rawdoc endpoint used to return when it did a search on
+    the identifier."""
+    hits = [dict(get_response)] if get_response.get('found') else []
+    return {
+        "timed_out": False,
+        "hits": {
+            "total": {"value": len(hits), "relation": "eq"},
+            "max_score": None,
+            "hits": hits }}
+
+def search_query(tags: list, term: str, type: str=None, expansions: list = None):
+    """Build the query used by search(), this is shared with the asynchronous
+    variant in elastic_async.py. Documents that match one of the expansion terms
+    instead of the term itself are also found, but they score lower."""
     # TODO: 'term' could be multiple tokens and the search is now a disjunction
     # Using "must" instead of "should". With the latter, documents with scores
     # of zero were making it into the response.
-    query = {
+    match_type = "phrase" if type == "exact" else "best_fields"
+    must = {
+        "multi_match": {
+            "query": term,
+            "fields": config.SEARCH_FIELDS,
+            "type": match_type}}
+    if expansions:
+        must = {
+            "bool": {
+                "should": [must] + [
+                    {"multi_match": {
+                        "query": expansion,
+                        "fields": config.SEARCH_FIELDS,
+                        "type": match_type,
+                        "boost": config.EXPANSION_BOOST}}
+                    for expansion in expansions]}}
+    return {
         "bool": {
-            "must": {
-                "multi_match": {
-                    "query": term,
-                    "fields": config.SEARCH_FIELDS,
-                    "type": "phrase" if type == "exact" else "best_fields"}},
+            "must": must,
             "filter": {
                 "terms": {"tags": tags} } if tags else None}}
-    # offset for documents returned
-    skip = config.MAX_RESULTS * (page - 1)
-    result = ES.search(index=INDEX, size=config.MAX_RESULTS, query=query, from_=skip)
-    return SearchResult(result)
 
 
+def related_query(doc_id: str, index: str = INDEX):
+    """Build the more_like_this query for documents related to the document. The
+    document is given by reference, so ElasticSearch selects the terms from the
+    stored document and we do not have to retrieve it first."""
+    return {
+        "more_like_this": {
+            "fields": list(config.RELATED_FIELDS),
+            "like": [{"_index": index, "_id": doc_id}],
+            "max_query_terms": config.RELATED_MAX_TERMS,
+            "min_term_freq": 1 }}
+
 class SearchResult:
 
     """Convenience wrapper around the response from ElasticSearch."""
 
     def __init__(self, elastic_response: ObjectApiResponse):
-        """The response is different depending on whether we called ES.mget() or
-        ES.search(). While in both cases the response is an ObjectApiResponse, in
-        the former case it just has a 'docs' property while in the latter there are
-        'took', 'timed_out', '_shards' and 'hits' properties."""
+        """The response is different depending on whether we called ES.mget(),
+        ES.get() or ES.search(). While in all cases the response is an
+        ObjectApiResponse, with ES.mget() it just has a 'docs' property, with
+        ES.get() the response is the document itself with a 'found' property,
+        and with ES.search() there are 'took', 'timed_out', '_shards' and 'hits'
+        properties."""
         self.response = elastic_response
         self.error = False
-        if 'docs' in self.response:
+        # only set for searches that use a point in time, these are needed to
+        # get the next page with search_after
+        self.pit_id = None
+        self.last_sort = None
+        self.errors = []
+        if 'found' in self.response:
+            found = self.response['found']
+            self.docs = self.docs_from_hits([self.response]) if found else []
+            self.total_hits = len(self)
+        elif 'docs' in self.response:
             docs = self.response['docs']
-            if docs and (len(docs) == 1) and 'error' in docs[0]:
+            # errors are given for each identifier, some documents may still
+            # have been found
+            self.errors = self.mget_errors(docs)
+            self.docs = self.docs_from_hits(docs)
+            self.total_hits = len(self)
+            if self.is_mget_error(docs):
                 self.error = True
                 self.error_details = ElasticErrorDetails(elastic_response)
-                self.docs = []
-                self.total_hits = 0
-            else:
-                self.docs = self.docs_from_hits(docs)
-                self.total_hits = len(self)
         else:
-            self.docs = self.docs_from_hits(self.response['hits']['hits'])
-            self.total_hits = self.response['hits']['total']['value']
+            hits = self.response['hits']['hits']
+            self.docs = self.docs_from_hits(hits)
+            # there is no total when the search was done with track_total_hits
+            # switched off
+            total = self.response['hits'].get('total')
+            self.total_hits = total['value'] if total else len(self)
+            self.pit_id = self.response.get('pit_id')
+            self.last_sort = hits[-1].get('sort') if hits else None
+        # only a search can time out, in which case the hits are incomplete
+        self.timed_out = bool(self.response.get('timed_out', False))
+
+    @classmethod
+    def from_documents(cls, docs: list, elastic_response=None, errors: list = None):
+        """Create a SearchResult from a list of Documents, for example when the
+        documents were taken from a cache. The response is optional, as are the
+        errors for identifiers that could not be retrieved."""
+        result = cls.__new__(cls)
+        result.response = elastic_response
+        result.error = False
+        result.errors = [] if errors is None else errors
+        result.docs = docs
+        result.total_hits = len(docs)
+        result.timed_out = False
+        result.pit_id = None
+        result.last_sort = None
+        return result
 
     def __str__(self):
         return f'<SearchResult hits={self.total_hits} succes={not self.error}>'
@@ -110,12 +227,37 @@ class SearchResult:
 
     @staticmethod
     def docs_from_hits(hits: list):
-        return [Document(hit) for hit in hits]
+        # ES.mget() adds hits with found=False for identifiers that do not exist
+        # and hits with an error for identifiers that could not be retrieved
+        return [Document(hit) for hit in hits
+                if hit.get('found', True) and 'error' not in hit]
+
+    @staticmethod
+    def mget_errors(docs: list):
+        """Return the errors from an ES.mget() response, one for each identifier
+        that could not be retrieved, including identifiers that do not exist."""
+        errors = []
+        for doc in docs:
+            if 'error' in doc:
+                errors.append({'id': doc.get('_id'),
+                               'type': doc['error'].get('type'),
+                               'reason': doc['error'].get('reason')})
+            elif not doc.get('found', True):
+                errors.append({'id': doc.get('_id'),
+                               'type': 'not_found',
+                               'reason': 'document does not exist'})
+        return errors
+
+    @staticmethod
+    def is_mget_error(docs: list):
+        """The request failed as a whole if there is an error for all identifiers,
+        for example when the index does not exist."""
+        return bool(docs) and all('error' in doc for doc in docs)
 
 
 class ElasticErrorDetails:
 
-    """Class to deal with the errors you get when using ES.mget(), where no
+    """Class to deal with the errors you get when using client().mget(), where no
     exception will be raised but the error is hidden in the first element of
     the docs list that is returned in the JSON response."""
 
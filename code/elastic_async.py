@@ -0,0 +1,282 @@
+"""Asynchronous access to ElasticSearch
+
+Mirrors the functions in elastic.py but uses AsyncElasticsearch so that the
+FastAPI handlers can await ElasticSearch without tying up a thread for every
+request. The functions return the same SearchResult objects as elastic.py.
+
+"""
+
+import time
+import asyncio
+import logging
+
+import elasticsearch
+from elasticsearch import AsyncElasticsearch
+
+import clients
+import config
+import metrics
+from cache import DocumentCache
+from document import Document, SOURCE_FIELDS
+from elastic import SearchResult, ElasticErrorDetails
+from elastic import search_query, related_query, source_filter, hits_envelope
+from exceptions import AskmeException
+
+
+INDEX = config.ELASTIC_INDEX
+
+logger = logging.getLogger(__name__)
+
+DOCUMENTS = DocumentCache(config.DOCUMENT_CACHE_SIZE, config.DOCUMENT_CACHE_PATH)
+
+# cached index generation, the time it was last checked (None if never) and the
+# task that is checking it
+_generation = None
+_generation_checked = None
+_generation_task = None
+
+
+def client(api: str = None) -> AsyncElasticsearch:
+    """Return the shared asynchronous ElasticSearch client, with the timeout for
+    the API if one is given, see clients.py."""
+    return clients.async_client(api)
+
+def __getattr__(name: str):
+    # keeps elastic_async.ES working while creating the client lazily
+    if name == 'ES':
+        return client()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+async def close():
+    await clients.close()
+
+async def ping() -> bool:
+    return await client().ping()
+
+async def get_document(doc_id: str, fields: list = None):
+    """Get a document by its identifier. This first checks the document cache and
+    then uses a realtime GET, which is routed to the shard with the document.
+    If fields are given then only the source fields needed for those Document
+    attributes are retrieved, those partial documents are not cached."""
+    DOCUMENTS.set_generation(await index_generation())
+    doc = await DOCUMENTS.get(doc_id)
+    if doc is not None:
+        return SearchResult.from_documents([doc])
+    source_fields = SOURCE_FIELDS if fields is None else Document.source_fields(fields)
+    result = await metrics.elastic(client('get').options(ignore_status=404).get(
+        index=INDEX, id=doc_id, realtime=True, **source_filter(source_fields)))
+    with metrics.stage('parse'):
+        if fields is not None:
+            return SearchResult(result)
+        docs = DOCUMENTS.put_many([result])
+        return SearchResult.from_documents(docs, result)
+
+async def get_raw_document(doc_id: str):
+    result = await metrics.elastic(client('get').options(ignore_status=404).get(
+        index=INDEX, id=doc_id, realtime=True))
+    return hits_envelope(result)
+
+async def get_documents(doc_ids: list, source_fields: list = None):
+    """Get documents from the cache and use client().mget() for those that are not
+    cached. Documents are returned in the order of the identifiers. If source
+    fields are given then only those are requested for the documents that are
+    not cached, and those partial documents are not added to the cache. Errors
+    for identifiers that could not be retrieved are in the errors attribute of
+    the result."""
+    docs = []
+    errors = []
+    async for chunk_docs, chunk_errors in iter_documents(doc_ids, source_fields):
+        docs.extend(chunk_docs)
+        errors.extend(chunk_errors)
+    return SearchResult.from_documents(docs, errors=errors)
+
+async def iter_documents(doc_ids: list, source_fields: list = None):
+    """Like get_documents(), but an async generator of pairs of a list of documents
+    and a list of errors, for consecutive slices of the identifiers. Documents
+    that are not cached are retrieved with concurrent client().mget() requests of
+    at most MGET_CHUNK_SIZE identifiers, and a slice is generated as soon as the
+    requests it depends on are done, so the first documents can be sent while
+    the rest are still being retrieved. Raises an AskmeException if an mget
+    request failed as a whole, for example because the index does not exist."""
+    DOCUMENTS.set_generation(await index_generation())
+    cached = await DOCUMENTS.get_many(doc_ids)
+    missing = list(dict.fromkeys(i for i in doc_ids if i not in cached))
+    size = config.MGET_CHUNK_SIZE
+    semaphore = asyncio.Semaphore(config.MGET_CONCURRENCY)
+
+    async def mget(ids: list):
+        async with semaphore:
+            return await metrics.elastic(client('mget').mget(
+                index=INDEX, ids=ids,
+                **source_filter(SOURCE_FIELDS if source_fields is None else source_fields)))
+
+    tasks = [asyncio.ensure_future(mget(missing[i:i+size]))
+             for i in range(0, len(missing), size)]
+    task_for_id = {doc_id: n // size for n, doc_id in enumerate(missing)}
+    fetched = {}
+    errors = {}
+    done = set()
+    try:
+        for i in range(0, len(doc_ids), size):
+            ids = doc_ids[i:i+size]
+            for n in sorted(set(task_for_id[doc_id] for doc_id in ids if doc_id in task_for_id)):
+                if n in done:
+                    continue
+                response = await tasks[n]
+                hits = response['docs']
+                done.add(n)
+                if SearchResult.is_mget_error(hits):
+                    details = ElasticErrorDetails(response)
+                    raise AskmeException(details.reason(), details=details.details)
+                with metrics.stage('parse'):
+                    for error in SearchResult.mget_errors(hits):
+                        errors[error['id']] = error
+                    if source_fields is None:
+                        docs = DOCUMENTS.put_many([hit for hit in hits if 'error' not in hit])
+                    else:
+                        docs = SearchResult.docs_from_hits(hits)
+                    fetched.update((doc.identifier, doc) for doc in docs)
+            yield ([cached.get(doc_id) or fetched[doc_id] for doc_id in ids
+                    if doc_id in cached or doc_id in fetched],
+                   [errors[doc_id] for doc_id in ids if doc_id in errors])
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def search(tags: list, term: str, type: str=None, page: int=1,
+                 source_fields: list = SOURCE_FIELDS, timeout: float = None,
+                 pit: str = None, after: list = None, expansions: list = None):
+    """Search the index. The optional timeout in seconds is passed to ElasticSearch,
+    which returns the hits it found so far when time runs out. With a point in time
+    the hits are sorted on score with the shard document as tie breaker, and with
+    the sort values of the last hit of the previous page as the search_after value
+    the page is found without collecting and sorting all hits before it. The
+    expansions are terms that are added to the query, see search_query()."""
+    query = search_query(tags, term, type, expansions)
+    # offset for documents returned
+    skip = config.MAX_RESULTS * (page - 1)
+    if timeout is not None:
+        timeout = f'{max(1, int(timeout * 1000))}ms'
+    if pit is None:
+        result = await metrics.elastic(client('search').search(
+            index=INDEX, size=config.MAX_RESULTS, query=query, from_=skip,
+            timeout=timeout, track_total_hits=config.TRACK_TOTAL_HITS,
+            **source_filter(source_fields)))
+    else:
+        # an index cannot be given when searching a point in time
+        result = await metrics.elastic(client('search').search(
+            size=config.MAX_RESULTS, query=query,
+            from_=skip if after is None else None,
+            pit={'id': pit, 'keep_alive': config.PIT_KEEP_ALIVE},
+            sort=['_score', '_shard_doc'], search_after=after,
+            timeout=timeout, track_total_hits=config.TRACK_TOTAL_HITS,
+            **source_filter(source_fields)))
+    with metrics.stage('parse'):
+        return SearchResult(result)
+
+async def related(doc_id: str, source_fields: list = SOURCE_FIELDS):
+    """Search for documents related to the document, see elastic.related_query()."""
+    result = await metrics.elastic(client('search').search(
+        index=INDEX, size=config.MAX_RESULTS, query=related_query(doc_id, INDEX),
+        track_total_hits=False, **source_filter(source_fields)))
+    with metrics.stage('parse'):
+        return SearchResult(result)
+
+async def msearch(searches: list, source_fields: list = SOURCE_FIELDS, timeout: float = None):
+    """Run several searches with one request to the _msearch API. The searches are
+    tuples of tags, term, type and page, as for search(). Returns a list with for
+    each search a SearchResult or, if the search failed, a dictionary with the
+    status, type and reason of the error."""
+    body = []
+    for tags, term, type, page in searches:
+        search = {
+            'query': search_query(tags, term, type),
+            'size': config.MAX_RESULTS,
+            'from': config.MAX_RESULTS * (page - 1),
+            'track_total_hits': config.TRACK_TOTAL_HITS,
+            '_source': {'includes': list(source_fields)} if source_fields else False }
+        if timeout is not None:
+            search['timeout'] = f'{max(1, int(timeout * 1000))}ms'
+        body.extend([{}, search])
+    response = await metrics.elastic(client('msearch').msearch(index=INDEX, searches=body))
+    results = []
+    for item in response['responses']:
+        if 'error' in item:
+            error = item['error']
+            results.append({
+                'status': item.get('status'),
+                'type': error.get('type') if isinstance(error, dict) else None,
+                'reason': error.get('reason') if isinstance(error, dict) else error })
+        else:
+            with metrics.stage('parse'):
+                results.append(SearchResult(item))
+    return results
+
+async def open_point_in_time() -> str:
+    result = await metrics.elastic(client('open_point_in_time').open_point_in_time(
+        index=INDEX, keep_alive=config.PIT_KEEP_ALIVE))
+    return result['id']
+
+async def close_point_in_time(pit: str):
+    """Close a point in time, one that already expired is not an error."""
+    await client('close_point_in_time').options(ignore_status=404).close_point_in_time(id=pit)
+
+async def scan(query: dict, source_fields: list = SOURCE_FIELDS, batch_size: int = 1000):
+    """Asynchronous version of elastic.scan(), an async generator of batches of
+    Documents. The next batch is only requested when the consumer asks for it,
+    and the point in time is closed when the consumer stops early."""
+    pit = await open_point_in_time()
+    after = None
+    try:
+        while True:
+            result = await metrics.elastic(client('search').search(
+                size=batch_size, query=query, track_total_hits=False,
+                pit={'id': pit, 'keep_alive': config.PIT_KEEP_ALIVE},
+                sort=['_score', '_shard_doc'], search_after=after,
+                **source_filter(source_fields)))
+            with metrics.stage('parse'):
+                result = SearchResult(result)
+            if not result.docs:
+                break
+            pit = result.pit_id or pit
+            after = result.last_sort
+            yield result.docs
+    finally:
+        await close_point_in_time(pit)
+
+async def index_generation():
+    """Return a value that changes whenever the index changes. This combines the
+    uuids of the indices (which change when an index is recreated, possibly behind
+    an alias) with the numbers of index and delete operations on their primary
+    shards, which go up with every write, including documents that are indexed
+    again with _bulk. The value is checked at most once every few seconds, and
+    requests that come in while it is being checked wait for that one check. If
+    the check fails the last known value is kept, which is None if no check ever
+    succeeded."""
+    global _generation_task
+    if (_generation_checked is not None
+            and time.monotonic() - _generation_checked <= config.INDEX_GENERATION_INTERVAL):
+        return _generation
+    if _generation_task is None:
+        _generation_task = asyncio.ensure_future(check_generation())
+    return await asyncio.shield(_generation_task)
+
+async def check_generation():
+    global _generation, _generation_checked, _generation_task
+    try:
+        stats = await metrics.elastic(
+            client().indices.stats(index=INDEX, metric='indexing'))
+        generations = []
+        for index_stats in stats['indices'].values():
+            indexing = index_stats['primaries']['indexing']
+            generations.append(
+                f"{index_stats['uuid']}:{indexing['index_total']}:{indexing['delete_total']}")
+        _generation = '+'.join(sorted(generations))
+    except (elasticsearch.ApiError, elasticsearch.TransportError, AskmeException) as e:
+        # the index stats need the monitor privilege, without it the caches are
+        # not emptied when the index changes but requests are still answered
+        logger.warning(f'Checking the index generation failed: {e}')
+    finally:
+        _generation_checked = time.monotonic()
+        _generation_task = None
+    return _generation
@@ -0,0 +1,294 @@
+"""Precomputed query expansions
+
+For each tag, and for all documents together, the build step computes two
+tables from the terms of the documents in the index:
+
+synonyms   variants of a term, terms that are the same after lower-casing,
+           splitting on hyphens and other non-word characters and removing a
+           plural s, for example "heart attack", "heart attacks" and "heart-attack"
+related    the terms that most often occur in the same documents as the term,
+           scored with the cosine similarity of their document vectors
+
+The related terms are computed like the related documents in neighbours.py, with
+sparse matrix products on blocks of terms spread over several processes. The
+result is written to a directory with NumPy files, which the API opens as
+memory-mapped arrays:
+
+keys.npy       sorted keys, each a tag and a lower-cased term separated by a unit
+               separator, the tag for all documents is ALL
+related.npy    for each key the row numbers of the related terms in keys.npy,
+               padded with -1
+scores.npy     the similarity scores of the related terms
+synonyms.npy   for each key the row numbers of its synonyms, padded with -1
+
+Lookups are binary searches in the sorted keys, and since the keys of a tag are
+consecutive, terms can also be found by prefix. To build the expansions (this
+needs scipy):
+
+$ python expansions.py /data/askme-expansions
+$ python expansions.py /data/askme-expansions --related 20 --min-df 5 --max-terms 50000
+
+And set EXPANSIONS_PATH in config.py to the directory.
+
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import multiprocessing
+from array import array
+
+import numpy as np
+
+import config
+import neighbours
+
+
+# the tag used for the tables computed over all documents
+ALL = '_all'
+
+SEPARATOR = '\x1f'
+
+# longer terms are left out so that the fixed-width keys stay small
+MAX_TERM_BYTES = 64
+
+TOKEN = re.compile(r'\w+')
+
+
+def variant_key(term: str) -> str:
+    """Return the key that all spelling variants of a term have in common."""
+    return ' '.join(token[:-1] if len(token) > 3 and token.endswith('s') else token
+                    for token in TOKEN.findall(term.lower()))
+
+
+def encode_key(tag: str, term: str) -> bytes:
+    return f'{tag}{SEPARATOR}{term.lower()}'.encode('utf8')
+
+
+class ExpansionIndex:
+
+    """Gives access to the precomputed expansions in a directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.related_rows = np.load(os.path.join(path, 'related.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(path, 'scores.npy'), mmap_mode='r')
+        self.synonym_rows = np.load(os.path.join(path, 'synonyms.npy'), mmap_mode='r')
+
+    def __str__(self):
+        return f'<ExpansionIndex keys={len(self)} path={self.path}>'
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row(self, term: str, tag: str = None):
+        key = encode_key(tag or ALL, term)
+        if len(key) > self.keys.dtype.itemsize:
+            return None
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def term(self, row: int) -> str:
+        return self.keys[row].decode('utf8').split(SEPARATOR, 1)[1]
+
+    def synonyms(self, term: str, tag: str = None) -> list:
+        i = self.row(term, tag)
+        if i is None:
+            return []
+        return [self.term(j) for j in self.synonym_rows[i].tolist() if j >= 0]
+
+    def related(self, term: str, tag: str = None, k: int = None) -> list:
+        """Return pairs of a related term and its score, at most k if k is given."""
+        i = self.row(term, tag)
+        if i is None:
+            return []
+        pairs = [(self.term(j), score)
+                 for j, score in zip(self.related_rows[i].tolist(), self.scores[i].tolist())
+                 if j >= 0]
+        return pairs if k is None else pairs[:k]
+
+    def complete(self, prefix: str, tag: str = None, limit: int = 10) -> list:
+        """Return at most limit terms of the tag that start with the prefix, in
+        alphabetical order."""
+        key = encode_key(tag or ALL, prefix)
+        start = int(np.searchsorted(self.keys, key))
+        end = min(start + limit, len(self.keys))
+        terms = []
+        for i in range(start, end):
+            if not self.keys[i].startswith(key):
+                break
+            terms.append(self.term(i))
+        return terms
+
+    def expand(self, query: str, tags: list = None, k: int = config.EXPANSION_TERMS) -> list:
+        """Return the terms to add to the query: the synonyms of the query and of
+        its words, and the k terms most related to the query or, if the query is
+        not a known term, to its words. The first tag that knows the term is used,
+        and the tables for all documents if none of them do."""
+        query = ' '.join(query.lower().split())
+        words = TOKEN.findall(query)
+        domains = list(tags or []) + [ALL]
+        expansions = {}
+
+        def add(term: str, related: int):
+            for tag in domains:
+                if self.row(term, tag) is not None:
+                    for synonym in self.synonyms(term, tag):
+                        expansions.setdefault(synonym, True)
+                    for related_term, _ in self.related(term, tag, related):
+                        expansions.setdefault(related_term, True)
+                    return True
+            return False
+
+        if not add(query, k):
+            for word in words:
+                add(word, 1 if len(words) > 1 else k)
+        expansions.pop(query, None)
+        for word in words:
+            expansions.pop(word, None)
+        return list(expansions)
+
+
+def load(path: str):
+    """Return the ExpansionIndex for the path, or None if there is no path or if
+    the expansions were not built."""
+    if path is None or not os.path.exists(os.path.join(path, 'keys.npy')):
+        return None
+    return ExpansionIndex(path)
+
+
+def read_terms(index: str, batch_size: int):
+    """Read the terms and tags of all documents and return the vocabulary, a list
+    with the tags of each document and a sparse matrix where rows are documents,
+    columns are terms and a 1 means that the term occurs in the document."""
+    import elastic
+    from scipy import sparse
+    vocabulary = {}
+    doc_tags = []
+    rows = array('i')
+    columns = array('i')
+    t0 = time.time()
+    for docs in elastic.scan({'match_all': {}}, ['terms', 'tags'], batch_size, index):
+        for doc in docs:
+            row = len(doc_tags)
+            doc_tags.append(doc.tags or [])
+            for term, _, _ in doc.terms:
+                term = term.lower()
+                if len(encode_key(ALL, term)) > MAX_TERM_BYTES:
+                    continue
+                rows.append(row)
+                columns.append(vocabulary.setdefault(term, len(vocabulary)))
+        print(f'{len(doc_tags):>9} documents  {time.time() - t0:8.1f} seconds')
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32),
+         (np.frombuffer(rows, np.int32), np.frombuffer(columns, np.int32))),
+        shape=(len(doc_tags), len(vocabulary)))
+    # duplicate terms in a document were added up by csr_matrix
+    matrix.data[:] = 1
+    return list(vocabulary), doc_tags, matrix
+
+
+def domain_tables(matrix, terms: list, k: int, min_df: int, max_terms: int,
+                  processes: int, block_size: int):
+    """Return the terms of a domain and arrays with the related terms, their
+    scores and the synonyms, where the rows and the values refer to positions
+    in the list of terms. The matrix has the documents of the domain."""
+    from scipy import sparse
+    doc_freqs = np.asarray(matrix.sum(axis=0)).ravel()
+    selected = np.flatnonzero(doc_freqs >= min_df)
+    if len(selected) > max_terms:
+        selected = selected[np.argsort(-doc_freqs[selected], kind='stable')[:max_terms]]
+    selected.sort()
+    domain_terms = [terms[i] for i in selected]
+    # rows are terms, normalized so that products are cosine similarities
+    term_matrix = matrix[:, selected].T.tocsr()
+    norms = np.sqrt(doc_freqs[selected])
+    norms[norms == 0] = 1
+    term_matrix = (sparse.diags(1 / norms).astype(np.float32) @ term_matrix).tocsr()
+    related = np.full((len(selected), k), -1, dtype=np.int32)
+    scores = np.zeros((len(selected), k), dtype=np.float32)
+    blocks = [(start, min(start + block_size, len(selected)), k)
+              for start in range(0, len(selected), block_size)]
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes, initializer=neighbours.init_worker,
+                      initargs=(term_matrix, term_matrix.T.tocsr())) as pool:
+        for start, block_rows, block_scores in pool.imap_unordered(
+                neighbours.block_neighbours, blocks):
+            related[start:start + len(block_rows)] = block_rows
+            scores[start:start + len(block_rows)] = block_scores
+    groups = {}
+    for i, term in enumerate(domain_terms):
+        groups.setdefault(variant_key(term), []).append(i)
+    synonyms = np.full((len(selected), config.EXPANSION_SYNONYMS), -1, dtype=np.int32)
+    for members in groups.values():
+        if len(members) > 1:
+            for i in members:
+                others = [j for j in members if j != i][:config.EXPANSION_SYNONYMS]
+                synonyms[i, :len(others)] = others
+    return domain_terms, related, scores, synonyms
+
+
+def build(path: str, index: str, k: int, min_df: int, max_terms: int,
+          processes: int, block_size: int, batch_size: int):
+    terms, doc_tags, matrix = read_terms(index, batch_size)
+    tags = sorted(set(tag for tags in doc_tags for tag in tags))
+    keys = []
+    tables = []
+    t0 = time.time()
+    for tag in tags + [ALL]:
+        if tag == ALL:
+            domain_matrix = matrix
+        else:
+            rows = [row for row, row_tags in enumerate(doc_tags) if tag in row_tags]
+            domain_matrix = matrix[rows]
+        domain_terms, related, scores, synonyms = domain_tables(
+            domain_matrix, terms, k, min_df, max_terms, processes, block_size)
+        # positions in the domain are turned into positions in the list of keys
+        offset = len(keys)
+        keys.extend(encode_key(tag, term) for term in domain_terms)
+        related[related >= 0] += offset
+        synonyms[synonyms >= 0] += offset
+        tables.append((related, scores, synonyms))
+        print(f'{tag:>20} {len(domain_terms):>9} terms  {time.time() - t0:8.1f} seconds')
+    related = np.concatenate([table[0] for table in tables])
+    scores = np.concatenate([table[1] for table in tables])
+    synonyms = np.concatenate([table[2] for table in tables])
+    width = max((len(key) for key in keys), default=1)
+    keys = np.array(keys, dtype=f'S{width}')
+    order = np.argsort(keys, kind='stable')
+    # new position of each key, used to renumber the references to other keys
+    position = np.empty(len(order), dtype=np.int32)
+    position[order] = np.arange(len(order), dtype=np.int32)
+    related = np.where(related >= 0, position[related], -1)[order]
+    synonyms = np.where(synonyms >= 0, position[synonyms], -1)[order]
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'keys.npy'), keys[order])
+    np.save(os.path.join(path, 'related.npy'), related.astype(np.int32))
+    np.save(os.path.join(path, 'scores.npy'), scores[order])
+    np.save(os.path.join(path, 'synonyms.npy'), synonyms.astype(np.int32))
+    with open(os.path.join(path, 'info.json'), 'w') as fh:
+        json.dump({'index': index, 'tags': tags, 'keys': len(keys), 'related': k,
+                   'min_df': min_df, 'max_terms': max_terms,
+                   'created': time.strftime('%Y-%m-%d %H:%M:%S')}, fh, indent=2)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="directory to write the expansions to")
+    parser.add_argument("--index", default=config.ELASTIC_INDEX, help="the index to use")
+    parser.add_argument("--related", default=20, type=int, help="number of related terms")
+    parser.add_argument("--min-df", default=5, type=int, help="minimum number of documents for a term")
+    parser.add_argument("--max-terms", default=50000, type=int, help="maximum number of terms per tag")
+    parser.add_argument("--processes", default=os.cpu_count(), type=int, help="number of processes")
+    parser.add_argument("--block", default=500, type=int, help="number of terms per block")
+    parser.add_argument("--batch", default=1000, type=int, help="number of documents read at a time")
+    args = parser.parse_args()
+
+    build(args.path, args.index, args.related, args.min_df, args.max_terms,
+          args.processes, args.block, args.batch)
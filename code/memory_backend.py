@@ -0,0 +1,756 @@
+"""In-memory search backend
+
+A small search engine that stands in for ElasticSearch, so that the API can be
+run, benchmarked and profiled without an ElasticSearch server. It loads the same
+bulk files that are loaded into ElasticSearch with _bulk and keeps an inverted
+index with BM25 scoring in memory.
+
+The backend interface is the part of the ElasticSearch client that AskMe uses,
+with the same arguments and with responses that have the same structure. It is
+written down as the SearchBackend protocol in clients.py:
+
+search()                 query, size, from_, sort, search_after, pit, scroll,
+                         source filtering, track_total_hits and aggregations
+msearch()                several searches in one request
+mget(), get()            documents by identifier
+count()                  number of documents matching a query
+open_point_in_time()     points in time for search_after
+close_point_in_time()
+scroll(), clear_scroll() scrolling through all hits of a search
+indices.get()            index names and index settings
+indices.get_settings()
+indices.stats()          counts of index and delete operations
+ping(), options(), close()
+
+MemoryClient implements this on top of MemoryIndex objects, one for each index,
+and AsyncMemoryClient wraps a MemoryClient for elastic_async.py. Supported
+queries are match_all, match, match_phrase, multi_match (with the best_fields,
+most_fields and phrase types and with field and query boosts), bool (must, should, filter
+and must_not), term, terms, ids and more_like_this. The only aggregation is the
+terms aggregation. Sorting is on _score, _doc and _shard_doc.
+
+Text is analyzed by lower-casing and splitting on non-word characters, which
+is close to what the ElasticSearch standard analyzer does. The postings of a
+field are built the first time the field is searched. The postings of all terms
+are stored in flat NumPy arrays, with the documents, term frequencies and token
+positions of a term in consecutive slices of those arrays.
+
+To use it set these in config.py:
+
+SEARCH_BACKEND = 'memory'
+MEMORY_BACKEND_FILES = ['/data/elastic-biomedical-001.json', '/data/elastic-mars.json']
+
+"""
+
+import re
+import copy
+import json
+import time
+import uuid
+import itertools
+import threading
+
+import numpy as np
+
+import config
+from exceptions import AskmeException
+
+
+# BM25 parameters, these are the ElasticSearch defaults
+K1 = 1.2
+B = 0.75
+
+TOKEN = re.compile(r'\w+')
+
+# the default maximum of hits that are counted, as in ElasticSearch
+TRACK_TOTAL_HITS = 10000
+
+_CLIENT = None
+_LOCK = threading.Lock()
+
+
+class BackendError(AskmeException):
+
+    """Raised for requests that the memory backend cannot handle, the status and
+    type follow what ElasticSearch would report. This is an AskmeException so that
+    the API responds with the status and the details, like it does for errors
+    from ElasticSearch."""
+
+    def __init__(self, reason: str, status: int = 400, type: str = 'illegal_argument_exception'):
+        super().__init__(reason, status=status, details={'type': type, 'reason': reason})
+        self.reason = reason
+        self.type = type
+
+    def as_json(self):
+        return {'error': {'type': self.type, 'reason': self.reason}, 'status': self.status}
+
+
+def analyze(value) -> list:
+    """Return the lower-cased tokens of a text or of a list of texts."""
+    if isinstance(value, str):
+        return TOKEN.findall(value.lower())
+    if isinstance(value, (list, tuple)):
+        return [token for item in value for token in analyze(item)]
+    if value is None:
+        return []
+    return analyze(str(value))
+
+
+def as_list(value) -> list:
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+class FieldIndex:
+
+    """Postings for one text field. The postings of term t are at positions
+    offsets[t] to offsets[t+1] of doc_ids and freqs, and the token positions
+    for posting p are at position_offsets[p] to position_offsets[p+1] of
+    positions. Documents are in ascending order within the postings of a term."""
+
+    def __init__(self, name: str, sources: list):
+        self.name = name
+        postings = {}
+        lengths = np.zeros(len(sources), dtype=np.int32)
+        for doc, source in enumerate(sources):
+            if source is None:
+                continue
+            tokens = analyze(source.get(name))
+            lengths[doc] = len(tokens)
+            doc_positions = {}
+            for position, token in enumerate(tokens):
+                doc_positions.setdefault(token, []).append(position)
+            for token, token_positions in doc_positions.items():
+                term_postings = postings.get(token)
+                if term_postings is None:
+                    term_postings = postings[token] = ([], [])
+                term_postings[0].append(doc)
+                term_postings[1].append(token_positions)
+        self.terms = {term: n for n, term in enumerate(postings)}
+        doc_freqs = np.fromiter((len(docs) for docs, _ in postings.values()), np.int64, len(postings))
+        self.offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(doc_freqs, out=self.offsets[1:])
+        self.doc_ids = np.fromiter(
+            itertools.chain.from_iterable(docs for docs, _ in postings.values()),
+            np.int32, self.offsets[-1])
+        all_positions = [p for _, term_positions in postings.values() for p in term_positions]
+        self.freqs = np.fromiter(map(len, all_positions), np.int32, len(all_positions))
+        self.position_offsets = np.zeros(len(all_positions) + 1, dtype=np.int64)
+        np.cumsum(self.freqs, out=self.position_offsets[1:])
+        self.positions = np.fromiter(
+            itertools.chain.from_iterable(all_positions), np.int32, self.position_offsets[-1])
+        self.lengths = lengths
+        self.n_docs = int(np.count_nonzero(lengths))
+        self.average_length = float(lengths.sum()) / max(self.n_docs, 1)
+
+    def __str__(self):
+        return f'<FieldIndex {self.name} terms={len(self.terms)} postings={len(self.doc_ids)}>'
+
+    def span(self, term: str):
+        n = self.terms.get(term)
+        if n is None:
+            return 0, 0
+        return int(self.offsets[n]), int(self.offsets[n+1])
+
+    def doc_freq(self, term: str) -> int:
+        start, end = self.span(term)
+        return end - start
+
+    def idf(self, doc_freq) -> float:
+        return np.log(1 + (self.n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def bm25(self, idf: float, freqs: np.ndarray, docs: np.ndarray) -> np.ndarray:
+        norm = K1 * (1 - B + B * self.lengths[docs] / self.average_length)
+        return (idf * freqs * (K1 + 1) / (freqs + norm)).astype(np.float32)
+
+    def match(self, tokens: list, scores: np.ndarray, boost: float = 1.0):
+        """Add the BM25 scores of documents that have any of the tokens."""
+        for token in tokens:
+            start, end = self.span(token)
+            if start == end:
+                continue
+            docs = self.doc_ids[start:end]
+            scores[docs] += boost * self.bm25(self.idf(end - start), self.freqs[start:end], docs)
+
+    def phrase(self, tokens: list, scores: np.ndarray, boost: float = 1.0):
+        """Add scores for documents that have the tokens as a phrase, the score uses
+        the phrase frequency and the summed idf of the tokens."""
+        if not tokens:
+            return
+        spans = [self.span(token) for token in tokens]
+        if any(start == end for start, end in spans):
+            return
+        candidates = self.doc_ids[spans[0][0]:spans[0][1]]
+        for start, end in spans[1:]:
+            candidates = np.intersect1d(candidates, self.doc_ids[start:end], assume_unique=True)
+        if not len(candidates):
+            return
+        # for each token, the postings of the candidates
+        postings = [start + np.searchsorted(self.doc_ids[start:end], candidates)
+                    for start, end in spans]
+        phrase_freqs = np.zeros(len(candidates), dtype=np.int32)
+        for n in range(len(candidates)):
+            starts = self.token_positions(postings[0][n])
+            for i, token_postings in enumerate(postings[1:], start=1):
+                starts = np.intersect1d(starts, self.token_positions(token_postings[n]) - i)
+                if not len(starts):
+                    break
+            phrase_freqs[n] = len(starts)
+        found = phrase_freqs > 0
+        docs = candidates[found]
+        idf = sum(self.idf(end - start) for start, end in spans)
+        scores[docs] += boost * self.bm25(idf, phrase_freqs[found], docs)
+
+    def token_positions(self, posting: int) -> np.ndarray:
+        return self.positions[self.position_offsets[posting]:self.position_offsets[posting+1]]
+
+
+class MemoryIndex:
+
+    """All documents of one index with their sources, and the postings of the
+    fields that were searched so far."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.uuid = uuid.uuid4().hex
+        self.ids = []
+        self.sources = []
+        self.numbers = {}
+        self.fields = {}
+        self.keywords = {}
+        # counts of index and delete operations, as in the indexing stats
+        self.index_total = 0
+        self.delete_total = 0
+
+    def __str__(self):
+        return f'<MemoryIndex {self.name} documents={len(self)}>'
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def add(self, doc_id: str, source: dict):
+        number = self.numbers.get(doc_id)
+        if number is None:
+            self.numbers[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+            self.sources.append(source)
+        else:
+            self.sources[number] = source
+        self.index_total += 1
+        self.changed()
+
+    def delete(self, doc_id: str):
+        number = self.numbers.pop(doc_id, None)
+        if number is not None:
+            # the slot stays so that document numbers do not change
+            self.sources[number] = None
+            self.delete_total += 1
+            self.changed()
+
+    def changed(self):
+        self.fields = {}
+        self.keywords = {}
+
+    def exists(self) -> np.ndarray:
+        return np.fromiter((source is not None for source in self.sources), bool, len(self.sources))
+
+    def field(self, name: str) -> FieldIndex:
+        """Return the postings for the field, building them if needed."""
+        field_index = self.fields.get(name)
+        if field_index is None:
+            field_index = self.fields[name] = FieldIndex(name, self.sources)
+        return field_index
+
+    def keyword(self, name: str) -> dict:
+        """Return a dictionary from the values of a field to arrays with the numbers
+        of the documents with that value, used for term filters and aggregations."""
+        values = self.keywords.get(name)
+        if values is None:
+            lists = {}
+            for doc, source in enumerate(self.sources):
+                if source is None:
+                    continue
+                for value in as_list(source.get(name)):
+                    if isinstance(value, (str, int, float, bool)):
+                        lists.setdefault(value, []).append(doc)
+            values = self.keywords[name] = {
+                value: np.array(docs, dtype=np.int32) for value, docs in lists.items()}
+        return values
+
+    def evaluate(self, query: dict):
+        """Return a boolean array with the documents that match the query and an
+        array with their scores."""
+        if not query:
+            query = {'match_all': {}}
+        if len(query) != 1:
+            raise BackendError(f'Query should have one key: {list(query)}')
+        (kind, body), = query.items()
+        n_docs = len(self.sources)
+        if kind == 'match_all':
+            return self.exists(), np.ones(n_docs, dtype=np.float32)
+        if kind == 'bool':
+            return self.evaluate_bool(body)
+        if kind in ('term', 'terms'):
+            (name, values), = ((k, v) for k, v in body.items() if k != 'boost')
+            matched = np.zeros(n_docs, dtype=bool)
+            keyword = self.keyword(name)
+            for value in as_list(values):
+                docs = keyword.get(value)
+                if docs is not None:
+                    matched[docs] = True
+            return matched, matched.astype(np.float32)
+        if kind == 'ids':
+            matched = np.zeros(n_docs, dtype=bool)
+            numbers = [self.numbers[i] for i in as_list(body.get('values')) if i in self.numbers]
+            matched[numbers] = True
+            return matched, matched.astype(np.float32)
+        scores = np.zeros(n_docs, dtype=np.float32)
+        if kind in ('match', 'match_phrase'):
+            (name, match), = body.items()
+            text = match.get('query') if isinstance(match, dict) else match
+            field_index = self.field(name)
+            if kind == 'match':
+                field_index.match(analyze(text), scores)
+            else:
+                field_index.phrase(analyze(text), scores)
+            return scores > 0, scores
+        if kind == 'multi_match':
+            return self.evaluate_multi_match(body, scores)
+        if kind == 'more_like_this':
+            return self.evaluate_more_like_this(body, scores)
+        raise BackendError(f'Unsupported query: {kind}')
+
+    def evaluate_bool(self, body: dict):
+        n_docs = len(self.sources)
+        matched = self.exists()
+        scores = np.zeros(n_docs, dtype=np.float32)
+        must = as_list(body.get('must'))
+        filters = as_list(body.get('filter'))
+        for query in must:
+            query_matched, query_scores = self.evaluate(query)
+            matched &= query_matched
+            scores += query_scores
+        for query in filters:
+            matched &= self.evaluate(query)[0]
+        for query in as_list(body.get('must_not')):
+            matched &= ~self.evaluate(query)[0]
+        should = as_list(body.get('should'))
+        if should:
+            any_should = np.zeros(n_docs, dtype=bool)
+            for query in should:
+                query_matched, query_scores = self.evaluate(query)
+                any_should |= query_matched
+                scores += np.where(query_matched, query_scores, 0)
+            # with must or filter clauses the should clauses are optional
+            if not must and not filters:
+                matched &= any_should
+        return matched, np.where(matched, scores, 0).astype(np.float32)
+
+    def evaluate_multi_match(self, body: dict, scores: np.ndarray):
+        tokens = analyze(body.get('query'))
+        match_type = body.get('type', 'best_fields')
+        tie_breaker = body.get('tie_breaker', 0.0)
+        field_scores = []
+        for field in as_list(body.get('fields')):
+            name, _, boost = field.partition('^')
+            field_index = self.field(name)
+            these_scores = np.zeros_like(scores)
+            if match_type == 'phrase':
+                field_index.phrase(tokens, these_scores, float(boost or 1))
+            elif match_type in ('best_fields', 'most_fields'):
+                field_index.match(tokens, these_scores, float(boost or 1))
+            else:
+                raise BackendError(f'Unsupported multi_match type: {match_type}')
+            field_scores.append(these_scores)
+        if field_scores:
+            stacked = np.vstack(field_scores)
+            if match_type == 'most_fields':
+                scores = stacked.sum(axis=0)
+            else:
+                best = stacked.max(axis=0)
+                scores = best + tie_breaker * (stacked.sum(axis=0) - best)
+            scores *= body.get('boost', 1.0)
+        return scores > 0, scores.astype(np.float32)
+
+    def evaluate_more_like_this(self, body: dict, scores: np.ndarray):
+        """Select the terms of the liked documents and texts with the highest tf-idf
+        and search for those terms. The liked documents are not included."""
+        names = as_list(body.get('fields'))
+        max_query_terms = body.get('max_query_terms', 25)
+        min_term_freq = body.get('min_term_freq', 2)
+        min_doc_freq = body.get('min_doc_freq', 5)
+        liked = []
+        texts = []
+        for like in as_list(body.get('like')):
+            if isinstance(like, str):
+                texts.append(like)
+            elif like.get('_id') in self.numbers:
+                liked.append(self.numbers[like['_id']])
+        candidates = []
+        for name in names:
+            field_index = self.field(name)
+            term_freqs = {}
+            tokens = analyze(texts) + [
+                token for doc in liked for token in analyze(self.sources[doc].get(name))]
+            for token in tokens:
+                term_freqs[token] = term_freqs.get(token, 0) + 1
+            for term, term_freq in term_freqs.items():
+                doc_freq = field_index.doc_freq(term)
+                if term_freq >= min_term_freq and doc_freq >= min_doc_freq:
+                    candidates.append((term_freq * field_index.idf(doc_freq), name, term))
+        candidates.sort(reverse=True)
+        for _, name, term in candidates[:max_query_terms]:
+            self.field(name).match([term], scores)
+        matched = scores > 0
+        if not body.get('include', False):
+            matched[liked] = False
+        return matched, np.where(matched, scores, 0).astype(np.float32)
+
+    def aggregate(self, aggregations: dict, matched: np.ndarray) -> dict:
+        results = {}
+        for name, aggregation in (aggregations or {}).items():
+            if list(aggregation) != ['terms']:
+                raise BackendError(f'Unsupported aggregation: {list(aggregation)}')
+            terms = aggregation['terms']
+            counts = [(int(np.count_nonzero(matched[docs])), value)
+                      for value, docs in self.keyword(terms['field']).items()]
+            counts = [(count, value) for count, value in counts if count > 0]
+            counts.sort(key=lambda pair: (-pair[0], str(pair[1])))
+            size = terms.get('size', 10)
+            results[name] = {
+                'doc_count_error_upper_bound': 0,
+                'sum_other_doc_count': sum(count for count, _ in counts[size:]),
+                'buckets': [{'key': value, 'doc_count': count} for count, value in counts[:size]]}
+        return results
+
+    def hit(self, doc: int, score=None, source_fields=True, sort=None) -> dict:
+        hit = {'_index': self.name, '_id': self.ids[doc], '_score': score}
+        if source_fields is not False:
+            hit['_source'] = project(self.sources[doc], source_fields)
+        if sort is not None:
+            hit['sort'] = sort
+        return hit
+
+
+def project(source: dict, source_fields) -> dict:
+    """Return a copy of the source with only the fields, all fields if source_fields
+    is True. Like the JSON from ElasticSearch the copy is not shared, so callers can
+    change it (Document.restore_types() does) without changing the index."""
+    if source_fields is True or source_fields is None:
+        return copy.deepcopy(source)
+    return {field: copy.deepcopy(source[field]) for field in source_fields if field in source}
+
+
+def source_fields_from(source=None, source_includes=None, body_source=None):
+    """Work out the source filter from the keyword arguments of a request, returns
+    False for no source, True for the whole source or a list of fields."""
+    for value in (source_includes, source, body_source):
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str):
+            return [value]
+        if isinstance(value, dict):
+            return value.get('includes', True)
+        return list(value)
+    return True
+
+
+def sort_keys(sort, scores: np.ndarray, docs: np.ndarray):
+    """Return for each sort criterion a pair of the name and an array that sorts in
+    ascending order, for the documents."""
+    keys = []
+    for criterion in as_list(sort) or ['_score', '_doc']:
+        name = criterion if isinstance(criterion, str) else next(iter(criterion))
+        if name == '_score':
+            keys.append((name, -scores[docs].astype(np.float64)))
+        elif name in ('_doc', '_shard_doc'):
+            keys.append((name, docs.astype(np.float64)))
+        else:
+            raise BackendError(f'Unsupported sort: {criterion}')
+    return keys
+
+
+class MemoryClient:
+
+    """Implements the backend interface on top of MemoryIndex objects."""
+
+    def __init__(self, default_index: str = config.ELASTIC_INDEX):
+        self.default_index = default_index
+        self.indexes = {}
+        self.pits = {}
+        self.scrolls = {}
+        self.indices = MemoryIndices(self)
+
+    def __str__(self):
+        return f'<MemoryClient indexes={list(self.indexes)}>'
+
+    def load_bulk(self, path: str):
+        """Load a file in the format of the ElasticSearch bulk API. Index and create
+        actions add documents and delete actions remove them."""
+        with open(path) as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                (action, meta), = json.loads(line).items()
+                index = self.index(meta.get('_index', self.default_index), create=True)
+                if action in ('index', 'create'):
+                    index.add(meta['_id'], json.loads(next(fh)))
+                elif action == 'delete':
+                    index.delete(meta['_id'])
+                else:
+                    raise BackendError(f'Unsupported bulk action: {action}')
+
+    def index(self, name: str, create: bool = False) -> MemoryIndex:
+        if name is None:
+            name = self.default_index
+        if name not in self.indexes:
+            if not create:
+                raise BackendError(
+                    f'no such index [{name}]', status=404, type='index_not_found_exception')
+            self.indexes[name] = MemoryIndex(name)
+        return self.indexes[name]
+
+    def options(self, **kwargs):
+        return self
+
+    def ping(self, **kwargs) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+    def info(self, **kwargs):
+        return {'name': 'memory', 'version': {'number': 'memory'}}
+
+    def count(self, index: str = None, query: dict = None, **kwargs) -> dict:
+        matched, _ = self.index(index).evaluate(query)
+        return {'count': int(np.count_nonzero(matched))}
+
+    def get(self, index: str, id: str, source=None, source_includes=None, **kwargs) -> dict:
+        memory_index = self.index(index)
+        number = memory_index.numbers.get(id)
+        if number is None:
+            return {'_index': memory_index.name, '_id': id, 'found': False}
+        hit = memory_index.hit(number, source_fields=source_fields_from(source, source_includes))
+        del hit['_score']
+        hit.update({'_version': 1, 'found': True})
+        return hit
+
+    def mget(self, index: str = None, body: dict = None, ids: list = None,
+             source=None, source_includes=None, **kwargs) -> dict:
+        ids = ids if ids is not None else body.get('ids', [])
+        return {'docs': [self.get(index, doc_id, source, source_includes) for doc_id in ids]}
+
+    def open_point_in_time(self, index: str, keep_alive: str = None, **kwargs) -> dict:
+        # documents are not changed while the API runs, so a point in time only
+        # needs to remember the index
+        pit_id = uuid.uuid4().hex
+        self.pits[pit_id] = self.index(index).name
+        return {'id': pit_id}
+
+    def close_point_in_time(self, id: str = None, body: dict = None, **kwargs) -> dict:
+        pit_id = id if id is not None else (body or {}).get('id')
+        found = self.pits.pop(pit_id, None) is not None
+        return {'succeeded': found, 'num_freed': int(found)}
+
+    def search(self, index: str = None, query: dict = None, size: int = 10, from_: int = None,
+               sort=None, search_after: list = None, pit: dict = None, scroll: str = None,
+               source=None, source_includes=None, track_total_hits=None,
+               aggs: dict = None, aggregations: dict = None, body: dict = None,
+               **kwargs) -> dict:
+        t0 = time.perf_counter()
+        body = body or {}
+        query = query if query is not None else body.get('query')
+        size = body.get('size', size)
+        from_ = body.get('from', from_) or 0
+        if pit is not None:
+            if pit['id'] not in self.pits:
+                raise BackendError(
+                    f"No search context found for id [{pit['id']}]",
+                    status=404, type='search_context_missing_exception')
+            index = self.pits[pit['id']]
+        memory_index = self.index(index)
+        matched, scores = memory_index.evaluate(query)
+        docs = np.flatnonzero(matched)
+        keys = sort_keys(sort, scores, docs)
+        if search_after is not None:
+            # keep the documents that sort after the search_after values
+            after = np.zeros(len(docs), dtype=bool)
+            equal = np.ones(len(docs), dtype=bool)
+            for (name, key), value in zip(keys, search_after):
+                value = -value if name == '_score' else value
+                after |= equal & (key > value)
+                equal &= key == value
+            docs = docs[after]
+            keys = [(name, key[after]) for name, key in keys]
+        total = len(docs)
+        wanted = len(docs) if scroll is not None else from_ + size
+        if len(docs) > 2 * wanted:
+            # only sort the documents that can make it to the requested page,
+            # ties with the last one are kept so that the order is exact
+            primary = keys[0][1]
+            threshold = np.partition(primary, wanted - 1)[wanted - 1] if wanted else -np.inf
+            selected = primary <= threshold
+            docs = docs[selected]
+            keys = [(name, key[selected]) for name, key in keys]
+        order = np.lexsort([key for _, key in reversed(keys)])
+        docs = docs[order]
+        source_fields = source_fields_from(source, source_includes, body.get('_source'))
+        with_sort = sort is not None
+        page = docs[from_:from_ + size]
+        response = {
+            'took': int((time.perf_counter() - t0) * 1000),
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {
+                'max_score': float(scores[docs].max()) if len(docs) else None,
+                'hits': [self.page_hit(memory_index, doc, scores, sort, source_fields, with_sort)
+                         for doc in page.tolist()]}}
+        track_total_hits = body.get('track_total_hits', track_total_hits)
+        if track_total_hits is None:
+            track_total_hits = TRACK_TOTAL_HITS
+        if track_total_hits is True:
+            response['hits']['total'] = {'value': total, 'relation': 'eq'}
+        elif track_total_hits is not False:
+            response['hits']['total'] = {
+                'value': min(total, track_total_hits),
+                'relation': 'gte' if total > track_total_hits else 'eq'}
+        aggregations = aggregations or aggs or body.get('aggs') or body.get('aggregations')
+        if aggregations:
+            response['aggregations'] = memory_index.aggregate(aggregations, matched)
+        if pit is not None:
+            response['pit_id'] = pit['id']
+        if scroll is not None:
+            scroll_id = uuid.uuid4().hex
+            self.scrolls[scroll_id] = (
+                memory_index, docs[from_ + size:], scores, sort, source_fields, size)
+            response['_scroll_id'] = scroll_id
+        return response
+
+    def page_hit(self, memory_index, doc: int, scores, sort, source_fields, with_sort: bool):
+        score = float(scores[doc])
+        sort_values = None
+        if with_sort:
+            sort_values = [score if name == '_score' else doc
+                           for name, _ in sort_keys(sort, scores, np.array([doc]))]
+        return memory_index.hit(doc, score, source_fields, sort_values)
+
+    def scroll(self, scroll_id: str = None, scroll: str = None, body: dict = None, **kwargs):
+        scroll_id = scroll_id if scroll_id is not None else (body or {}).get('scroll_id')
+        if scroll_id not in self.scrolls:
+            raise BackendError(
+                f'No search context found for id [{scroll_id}]',
+                status=404, type='search_context_missing_exception')
+        memory_index, docs, scores, sort, source_fields, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (memory_index, docs[size:], scores, sort, source_fields, size)
+        return {
+            '_scroll_id': scroll_id, 'took': 0, 'timed_out': False,
+            'hits': {'hits': [self.page_hit(memory_index, doc, scores, sort, source_fields, sort is not None)
+                              for doc in docs[:size].tolist()]}}
+
+    def clear_scroll(self, scroll_id=None, body: dict = None, **kwargs):
+        ids = as_list(scroll_id if scroll_id is not None else (body or {}).get('scroll_id'))
+        freed = sum(self.scrolls.pop(i, None) is not None for i in ids)
+        return {'succeeded': True, 'num_freed': freed}
+
+    def msearch(self, searches: list, index: str = None, **kwargs) -> dict:
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                response = self.search(index=header.get('index', index), body=body)
+                response['status'] = 200
+            except BackendError as e:
+                response = e.as_json()
+            responses.append(response)
+        return {'took': sum(r.get('took', 0) for r in responses), 'responses': responses}
+
+
+class MemoryIndices:
+
+    """The indices namespace of the client."""
+
+    def __init__(self, client: MemoryClient):
+        self.client = client
+
+    def names(self, index: str) -> list:
+        if index in ('*', '_all', None):
+            return list(self.client.indexes)
+        return [self.client.index(name).name for name in index.split(',')]
+
+    def get(self, index: str = '*', **kwargs) -> dict:
+        return {name: {'aliases': {}, 'mappings': {}, 'settings': self.settings(name)}
+                for name in self.names(index)}
+
+    def get_settings(self, index: str = '*', name: str = None, **kwargs) -> dict:
+        return {index_name: {'settings': self.settings(index_name)}
+                for index_name in self.names(index)}
+
+    def stats(self, index: str = '*', metric: str = None, **kwargs) -> dict:
+        """Return the indexing stats of the indices, all operations count as
+        operations on primary shards."""
+        indices = {}
+        for name in self.names(index):
+            memory_index = self.client.index(name)
+            indexing = {'indexing': {
+                'index_total': memory_index.index_total,
+                'delete_total': memory_index.delete_total}}
+            indices[name] = {'uuid': memory_index.uuid, 'primaries': indexing, 'total': indexing}
+        return {'indices': indices}
+
+    def settings(self, name: str) -> dict:
+        memory_index = self.client.index(name)
+        return {'index': {
+            'uuid': memory_index.uuid, 'provided_name': name,
+            'number_of_shards': '1', 'number_of_replicas': '0'}}
+
+
+class AsyncMemoryClient:
+
+    """Wraps a MemoryClient for use where the AsyncElasticsearch client is expected.
+    The work is done right away on the event loop, like ElasticSearch would do
+    it on its own threads, so it shows up in profiles of the API."""
+
+    def __init__(self, client: MemoryClient):
+        self.client = client
+        self.indices = AsyncWrapper(client.indices)
+
+    def __getattr__(self, name: str):
+        return getattr(AsyncWrapper(self.client), name)
+
+    def options(self, **kwargs):
+        return self
+
+
+class AsyncWrapper:
+
+    def __init__(self, target):
+        self.target = target
+
+    def __getattr__(self, name: str):
+        method = getattr(self.target, name)
+
+        async def wrapper(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return wrapper
+
+
+def client() -> MemoryClient:
+    """Return the memory client, loading MEMORY_BACKEND_FILES the first time."""
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is None:
+            memory_client = MemoryClient(config.ELASTIC_INDEX)
+            for path in config.MEMORY_BACKEND_FILES:
+                memory_client.load_bulk(path)
+            # the default index exists even if no files were loaded
+            memory_client.index(config.ELASTIC_INDEX, create=True)
+            _CLIENT = memory_client
+    return _CLIENT
+
+
+def async_client() -> AsyncMemoryClient:
+    return AsyncMemoryClient(client())
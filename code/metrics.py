@@ -0,0 +1,202 @@
+"""Request timings and metrics
+
+Records for each request how long the stages of handling it took:
+
+es-client   round trips to ElasticSearch, as seen by the client
+es-server   time spent in ElasticSearch, from the took value of responses
+parse       turning hits into Documents
+rerank      reranking the documents
+serialize   serializing the response
+app         everything from receiving the request until the response starts
+
+The timings of a request are kept in a context variable, which is set by the
+Timings middleware. The middleware adds them to the response in a Server-Timing
+header and to histograms for each endpoint and stage, which are available in the
+Prometheus text format from /api/metrics. Code that handles requests only needs
+to wrap a stage in stage() or to await ElasticSearch through elastic(). Tasks
+started with asyncio copy the context variable, so tasks that a request does not
+wait for should be started with detached().
+
+For streamed responses the header only has what was done before the first part
+of the response was sent, the histograms have the timings of the whole response.
+
+With METRICS switched off the middleware is not installed, the context variable
+is never set, and stage() and elastic() do little more than look it up.
+
+"""
+
+import time
+import asyncio
+import contextvars
+from contextlib import nullcontext
+
+import config
+
+
+# the timings of the current request, a dictionary from stages to seconds
+_TIMINGS = contextvars.ContextVar('timings', default=None)
+
+_NULL_STAGE = nullcontext()
+
+
+class Stage:
+
+    """Context manager that adds the time spent inside it to a stage."""
+
+    __slots__ = ('timings', 'name', 't0')
+
+    def __init__(self, timings: dict, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings[self.name] = self.timings.get(self.name, 0) + time.perf_counter() - self.t0
+
+
+def stage(name: str):
+    timings = _TIMINGS.get()
+    if timings is None:
+        return _NULL_STAGE
+    return Stage(timings, name)
+
+
+def record(name: str, seconds: float):
+    timings = _TIMINGS.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + seconds
+
+
+async def elastic(awaitable):
+    """Await an ElasticSearch request and record the round trip and, if the
+    response has it, the time ElasticSearch says it took."""
+    timings = _TIMINGS.get()
+    if timings is None:
+        return await awaitable
+    t0 = time.perf_counter()
+    response = await awaitable
+    timings['es-client'] = timings.get('es-client', 0) + time.perf_counter() - t0
+    took = response.get('took') if hasattr(response, 'get') else None
+    if took is not None:
+        timings['es-server'] = timings.get('es-server', 0) + took / 1000
+    return response
+
+
+def detached(coroutine) -> asyncio.Task:
+    """Start a task for work that a request starts but does not wait for, like
+    refreshing a cache entry in the background. The task does not see the timings
+    of the request, so its stages are not added to a request that may be done."""
+    context = contextvars.copy_context()
+    context.run(_TIMINGS.set, None)
+    return context.run(asyncio.ensure_future, coroutine)
+
+
+def server_timing(timings: dict) -> bytes:
+    return ', '.join(f'{name};dur={seconds * 1000:.2f}'
+                     for name, seconds in timings.items()).encode('latin-1')
+
+
+class Histogram:
+
+    """Cumulative histogram in the way Prometheus defines them, where each bucket
+    counts the observations less than or equal to its upper bound."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def lines(self, name: str, labels: str) -> list:
+        lines = [f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+                 for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Metrics:
+
+    """Histograms of request durations and stage timings, by endpoint."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.requests = {}
+        self.stages = {}
+
+    def observe(self, endpoint: str, seconds: float, timings: dict):
+        histogram = self.requests.get(endpoint)
+        if histogram is None:
+            histogram = self.requests[endpoint] = Histogram(self.buckets)
+        histogram.observe(seconds)
+        for name, stage_seconds in timings.items():
+            histogram = self.stages.get((endpoint, name))
+            if histogram is None:
+                histogram = self.stages[(endpoint, name)] = Histogram(self.buckets)
+            histogram.observe(stage_seconds)
+
+    def prometheus(self) -> str:
+        lines = ['# HELP askme_request_duration_seconds Time spent handling a request.',
+                 '# TYPE askme_request_duration_seconds histogram']
+        for endpoint, histogram in sorted(self.requests.items()):
+            lines.extend(histogram.lines(
+                'askme_request_duration_seconds', f'endpoint="{endpoint}"'))
+        lines.extend(['# HELP askme_stage_duration_seconds Time spent in a stage of handling a request.',
+                      '# TYPE askme_stage_duration_seconds histogram'])
+        for (endpoint, name), histogram in sorted(self.stages.items()):
+            lines.extend(histogram.lines(
+                'askme_stage_duration_seconds', f'endpoint="{endpoint}",stage="{name}"'))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(config.METRICS_BUCKETS)
+
+
+class Timings:
+
+    """ASGI middleware that sets up the timings of a request, adds them to the
+    response headers and records them in METRICS. The endpoint is the path of the
+    route that handled the request."""
+
+    def __init__(self, app, metrics: Metrics = METRICS):
+        self.app = app
+        self.metrics = metrics
+        self.paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        timings = {}
+        token = _TIMINGS.set(timings)
+        t0 = time.perf_counter()
+
+        async def send_with_timings(message):
+            if message['type'] == 'http.response.start':
+                timings['app'] = time.perf_counter() - t0
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', server_timing(timings)))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _TIMINGS.reset(token)
+            self.metrics.observe(self.endpoint(scope), time.perf_counter() - t0, timings)
+
+    def endpoint(self, scope) -> str:
+        # the router adds the endpoint function to the scope
+        if self.paths is None:
+            self.paths = {route.endpoint: route.path for route in scope['app'].routes
+                          if hasattr(route, 'endpoint')}
+        return self.paths.get(scope.get('endpoint'), 'unknown')
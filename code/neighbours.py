@@ -0,0 +1,193 @@
+"""Precomputed related documents
+
+The index only changes with a data drop, so the related documents of all
+documents can be computed in advance. The build reads the terms with their tfidf
+scores for all documents in the index and turns them into sparse document
+vectors. The nearest neighbours of all documents are then computed with sparse
+matrix products on blocks of documents, spread over several processes. The
+result is written to a directory with three NumPy files, which the API opens as
+memory-mapped arrays:
+
+ids.npy          the sorted document identifiers
+neighbours.npy   for each document the row numbers of its neighbours in ids.npy,
+                 padded with -1 when a document has fewer neighbours
+scores.npy       the cosine similarities with the neighbours
+
+To build the neighbours (this needs scipy):
+
+$ python neighbours.py /data/askme-neighbours
+$ python neighbours.py /data/askme-neighbours --k 20 --processes 8 --block 500
+
+And set NEIGHBOURS_PATH in config.py to the directory. Documents that are not in
+the precomputed neighbours fall back to a more_like_this search.
+
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from array import array
+
+import numpy as np
+
+import config
+
+
+# The matrix with the document vectors and its transpose, set in the worker
+# processes by init_worker()
+_MATRIX = None
+_TRANSPOSED = None
+
+
+class NeighbourIndex:
+
+    """Gives access to the precomputed neighbours in a directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.neighbours = np.load(os.path.join(path, 'neighbours.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(path, 'scores.npy'), mmap_mode='r')
+
+    def __str__(self):
+        return f'<NeighbourIndex documents={len(self)} path={self.path}>'
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id: str):
+        return self.row(doc_id) is not None
+
+    def row(self, doc_id: str):
+        key = doc_id.encode('utf8')
+        i = int(np.searchsorted(self.ids, key))
+        if i < len(self.ids) and self.ids[i] == key:
+            return i
+        return None
+
+    def lookup(self, doc_id: str):
+        """Return a list of pairs of a document identifier and a similarity score
+        for the neighbours of the document, or None if the document is unknown."""
+        i = self.row(doc_id)
+        if i is None:
+            return None
+        return [(self.ids[j].decode('utf8'), score)
+                for j, score in zip(self.neighbours[i].tolist(), self.scores[i].tolist())
+                if j >= 0]
+
+
+def load(path: str):
+    """Return the NeighbourIndex for the path, or None if there is no path or if
+    the neighbours were not built."""
+    if path is None or not os.path.exists(os.path.join(path, 'ids.npy')):
+        return None
+    return NeighbourIndex(path)
+
+
+def read_vectors(index: str, batch_size: int):
+    """Read the terms of all documents and return the sorted identifiers and a
+    sparse matrix with the normalized tfidf vectors of the documents, where the
+    rows are in the order of the identifiers."""
+    import elastic
+    from scipy import sparse
+    ids = []
+    vocabulary = {}
+    rows = array('i')
+    columns = array('i')
+    values = array('f')
+    t0 = time.time()
+    for docs in elastic.scan({'match_all': {}}, ['terms'], batch_size, index):
+        for doc in docs:
+            row = len(ids)
+            ids.append(doc.identifier)
+            for term, _, tfidf in doc.terms:
+                rows.append(row)
+                columns.append(vocabulary.setdefault(term.lower(), len(vocabulary)))
+                values.append(tfidf)
+        print(f'{len(ids):>9} documents  {time.time() - t0:8.1f} seconds')
+    matrix = sparse.csr_matrix(
+        (np.frombuffer(values, np.float32),
+         (np.frombuffer(rows, np.int32), np.frombuffer(columns, np.int32))),
+        shape=(len(ids), len(vocabulary)))
+    # duplicate terms in a document were added up by csr_matrix
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.diags(1 / norms).astype(np.float32) @ matrix
+    order = np.argsort(np.array(ids, dtype=object))
+    ids = [ids[i] for i in order]
+    return ids, matrix[order].tocsr()
+
+
+def init_worker(matrix, transposed):
+    global _MATRIX, _TRANSPOSED
+    _MATRIX = matrix
+    _TRANSPOSED = transposed
+
+
+def block_neighbours(block: tuple):
+    """Return the start of the block and arrays with the neighbours and scores
+    for the rows of the block."""
+    start, end, k = block
+    similarities = (_MATRIX[start:end] @ _TRANSPOSED).tocsr()
+    neighbours = np.full((end - start, k), -1, dtype=np.int32)
+    scores = np.zeros((end - start, k), dtype=np.float32)
+    for i in range(end - start):
+        begin, finish = similarities.indptr[i], similarities.indptr[i+1]
+        columns = similarities.indices[begin:finish]
+        values = similarities.data[begin:finish]
+        # a document is not its own neighbour
+        keep = (columns != start + i) & (values > 0)
+        columns, values = columns[keep], values[keep]
+        if len(values) > k:
+            top = np.argpartition(-values, k - 1)[:k]
+            columns, values = columns[top], values[top]
+        order = np.argsort(-values, kind='stable')
+        neighbours[i, :len(order)] = columns[order]
+        scores[i, :len(order)] = values[order]
+    return start, neighbours, scores
+
+
+def build(path: str, index: str, k: int, processes: int, block_size: int, batch_size: int):
+    ids, matrix = read_vectors(index, batch_size)
+    os.makedirs(path, exist_ok=True)
+    width = max((len(doc_id.encode('utf8')) for doc_id in ids), default=1)
+    np.save(os.path.join(path, 'ids.npy'), np.array(ids, dtype=f'S{width}'))
+    neighbours = np.lib.format.open_memmap(
+        os.path.join(path, 'neighbours.npy'), mode='w+', dtype=np.int32, shape=(len(ids), k))
+    scores = np.lib.format.open_memmap(
+        os.path.join(path, 'scores.npy'), mode='w+', dtype=np.float32, shape=(len(ids), k))
+    blocks = [(start, min(start + block_size, len(ids)), k)
+              for start in range(0, len(ids), block_size)]
+    t0 = time.time()
+    # with fork the workers share the matrix with this process
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes, initializer=init_worker,
+                      initargs=(matrix, matrix.T.tocsr())) as pool:
+        for n, (start, block_rows, block_scores) in enumerate(
+                pool.imap_unordered(block_neighbours, blocks), start=1):
+            end = start + len(block_rows)
+            neighbours[start:end] = block_rows
+            scores[start:end] = block_scores
+            if n % 100 == 0 or n == len(blocks):
+                print(f'{n:>9} of {len(blocks)} blocks  {time.time() - t0:8.1f} seconds')
+    neighbours.flush()
+    scores.flush()
+    with open(os.path.join(path, 'info.json'), 'w') as fh:
+        json.dump({'index': index, 'documents': len(ids), 'k': k,
+                   'created': time.strftime('%Y-%m-%d %H:%M:%S')}, fh, indent=2)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="directory to write the neighbours to")
+    parser.add_argument("--index", default=config.ELASTIC_INDEX, help="the index to use")
+    parser.add_argument("--k", default=config.MAX_RESULTS, type=int, help="number of neighbours")
+    parser.add_argument("--processes", default=os.cpu_count(), type=int, help="number of processes")
+    parser.add_argument("--block", default=500, type=int, help="number of documents per block")
+    parser.add_argument("--batch", default=1000, type=int, help="number of documents read at a time")
+    args = parser.parse_args()
+
+    build(args.path, args.index, args.k, args.processes, args.block, args.batch)
@@ -0,0 +1,160 @@
+"""Persistent cache of parsed summaries
+
+The same documents come back for many queries, so instead of parsing their
+summaries with spaCy for every query we keep the parsed documents around. They
+are serialized with spaCy's DocBin and stored in an SQLite database that is
+shared by all processes on a host, with a small LRU cache of deserialized
+documents in each process. Entries are keyed on the document identifier and a
+hash of the summary, so a changed summary is never served from the cache. The
+database is bounded in size, the least recently used entries are removed.
+
+To fill the cache for a whole index, before the API is started:
+
+$ python nlpcache.py --populate
+$ python nlpcache.py --populate --index xdd --batch 1000
+
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import argparse
+
+import config
+from cache import LRUCache
+
+
+# what we need from the parsed documents, the lower-cased form of the token
+# comes with the orthographic form
+DOCBIN_ATTRS = ['ORTH', 'LEMMA', 'SPACY']
+
+
+def cache_key(doc_id: str, summary: str) -> str:
+    digest = hashlib.blake2b(summary.encode('utf8'), digest_size=8).hexdigest()
+    return f'{doc_id}:{digest}'
+
+
+class ParseCache:
+
+    """Two-tier cache of parsed spaCy documents, with an LRU cache of documents in
+    memory and an SQLite database with DocBin serializations on disk."""
+
+    def __init__(self, path: str, maxsize: int, memory_size: int = 1000):
+        self.path = path
+        self.maxsize = maxsize
+        self.memory = LRUCache(memory_size)
+        self.writes = 0
+        self._connection = None
+        self._pid = None
+
+    def __str__(self):
+        return f'<ParseCache memory={len(self.memory)} path={self.path}>'
+
+    def connection(self):
+        # one connection per process, SQLite connections should not be shared
+        # by forked processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=5, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS parses '
+                '(key TEXT PRIMARY KEY, accessed REAL, docbin BLOB)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS parses_accessed ON parses (accessed)')
+            self._pid = os.getpid()
+        return self._connection
+
+    def get_many(self, keys: list, vocab) -> dict:
+        """Return a dictionary from keys to the parsed documents that were found in
+        the cache. The vocab is used to deserialize documents."""
+        from spacy.tokens import DocBin
+        found = {}
+        missing = []
+        for key in keys:
+            doc = self.memory.get(key)
+            if doc is None:
+                missing.append(key)
+            else:
+                found[key] = doc
+        connection = self.connection()
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i+500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = connection.execute(
+                f'SELECT key, docbin FROM parses WHERE key IN ({placeholders})',
+                chunk).fetchall()
+            for key, data in rows:
+                doc = next(DocBin().from_bytes(data).get_docs(vocab))
+                self.memory.put(key, doc)
+                found[key] = doc
+            if rows:
+                with connection:
+                    connection.executemany(
+                        'UPDATE parses SET accessed = ? WHERE key = ?',
+                        [(time.time(), key) for key, _ in rows])
+        return found
+
+    def put_many(self, items: list):
+        """Store a list of pairs of a key and a parsed document."""
+        from spacy.tokens import DocBin
+        rows = []
+        now = time.time()
+        for key, doc in items:
+            self.memory.put(key, doc)
+            docbin = DocBin(attrs=DOCBIN_ATTRS, store_user_data=False, docs=[doc])
+            rows.append((key, now, docbin.to_bytes()))
+        if not rows:
+            return
+        connection = self.connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO parses VALUES (?, ?, ?)', rows)
+        self.writes += len(rows)
+        # checking the size is not free so we only do it every now and then
+        if self.writes >= max(100, self.maxsize // 100):
+            self.writes = 0
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries above the maximum size."""
+        connection = self.connection()
+        with connection:
+            (size,) = connection.execute('SELECT COUNT(*) FROM parses').fetchone()
+            if size > self.maxsize:
+                connection.execute(
+                    'DELETE FROM parses WHERE key IN '
+                    '(SELECT key FROM parses ORDER BY accessed LIMIT ?)',
+                    (size - self.maxsize,))
+
+    def __len__(self):
+        (size,) = self.connection().execute('SELECT COUNT(*) FROM parses').fetchone()
+        return size
+
+
+def populate(index: str, batch_size: int):
+    """Parse the summaries of all documents in the index and add them to the cache.
+    The summaries are truncated the same way as for the API."""
+    import elastic
+    import ranking
+    total = 0
+    t0 = time.time()
+    for docs in elastic.scan({'match_all': {}}, ['summary'], batch_size, index):
+        ranking.parse_summaries([(doc.identifier, doc.summary) for doc in docs])
+        total += len(docs)
+        print(f'{total:>9} documents  {time.time() - t0:8.1f} seconds')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--populate", action='store_true', help="parse all documents of the index")
+    parser.add_argument("--index", default=config.ELASTIC_INDEX, help="the index to use")
+    parser.add_argument("--batch", default=500, type=int, help="number of documents per batch")
+    args = parser.parse_args()
+
+    if config.NLP_CACHE_PATH is None:
+        print('Set NLP_CACHE_PATH in config.py to use the cache')
+    elif args.populate:
+        populate(args.index, args.batch)
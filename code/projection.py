@@ -0,0 +1,37 @@
+"""Source field projection
+
+Works out what fields to request from the ElasticSearch source. The output
+fields of an endpoint are by default taken from config.FIELDS_FOR_MULTIPLE_DOCS
+or another list of fields in the configuration file, but clients can ask for
+a subset with the fields parameter. Only the source fields needed to fill in
+those output fields are retrieved, plus the fields that other components need,
+for example the fields that the reranker uses.
+
+"""
+
+from document import Document
+from exceptions import AskmeException
+
+
+def parse_fields(fields: str, allowed: tuple) -> tuple:
+    """Turn the comma-separated value of the fields parameter into a tuple of
+    fields. Returns all allowed fields if no fields were given and raises an
+    AskmeException if an unknown field was requested."""
+    if not fields:
+        return allowed
+    requested = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise AskmeException(
+            f"Unknown field(s): {', '.join(unknown)}",
+            status=400,
+            details={"allowed_fields": list(allowed)})
+    return tuple(dict.fromkeys(requested))
+
+def source_includes(fields: tuple, *needed: tuple) -> list:
+    """Return the minimal list of source fields needed for the output fields and
+    for the fields needed by other components."""
+    source_fields = Document.source_fields(fields)
+    for more_fields in needed:
+        source_fields.extend(Document.source_fields(more_fields))
+    return list(dict.fromkeys(source_fields))
@@ -3,17 +3,18 @@ import sys, json, argparse
 
 from elasticsearch import Elasticsearch
 
+import clients
 import config
 #from document import Document
 
 
-ES = Elasticsearch(
-        [f'http://{config.ELASTIC_HOST}:{config.ELASTIC_PORT}'],
-        basic_auth=(config.ELASTIC_USER, config.ELASTIC_PASSWORD))
-
 INDEX = config.ELASTIC_INDEX
 
 
+def client(api: str = None) -> Elasticsearch:
+    return clients.client(api)
+
+
 def search(tags: str = None, term: str = None, query: str = None, page: int = 1):
     """New search function for elastic.py."""
     # TODO: 'term' could be multiple tokens and the search is now a disjunction
@@ -29,7 +30,7 @@ def search(tags: str = None, term: str = None, query: str = None, page: int = 1)
                 "filter": {"term": {"tags": tags} }}}
     # offset for documents returned
     skip = config.MAX_RESULTS * (page - 1)
-    result = ES.search(index=INDEX, size=config.MAX_RESULTS, query=query, from_=skip)
+    result = client('search').search(index=INDEX, size=config.MAX_RESULTS, query=query, from_=skip)
     return SearchResult(result)
 
 
@@ -98,7 +99,7 @@ if __name__ == '__main__':
     print(json.dumps(query.query, indent=2))
 
     if query.is_valid():
-        result = ES.search(index=INDEX, size=config.MAX_RESULTS, query=query.query, from_=start_hit)
+        result = client('search').search(index=INDEX, size=config.MAX_RESULTS, query=query.query, from_=start_hit)
         print(f'\nTotal hits: {result["hits"]["total"]["value"]}')
         for hit in result['hits']['hits']:
             score = f'{hit["_score"]:2.4f}'
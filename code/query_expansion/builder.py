@@ -7,6 +7,11 @@ Requirements:
 
 $ pip install elasticsearch
 
+The client and its settings are shared with the API, so this runs as a module
+from the parent directory:
+
+$ python -m query_expansion.builder
+
 """
 
 import re
@@ -14,33 +19,39 @@ import json
 import pprint
 import textwrap
 import elasticsearch
-from utils import dict_generator, highlight
-
 
-# Making this standalone for now so copied settings from the configuration file
+import clients
+import config
+import expansions
+from query_expansion.utils import dict_generator, highlight
 
-ELASTIC_HOST = 'localhost'
-ELASTIC_PORT = 9200
-ELASTIC_INDEX = 'xdd'
-ELASTIC_USER = 'askme'
-ELASTIC_PASSWORD = 'pw-askme'
 
+ELASTIC_INDEX = config.ELASTIC_INDEX
 
 MAX_HITS = 20
 
+# Number of hits a refinement session keeps, so that excluded documents can be
+# replaced without going back to ElasticSearch
+SESSION_WINDOW = 100
 
-ES = elasticsearch.Elasticsearch(
-        [f'http://{ELASTIC_HOST}:{ELASTIC_PORT}'],
-        basic_auth=(ELASTIC_USER, ELASTIC_PASSWORD))
+
+def client(api: str = None) -> elasticsearch.Elasticsearch:
+    return clients.client(api)
 
 
 
 class Result:
 
-    def __init__(self, query: dict):
+    def __init__(self, query: dict, hits: list = None):
+        """Run the query, unless the hits are given, which is what a refinement
+        session does."""
         self.query = query
-        self.result = ES.search(index=ELASTIC_INDEX, size=MAX_HITS, query=query)
-        self.hits = [Hit(hit) for hit in self.result['hits']['hits']]
+        if hits is None:
+            self.result = client('search').search(index=ELASTIC_INDEX, size=MAX_HITS, query=query)
+            hits = self.result['hits']['hits']
+        else:
+            self.result = None
+        self.hits = [Hit(hit) for hit in hits]
 
     def __str__(self):
         return f'<Result query_terms={len(self.qterms())} hits={len(self)}>'
@@ -100,6 +111,7 @@ class Hit:
 
     def __init__(self, hit: dict):
         self.hit = hit
+        self.identifier = self.hit['_id']
         self.score = self.hit['_score']
         self.title = self.hit['_source']['title']
         self.abstract = self.hit['_source']['abstract']
@@ -181,18 +193,31 @@ class QueryBuilder:
         for term in terms:
             qterm = QTerm(term)
             self.add(QuerySpecification('term_inclusion', qterm))
-        self.query.include_term_as_conjunction(qterm)
+            self.query.include_term_as_conjunction(qterm)
 
     def exclude_terms(self, *terms):
         for term in terms:
             qterm = QTerm(term)
             self.add(QuerySpecification('term_exclusion', QTerm(term)))
-        self.query.include_term_as_conjunction(Not(qterm))
+            self.query.include_term_as_conjunction(Not(qterm))
 
     def add_synonyms(self, term: str, synonyms: list):
         self.add(QuerySpecification('synonym', (term, synonyms)))
         self.query.add_synonyms(term, synonyms)
 
+    def expand(self, expansion_index: expansions.ExpansionIndex, tags: list = None,
+               k: int = config.EXPANSION_TERMS):
+        """Add the synonyms and related terms that were computed in advance with
+        expansions.py to the terms of the query."""
+        for element in list(self.query.data.must):
+            if isinstance(element, QTerm):
+                terms = expansion_index.expand(element.query, tags, k)
+                if terms:
+                    self.add_synonyms(element.query, terms)
+
+    def session(self, size: int = MAX_HITS, window: int = SESSION_WINDOW):
+        return RefinementSession(self, size, window)
+
     def pp(self):
         print()
         print(self)
@@ -205,6 +230,111 @@ class QueryBuilder:
         print()
 
 
+class RefinementSession:
+
+    """Evaluates the query of a QueryBuilder after each refinement, doing as little
+    work in ElasticSearch as possible. The session keeps the hits of the last
+    search, up to the window size, and only searches again when the terms of
+    the query changed. Document exclusions are applied to the kept hits, and more
+    hits are only requested when too few are left. Included documents are put
+    first, those that are not in the kept hits are retrieved with an ids filter.
+    All searches use the same point in time, so successive refinements see the
+    same version of the index. Close the session when done, or use it as a
+    context manager:
+
+    with qb.session() as session:
+        print(session.result())
+        qb.exclude_documents('d1', 'd2')
+        print(session.result())
+    """
+
+    def __init__(self, builder: QueryBuilder, size: int = MAX_HITS, window: int = SESSION_WINDOW):
+        self.builder = builder
+        self.size = size
+        self.window = max(window, size)
+        self.pit = None
+        # the query of the last search, its hits in the order of ElasticSearch,
+        # whether there are more hits, and the hits for included documents
+        self.query = None
+        self.hits = []
+        self.exhausted = False
+        self.included = {}
+        self.searches = 0
+
+    def __str__(self):
+        return f'<RefinementSession hits={len(self.hits)} searches={self.searches}>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pit is not None:
+            client('close_point_in_time').close_point_in_time(id=self.pit)
+            self.pit = None
+
+    def result(self) -> Result:
+        """Return the Result for the current state of the builder."""
+        query = self.builder.query.json()
+        if query != self.query:
+            self.query = query
+            self.hits = self.search(query, self.window)
+            self.exhausted = len(self.hits) < self.window
+            self.included = {}
+        excluded = set(self.builder.document_exclusions)
+        included = [doc_id for doc_id in dict.fromkeys(self.builder.document_inclusions)
+                    if doc_id not in excluded]
+        kept = [hit for hit in self.hits if hit['_id'] not in excluded]
+        while len(kept) < self.size + len(included) and not self.exhausted:
+            more = self.search(query, self.window, after=self.hits[-1]['sort'])
+            self.exhausted = len(more) < self.window
+            self.hits.extend(more)
+            kept.extend(hit for hit in more if hit['_id'] not in excluded)
+        pinned = self.included_hits(query, included)
+        pinned_ids = set(hit['_id'] for hit in pinned)
+        hits = pinned + [hit for hit in kept if hit['_id'] not in pinned_ids]
+        return Result(query, hits[:self.size])
+
+    def included_hits(self, query: dict, doc_ids: list) -> list:
+        """Return the hits for the included documents, those that are not in the
+        kept hits are scored against the query with one search on their ids."""
+        hits = {hit['_id']: hit for hit in self.hits if hit['_id'] in doc_ids}
+        missing = [doc_id for doc_id in doc_ids
+                   if doc_id not in hits and doc_id not in self.included]
+        if missing:
+            ids_query = {
+                "bool": {
+                    "filter": {"ids": {"values": missing}},
+                    "should": [query] }}
+            for hit in self.search(ids_query, len(missing)):
+                self.included[hit['_id']] = hit
+        hits.update(self.included)
+        return [hits[doc_id] for doc_id in doc_ids if doc_id in hits]
+
+    def search(self, query: dict, size: int, after: list = None) -> list:
+        """Search the point in time, opening a new one if there is none or if it
+        expired, and return the hits."""
+        for attempt in range(2):
+            if self.pit is None:
+                self.pit = client('open_point_in_time').open_point_in_time(
+                    index=ELASTIC_INDEX, keep_alive=config.PIT_KEEP_ALIVE)['id']
+            try:
+                response = client('search').search(
+                    size=size, query=query, track_total_hits=False,
+                    pit={'id': self.pit, 'keep_alive': config.PIT_KEEP_ALIVE},
+                    sort=['_score', '_shard_doc'], search_after=after)
+            except elasticsearch.NotFoundError:
+                self.pit = None
+                if attempt > 0 or after is not None:
+                    raise
+                continue
+            self.searches += 1
+            self.pit = response.get('pit_id', self.pit)
+            return response['hits']['hits']
+
+
 class Boolean:
 
     def __init__(self):
@@ -355,7 +485,40 @@ def example2():
     #result.pp_all()
 
 
+def example3():
+    qb = QueryBuilder("earthquake")
+    with qb.session() as session:
+        result = session.result()
+        print(f'\n{result}  {session}')
+        result.pp_titles()
+        # the excluded documents are replaced from the hits the session has
+        qb.exclude_documents(*[hit.identifier for hit in result[:3]])
+        result = session.result()
+        print(f'{result}  {session}')
+        result.pp_titles()
+        # a new term changes the query, so this searches again
+        qb.include_terms('fault')
+        result = session.result()
+        print(f'{result}  {session}')
+        result.pp_titles()
+
+
+def example4():
+    qb = QueryBuilder("earthquake")
+    expansion_index = expansions.load(config.EXPANSIONS_PATH)
+    if expansion_index is None:
+        print('No expansions, build them with expansions.py and set EXPANSIONS_PATH')
+        return
+    qb.expand(expansion_index, tags=['geoarchive'])
+    qb.pp()
+    result = Result(qb.query.json())
+    print(result)
+    result.pp_titles()
+
+
 if __name__ == '__main__':
 
     example1()
     #example2()
+    #example3()
+    #example4()
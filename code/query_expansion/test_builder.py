@@ -0,0 +1,80 @@
+import pytest
+
+from conftest import write_bulk
+from query_expansion.builder import QueryBuilder
+
+
+# the builder searches the title, abstract and text fields
+DOCUMENTS = {
+    f'e{i}': {'title': f'Earthquake report {i}',
+              'abstract': 'An earthquake with aftershocks.' if i % 2 else 'An earthquake.',
+              'text': ' '.join(['earthquake'] * (12 - i))}
+    for i in range(10)}
+DOCUMENTS['f1'] = {'title': 'Fault lines', 'abstract': 'Faults.', 'text': 'A fault.'}
+
+
+@pytest.fixture
+def bulk_file(tmp_path):
+    return write_bulk(tmp_path / 'bulk.json', DOCUMENTS)
+
+
+def identifiers(result):
+    return [hit.identifier for hit in result]
+
+
+def test_exclusions_use_the_kept_hits(backend):
+    qb = QueryBuilder('earthquake')
+    with qb.session(size=3, window=5) as session:
+        first = identifiers(session.result())
+        assert first == ['e0', 'e1', 'e2'] and session.searches == 1
+        qb.exclude_documents('e0', 'e1')
+        assert identifiers(session.result()) == ['e2', 'e3', 'e4']
+        assert session.searches == 1
+        # too few hits are left in the window, so the next page is requested
+        qb.exclude_documents('e2', 'e3')
+        assert identifiers(session.result()) == ['e4', 'e5', 'e6']
+        assert session.searches == 2
+        assert len(session.hits) == 10 and not session.exhausted
+        # an empty page means there are no more hits
+        qb.exclude_documents('e4', 'e5', 'e6', 'e7', 'e8')
+        assert identifiers(session.result()) == ['e9']
+        assert session.searches == 3 and session.exhausted
+        assert identifiers(session.result()) == ['e9']
+        assert session.searches == 3
+
+
+def test_included_documents_come_first(backend):
+    qb = QueryBuilder('earthquake')
+    with qb.session(size=3, window=5) as session:
+        session.result()
+        # e1 is in the window, e8 is not and is scored with an ids search
+        qb.include_documents('e8', 'e1')
+        assert identifiers(session.result()) == ['e8', 'e1', 'e0']
+        assert session.searches == 2
+        assert identifiers(session.result()) == ['e8', 'e1', 'e0']
+        assert session.searches == 2
+        # excluding an included document drops it
+        qb.exclude_documents('e8')
+        assert identifiers(session.result()) == ['e1', 'e0', 'e2']
+
+
+def test_new_terms_search_again(backend):
+    qb = QueryBuilder('earthquake')
+    with qb.session(size=3, window=5) as session:
+        session.result()
+        qb.include_terms('aftershocks', 'report')
+        assert identifiers(session.result()) == ['e1', 'e3', 'e5']
+        assert session.searches == 2
+        assert qb.query.formula() == '(earthquake AND aftershocks AND report)'
+        qb.exclude_terms('report')
+        assert len(session.result()) == 0
+        assert session.searches == 3
+
+
+def test_close_releases_the_point_in_time(backend):
+    qb = QueryBuilder('earthquake')
+    with qb.session() as session:
+        session.result()
+        assert session.pit in backend.pits
+        pit = session.pit
+    assert session.pit is None and pit not in backend.pits
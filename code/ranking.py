@@ -1,21 +1,416 @@
+"""Reranking of search results
+
+The ElasticSearch order of the hits is refined with the terms that were stored
+for each document at indexing time. For each document the terms come with a
+frequency and a tfidf score, the TermVectorRanker compares those to the terms in
+the query for all hits at once, using NumPy arrays. Optionally, the summaries of
+the hits are parsed with spaCy and the lemmas of the summary are matched to the
+query as well, this is switched off by default since it is much slower. Parsed
+summaries can be kept in an on-disk cache, see nlpcache.py.
+
+"""
+
+import re
 import time
-import spacy
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import timing
+from config import MAX_DOCUMENTS_FOR_NLP, NLP_POOL_SIZE, NLP_CHUNK_SIZE, NLP_EXCLUDE
+from config import NLP_BATCH_SIZE, NLP_PROCESSES, NLP_MULTIPROCESS_THRESHOLD
+from config import RERANK_BATCH_WINDOW, RERANK_NLP, RERANK_WEIGHTS
+from config import NLP_CACHE_PATH, NLP_CACHE_SIZE, NLP_CACHE_MEMORY
+
+
+logger = logging.getLogger(__name__)
+
+# The spaCy model is loaded on first use, see get_nlp(). In the API the model is
+# only loaded in the worker processes of the NLP pool.
+nlp = None
+
+# fields from the ElasticSearch source that the reranker can use, see source_fields()
+SOURCE_FIELDS = ('terms', 'summary') if RERANK_NLP else ('terms',)
+
+# When called from the API the spaCy work is done by a pool of processes, each
+# with its own copy of the model. This keeps the CPU bound work off the event
+# loop and lets a request give up on NLP that takes too long. Use pool() to get
+# the pool, it is replaced if a worker process died.
+POOL = None
+
+# Cache of parsed summaries, created on first use in each process that parses
+# summaries, see parse_cache()
+PARSES = None
+
+TOKEN = re.compile(r'\w+')
+
+
+def get_nlp():
+	"""Return the spaCy model, loading it if needed. Components that the ranker
+	does not use are not even loaded."""
+	global nlp
+	if nlp is None:
+		with timing.timed('spacy import'):
+			import spacy
+		with timing.timed('spacy model'):
+			nlp = spacy.load("en_core_web_sm", exclude=NLP_EXCLUDE)
+		timing.loaded('spacy')
+	return nlp
+
+
+def parse(texts: list) -> list:
+	"""Parse the texts in batches with nlp.pipe(). Large numbers of texts are spread
+	over several processes if NLP_PROCESSES is larger than one, starting processes
+	takes time so this only pays off for large batches."""
+	n_process = 1
+	if NLP_PROCESSES > 1 and len(texts) >= NLP_MULTIPROCESS_THRESHOLD:
+		n_process = NLP_PROCESSES
+	return list(get_nlp().pipe(texts, batch_size=NLP_BATCH_SIZE, n_process=n_process))
+
+
+def parse_cache():
+	"""Return the cache of parsed summaries, or None if there is no cache."""
+	global PARSES
+	if PARSES is None and NLP_CACHE_PATH is not None:
+		import nlpcache
+		PARSES = nlpcache.ParseCache(NLP_CACHE_PATH, NLP_CACHE_SIZE, NLP_CACHE_MEMORY)
+	return PARSES
+
+
+def parse_summaries(summaries: list) -> list:
+	"""Parse summaries, where the summaries are pairs of a document identifier and
+	the summary text. Parses are taken from the cache if possible, only summaries
+	that are not in the cache are parsed and those parses are added to the cache."""
+	cache = parse_cache()
+	if cache is None:
+		return parse([summary for _, summary in summaries])
+	import nlpcache
+	keys = [nlpcache.cache_key(doc_id, summary) for doc_id, summary in summaries]
+	parsed = cache.get_many(keys, get_nlp().vocab)
+	missing = {key: summary for key, (_, summary) in zip(keys, summaries)
+			   if key not in parsed}
+	if missing:
+		new_parses = list(zip(missing, parse(list(missing.values()))))
+		cache.put_many(new_parses)
+		parsed.update(new_parses)
+	return [parsed[key] for key in keys]
+
+
+def source_fields(query: str) -> tuple:
+	"""Return the fields from the ElasticSearch source that are needed to rerank the
+	hits for the query. The terms are often the largest part of the source of a hit,
+	so they are not retrieved when reranking cannot change the ElasticSearch order,
+	which is when the query has no terms or when the features that use the terms
+	have no weight."""
+	if not query_terms(query):
+		return ()
+	fields = []
+	if RANKER.cosine_weight or RANKER.coverage_weight:
+		fields.append('terms')
+	if RERANK_NLP and RANKER.summary_weight:
+		fields.append('summary')
+	return tuple(fields)
+
+
+def query_terms(query: str) -> list:
+	"""Return the lower-cased tokens and bigrams of the query as well as the whole
+	query, the latter two are there to match multi-word terms."""
+	tokens = TOKEN.findall(query.lower()) if query else []
+	if not tokens:
+		return []
+	bigrams = [f'{t1} {t2}' for t1, t2 in zip(tokens, tokens[1:])]
+	return list(dict.fromkeys(tokens + bigrams + [' '.join(tokens)]))
+
+
+def rerank(docs: list, query: str = None):
+	return rerank_many([(docs, query)])[0]
+
+
+def rerank_many(requests: list):
+	"""Rerank several lists of documents, for example the results of concurrent
+	requests. Each request is a pair of a list of documents and the query. When
+	NLP is used then the summaries of all requests are parsed in one batch. This
+	does all the work in the current process and without a time limit."""
+	t0 = time.perf_counter()
+	summary_features = [None] * len(requests)
+	if RERANK_NLP:
+		summaries = []
+		for docs, _ in requests:
+			summaries.extend((doc.identifier, doc.summary)
+							 for doc in docs[:MAX_DOCUMENTS_FOR_NLP])
+		parsed_docs = iter(parse_summaries(summaries))
+		for n, (docs, query) in enumerate(requests):
+			qterms = set(query_terms(query))
+			summary_features[n] = np.array(
+				[summary_match(next(parsed_docs), qterms)
+				 for _ in docs[:MAX_DOCUMENTS_FOR_NLP]], dtype=np.float32)
+	reranked = [RANKER.rerank(docs, query, summary_features[n])
+				for n, (docs, query) in enumerate(requests)]
+	logger.debug(f'reranked {len(requests)} request(s) in {time.perf_counter() - t0:.4f} seconds')
+	return reranked
+
+
+def summary_match(parsed, qterms: set) -> float:
+	"""Return how often query tokens occur in the parsed summary, either as the
+	lower-cased token or as the lemma, normalized by summary length."""
+	if not len(parsed):
+		return 0.0
+	count = sum(1 for token in parsed
+				if token.lower_ in qterms or token.lemma_.lower() in qterms)
+	return count / np.sqrt(len(parsed))
+
+
+def match_summaries(texts: list) -> list:
+	"""Parse the summaries and match them to the query terms. The texts are triples
+	of a document identifier, a summary and a list of query terms. This runs in the
+	worker processes."""
+	parsed_docs = parse_summaries([(doc_id, summary) for doc_id, summary, _ in texts])
+	return [summary_match(parsed, set(qterms))
+			for parsed, (_, _, qterms) in zip(parsed_docs, texts)]
+
+
+async def arerank(docs: list, query: str = None, deadline: float = None):
+	"""Asynchronous version of rerank(), returns the reranked documents and a
+	boolean that indicates whether reranking was complete. The term vector
+	reranking takes well under a millisecond so it runs on the event loop, NLP
+	is handed off to the process pool. The deadline is a time on the clock of
+	the event loop. Documents whose summaries were not processed when the
+	deadline passes are not reranked and stay in the ElasticSearch order."""
+	return (await arerank_many([(docs, query)], deadline))[0]
+
+
+async def arerank_many(requests: list, deadline: float = None):
+	"""Asynchronous version of rerank_many(), returns a list of pairs of reranked
+	documents and a boolean that indicates whether reranking was complete, see
+	arerank(). The summaries of all requests are handed to the pool together."""
+	if not RERANK_NLP:
+		return [(docs, True) for docs in rerank_many(requests)]
+	texts = []
+	for docs, query in requests:
+		qterms = query_terms(query)
+		texts.extend((doc.identifier, doc.summary, qterms)
+					 for doc in docs[:MAX_DOCUMENTS_FOR_NLP])
+	if RERANK_BATCH_WINDOW > 0:
+		# chunks are shared with other requests so they should not be cancelled
+		pieces = await BATCHER.submit(texts)
+		matches = await collect(pieces, deadline, cancel=False)
+	else:
+		pieces = submit(texts)
+		matches = await collect(pieces, deadline)
+	results = []
+	start = 0
+	for docs, query in requests:
+		end = start + len(docs[:MAX_DOCUMENTS_FOR_NLP])
+		request_matches = matches[start:end]
+		processed = len(request_matches)
+		if start + processed == end:
+			results.append((RANKER.rerank(docs, query, request_matches), True))
+		else:
+			reranked = RANKER.rerank(docs[:processed], query, request_matches)
+			results.append((reranked + docs[processed:], False))
+		start = end
+	return results
+
+
+def pool() -> ProcessPoolExecutor:
+	global POOL
+	if POOL is None or POOL._broken:
+		if POOL is not None:
+			logger.warning('NLP process pool is broken, starting a new one')
+			POOL.shutdown(wait=False, cancel_futures=True)
+		POOL = ProcessPoolExecutor(
+			max_workers=NLP_POOL_SIZE, mp_context=multiprocessing.get_context('spawn'),
+			initializer=get_nlp)
+	return POOL
+
+
+def worker_ready() -> bool:
+	return nlp is not None
+
+
+async def warm_up():
+	"""Start the NLP worker processes and wait until they have loaded the model.
+	Does nothing if the reranker does not use NLP."""
+	if not RERANK_NLP:
+		return
+	loop = asyncio.get_running_loop()
+	with timing.timed('nlp pool'):
+		await asyncio.gather(*[loop.run_in_executor(pool(), worker_ready)
+							   for _ in range(NLP_POOL_SIZE)])
+	timing.loaded('nlp pool')
+
+
+def ready() -> bool:
+	"""The ranker is ready if it does not need NLP or if the NLP pool is up."""
+	return not RERANK_NLP or timing.is_loaded('nlp pool')
+
+
+def close():
+	if POOL is not None:
+		POOL.shutdown(wait=False, cancel_futures=True)
+
+
+def submit(texts: list) -> list:
+	"""Hand the texts to the process pool in chunks. Returns a list of pieces, one
+	for each chunk, where a piece is a triple of the future for the chunk and the
+	start and end of the results for these texts in the result of the chunk."""
+	loop = asyncio.get_running_loop()
+	pieces = []
+	for i in range(0, len(texts), NLP_CHUNK_SIZE):
+		chunk = texts[i:i+NLP_CHUNK_SIZE]
+		future = loop.run_in_executor(pool(), match_summaries, chunk)
+		pieces.append((future, 0, len(chunk)))
+	return pieces
+
+
+async def collect(pieces: list, deadline: float = None, cancel: bool = True) -> np.ndarray:
+	"""Wait for the pieces until the deadline and return the results for the
+	longest run of pieces from the start that finished in time. Unless cancel is
+	False, pieces that are still waiting for a worker when the deadline passes
+	are cancelled."""
+	futures = [future for future, _, _ in pieces]
+	if futures:
+		timeout = None
+		if deadline is not None:
+			timeout = max(0, deadline - asyncio.get_running_loop().time())
+		await asyncio.wait(futures, timeout=timeout)
+	results = []
+	for future, start, end in pieces:
+		if not future.done() or future.cancelled() or future.exception() is not None:
+			break
+		results.extend(future.result()[start:end])
+	for future in set(futures):
+		if future.done() and not future.cancelled() and future.exception() is not None:
+			logger.warning(f'NLP for reranking failed: {future.exception()!r}')
+	if cancel:
+		for future in futures:
+			if not future.done():
+				future.cancel()
+	return np.array(results, dtype=np.float32)
+
+
+class TermVectorRanker:
+
+	"""Reranks documents by combining the ElasticSearch score with how well the
+	stored terms of a document match the query. For all hits together we build a
+	matrix of the tfidf weights of the query terms in each document, from which
+	we get the cosine similarity of the documents with the query and the share
+	of query terms that the documents cover. The features are normalized over
+	the hits and then combined using the weights from RERANK_WEIGHTS, the result
+	is stored in the nscore attribute."""
+
+	def __init__(self, weights: dict):
+		self.es_weight = weights.get('elastic', 0)
+		self.cosine_weight = weights.get('cosine', 0)
+		self.coverage_weight = weights.get('coverage', 0)
+		self.summary_weight = weights.get('summary', 0)
+
+	def scores(self, docs: list, qterms: list, summary_matches=None) -> np.ndarray:
+		n_docs = len(docs)
+		n_qterms = max(len(qterms), 1)
+		es_scores = np.fromiter((doc.score or 0 for doc in docs), np.float32, n_docs)
+		weights, norms = self.weights(docs, qterms)
+		cosine = weights.sum(axis=1) / (norms * np.sqrt(n_qterms))
+		coverage = (weights > 0).mean(axis=1)
+		combined = self.es_weight * normalize(es_scores)
+		combined += self.cosine_weight * normalize(cosine)
+		combined += self.coverage_weight * coverage
+		if summary_matches is not None and len(summary_matches):
+			# documents that were not parsed get the average of the parsed ones
+			summary = np.full(n_docs, summary_matches.mean(), dtype=np.float32)
+			summary[:len(summary_matches)] = summary_matches
+			combined += self.summary_weight * normalize(summary)
+		return combined
+
+	def weights(self, docs: list, qterms: list) -> np.ndarray:
+		"""Return the matrix with the tfidf weights of the query terms (columns) in
+		the documents (rows) and the norms of the term vectors of the documents.
+		Only the query terms are looked up in the terms of each document, the other
+		terms are only needed for the norm."""
+		weights = np.zeros((len(docs), max(len(qterms), 1)), dtype=np.float32)
+		norms = np.ones(len(docs), dtype=np.float32)
+		for i, doc in enumerate(docs):
+			term_weights, norm = doc.term_weights()
+			norms[i] = norm or 1
+			for j, qterm in enumerate(qterms):
+				tfidf = term_weights.get(qterm)
+				if tfidf is not None:
+					weights[i, j] = float(tfidf)
+		return weights, norms
+
+	def rerank(self, docs: list, query: str, summary_matches=None) -> list:
+		qterms = query_terms(query)
+		if not docs or not qterms:
+			return docs
+		scores = self.scores(docs, qterms, summary_matches)
+		for doc, score in zip(docs, scores.tolist()):
+			doc.nscore = score
+		# a stable sort keeps the ElasticSearch order for ties
+		order = np.argsort(-scores, kind='stable')
+		return [docs[i] for i in order]
+
+
+def normalize(values: np.ndarray) -> np.ndarray:
+	"""Scale the values so that the maximum is 1.0, leaves all zeros alone."""
+	maximum = values.max() if len(values) else 0
+	return values / maximum if maximum > 0 else values
+
+
+class Batcher:
 
-from config import MAX_DOCUMENTS_FOR_NLP
+	"""Collects the summaries of concurrent rerank requests and hands them off to
+	the process pool together, so that they are parsed in shared chunks. The
+	summaries are handed off when the window of time after the first request
+	has passed or when enough summaries are waiting."""
 
+	def __init__(self, window: float, max_texts: int):
+		self.window = window
+		self.max_texts = max_texts
+		self.queue = []
+		self.size = 0
+		self.timer = None
 
-t0 = time.time()
-nlp = spacy.load("en_core_web_sm", disable=["ner", "parser", "tok2vec"])
+	def __str__(self):
+		return f'<Batcher waiting={len(self.queue)} texts={self.size}>'
 
-# TODO: move this to a log
-# print(f'>>> spaCy loaded in {time.time() - t0: .4f} seconds')
+	async def submit(self, texts: list) -> list:
+		"""Like submit(), but the chunks may be shared with other requests."""
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self.queue.append((texts, future))
+		self.size += len(texts)
+		if self.size >= self.max_texts:
+			self.flush()
+		elif self.timer is None:
+			self.timer = loop.call_later(self.window, self.flush)
+		return await future
 
+	def flush(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		queue, self.queue, self.size = self.queue, [], 0
+		all_texts = [text for texts, _ in queue for text in texts]
+		chunks = submit(all_texts)
+		# map the texts of each request to the chunks that contain them
+		start = 0
+		for texts, future in queue:
+			pieces = []
+			i = start
+			stop = start + len(texts)
+			while i < stop:
+				first = i - i % NLP_CHUNK_SIZE
+				end = min(stop, first + NLP_CHUNK_SIZE)
+				chunk_future = chunks[first // NLP_CHUNK_SIZE][0]
+				pieces.append((chunk_future, i - first, end - first))
+				i = end
+			start = stop
+			if not future.done():
+				future.set_result(pieces)
 
-def rerank(docs: list):
-	t0 = time.time()
-	for doc in docs[:MAX_DOCUMENTS_FOR_NLP]:
-		parsed_doc = nlp(doc.summary)
 
-	# TODO: move this to a log
-	# print(f'>>> reranked in {time.time() - t0: .4f} seconds')
-	return docs
+RANKER = TermVectorRanker(RERANK_WEIGHTS)
+BATCHER = Batcher(RERANK_BATCH_WINDOW, NLP_BATCH_SIZE)
@@ -0,0 +1,51 @@
+"""Serialization of API responses
+
+Responses are serialized with orjson if it is installed and with the json module
+from the standard library otherwise. FastJSONResponse is the default response
+class of the API. Handlers that return larger responses create the response
+themselves, which skips the jsonable_encoder() pass that FastAPI otherwise does
+over the returned content. Objects with an as_json() method, like Document and
+DocumentSet, are serialized through that method. Serialized documents are cached
+on the Document, see Document.json_bytes().
+
+Pretty-printed responses are not created here, see utils.prettify().
+
+"""
+
+import json
+
+from fastapi.responses import JSONResponse
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """Serialize objects that the JSON encoder does not know about."""
+    as_json = getattr(obj, 'as_json', None)
+    if as_json is not None:
+        return as_json()
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+
+
+if orjson is not None:
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=default)
+
+else:
+
+    def dumps(obj) -> bytes:
+        return json.dumps(
+            obj, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        with metrics.stage('serialize'):
+            return dumps(content)
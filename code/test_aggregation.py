@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from document import Document, DocumentSet
+from aggregation import TermVocabulary, top_terms
+
+
+def doc(identifier: str, terms: list) -> Document:
+    return Document({'_id': identifier, '_source': {'terms': terms}})
+
+
+def dict_terms(docs: list) -> list:
+    # the sums of sorted_terms() as they were computed with a dictionary, but for
+    # all occurrences of a term and not only the first one
+    sums = {}
+    for d in docs:
+        for term, freq, tfidf in d.terms:
+            freq_sum, tfidf_sum = sums.get(term, (0, 0.0))
+            sums[term] = (freq_sum + freq, tfidf_sum + tfidf)
+    return sorted(((term, freq, tfidf) for term, (freq, tfidf) in sums.items()),
+                  key=lambda triple: triple[2], reverse=True)
+
+
+def random_docs(seed: int, n: int) -> list:
+    rng = random.Random(seed)
+    vocabulary = [f'term{i}' for i in range(50)]
+    return [doc(f'd{i}', [[term, str(rng.randint(1, 5)), str(rng.randint(1, 99) / 100)]
+                          for term in rng.sample(vocabulary, 10)])
+            for i in range(n)]
+
+
+def test_top_terms_match_the_dictionary_sums():
+    docs = random_docs(3, 40)
+    expected = dict_terms(docs)
+    actual = top_terms(docs, vocabulary=TermVocabulary(1000))
+    assert {term: (freq, pytest.approx(tfidf)) for term, freq, tfidf in actual} == {
+        term: (freq, tfidf) for term, freq, tfidf in expected}
+    scores = [tfidf for _, _, tfidf in actual]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_top_k_terms():
+    docs = random_docs(5, 20)
+    vocabulary = TermVocabulary(1000)
+    everything = top_terms(docs, vocabulary=vocabulary)
+    assert top_terms(docs, 7, vocabulary) == everything[:7]
+    assert top_terms(docs, 0, vocabulary) == []
+    assert top_terms(docs, 1000, vocabulary) == everything
+    assert top_terms([], 5, vocabulary) == []
+
+
+def test_ties_are_ordered_on_first_occurrence():
+    docs = [doc('d1', [['b', '1', '0.5'], ['a', '1', '0.5']]),
+            doc('d2', [['c', '2', '0.5'], ['a', '1', '0.25']])]
+    vocabulary = TermVocabulary(1000)
+    assert top_terms(docs, 2, vocabulary) == [('a', 2, 0.75), ('b', 1, 0.5)]
+    assert top_terms(docs, vocabulary=vocabulary) == [
+        ('a', 2, 0.75), ('b', 1, 0.5), ('c', 2, 0.5)]
+
+
+def test_vocabulary_starting_over_while_adding_up():
+    docs = [doc(f'd{i}', [[f'term{i}{j}', '1', '0.5'] for j in range(5)]) for i in range(4)]
+    # the vocabulary is nearly full, so it starts over halfway the documents
+    vocabulary = TermVocabulary(30)
+    vocabulary.intern([f'other{i}' for i in range(20)])
+    actual = top_terms(docs, vocabulary=vocabulary)
+    assert vocabulary.generation == 1 and len(vocabulary) == 20
+    assert {term: freq for term, freq, _ in actual} == {
+        term: freq for term, freq, _ in dict_terms(docs)}
+
+
+def test_document_set_adds_up_all_documents():
+    docs = [doc('d1', [['flu', '2', '0.5']]), doc('d2', [['flu', '3', '0.25']])]
+    assert DocumentSet(docs).sorted_terms() == [('flu', 5, 0.75)]
+
+
+def test_sums_do_not_depend_on_the_vocabulary_size():
+    docs = random_docs(7, 10)
+    expected = top_terms(docs, vocabulary=TermVocabulary(1000))
+    vocabulary = TermVocabulary(100000)
+    vocabulary.intern([f'other{i}' for i in range(50000)])
+    docs = random_docs(7, 10)
+    assert top_terms(docs, vocabulary=vocabulary) == expected
+    # the arrays are built without restoring the types of the stored terms
+    assert all(isinstance(freq, str) for d in docs for _, freq, _ in d._source['terms'])
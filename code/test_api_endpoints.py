@@ -0,0 +1,256 @@
+"""Tests for the API endpoints, on the memory backend (see conftest.py). The
+test_api.py script pings a running API instead."""
+
+import json
+
+import config
+import utils
+import elastic_async
+from elastic import search_query, related_query
+
+
+def test_get_field(api_client):
+    response = api_client.get('/api/doc/d4/title')
+    assert response.status_code == 200
+    assert response.json() == {'title': 'Water on Mars'}
+    assert api_client.get('/api/doc/nope/title').json() == {}
+
+
+def test_get_field_returns_the_public_fields(api_client):
+    for field in ('score', 'nscore', 'entities', 'terms'):
+        response = api_client.get(f'/api/doc/d4/{field}')
+        assert response.status_code == 200, field
+        assert list(response.json()) == [field]
+    assert api_client.get('/api/doc/d4/nosuchfield').json() == {'nosuchfield': None}
+
+
+def test_get_field_rejects_private_attributes_and_methods(api_client):
+    for field in ('_source', '_json', '_term_arrays', 'as_json', 'term_arrays'):
+        response = api_client.get(f'/api/doc/d4/{field}')
+        assert response.status_code == 400, field
+        assert 'title' in response.json()['details']['elastic_details']['allowed_fields']
+
+
+def test_set_lists_identifiers_that_do_not_exist(api_client):
+    response = api_client.get('/api/set', params={'ids': 'd1,nope,d4', 'terms': 2})
+    assert response.status_code == 200
+    answer = response.json()
+    assert [doc['identifier'] for doc in answer['documents']] == ['d1', 'd4']
+    assert [(term, tfidf) for term, _, tfidf in answer['terms']] == [
+        ('influenza', 0.9), ('water', 0.9)]
+    assert answer['errors'] == [{'id': 'nope', 'type': 'not_found', 'reason': 'document does not exist'}]
+
+
+def test_set_is_completed_when_a_later_request_fails(api_client, backend, monkeypatch):
+    import elasticsearch
+    monkeypatch.setattr(config, 'MGET_CHUNK_SIZE', 1)
+    monkeypatch.setattr(config, 'MGET_CONCURRENCY', 1)
+    mget = backend.mget
+    calls = []
+
+    def failing_mget(**kwargs):
+        calls.append(kwargs)
+        if len(calls) > 1:
+            raise elasticsearch.ConnectionError('connection lost')
+        return mget(**kwargs)
+
+    monkeypatch.setattr(backend, 'mget', failing_mget)
+    response = api_client.get('/api/set', params={'ids': 'd1,d2,d3'})
+    assert response.status_code == 200
+    answer = response.json()
+    assert [doc['identifier'] for doc in answer['documents']] == ['d1']
+    assert [error['id'] for error in answer['errors']] == ['d2', 'd3']
+    assert answer['errors'][0]['type'] == 'request_failed'
+
+
+def test_set_fails_when_all_identifiers_fail(api_client, backend, monkeypatch):
+    error = {'type': 'index_not_found_exception', 'reason': 'no such index [xdd]'}
+    monkeypatch.setattr(backend, 'mget', lambda ids, **kwargs: {
+        'docs': [{'_id': doc_id, 'error': error} for doc_id in ids]})
+    response = api_client.get('/api/set', params={'ids': 'd1,d2'})
+    assert response.status_code == 500
+    assert response.json()['message'] == 'AskMe Exception: no such index [xdd]'
+
+
+def test_page_tokens_page_through_all_results(api_client, backend, monkeypatch):
+    monkeypatch.setattr(config, 'MAX_RESULTS', 1)
+    params = {'query': 'water mars rover sediment'}
+    answer = api_client.post('/api/question', params=params).json()
+    seen = [doc['identifier'] for doc in answer['documents']]
+    pits = set()
+    while 'next_token' in answer['pages']:
+        token = answer['pages']['next_token']
+        response = api_client.post('/api/question', params={**params, 'page_token': token})
+        assert response.status_code == 200
+        answer = response.json()
+        seen.extend(doc['identifier'] for doc in answer['documents'])
+        pits.add(utils.decode_page_token(token)['pit'])
+        assert len(answer['documents']) == 1
+    # d4, d5 and d6 all have water and d5 has both mars and rover
+    assert sorted(seen) == ['d4', 'd5', 'd6']
+    assert seen[0] == 'd5'
+    # the first page requested with a token opened the point in time, the pages
+    # after it reused it and it was closed with the last page
+    assert len(pits) == 2 and None in pits and backend.pits == {}
+
+
+def test_page_token_must_match_the_query(api_client, monkeypatch):
+    monkeypatch.setattr(config, 'MAX_RESULTS', 1)
+    answer = api_client.post('/api/question', params={'query': 'water'}).json()
+    token = answer['pages']['next_token']
+    response = api_client.post('/api/question', params={'query': 'flu', 'page_token': token})
+    assert response.status_code == 400
+    response = api_client.post('/api/question', params={'query': 'water', 'page_token': 'x!'})
+    assert response.status_code == 400
+
+
+def test_question(api_client):
+    response = api_client.post('/api/question', params={'query': 'flu'})
+    assert response.status_code == 200
+    answer = response.json()
+    assert answer['query'] == {'question': 'flu'}
+    assert sorted(doc['identifier'] for doc in answer['documents']) == ['d1', 'd2']
+    assert answer['reranked'] == 'complete' and answer['timed_out'] is False
+    tagged = api_client.post('/api/question', params={'query': 'water', 'tags': 'mars,biomedical'})
+    assert sorted(doc['identifier'] for doc in tagged.json()['documents']) == ['d4', 'd5']
+    exact = api_client.post('/api/question', params={'query': 'flu cases', 'type': 'exact'})
+    assert sorted(doc['identifier'] for doc in exact.json()['documents']) == ['d1', 'd2']
+    exact = api_client.post('/api/question', params={'query': 'cases flu', 'type': 'exact'})
+    assert exact.json()['documents'] == []
+
+
+def test_documents_are_retrieved_with_get(api_client, backend, monkeypatch):
+    calls = []
+    get = backend.get
+
+    def counting_get(**kwargs):
+        calls.append(kwargs)
+        return get(**kwargs)
+
+    def no_search(**kwargs):
+        raise AssertionError('documents should not be searched for')
+
+    monkeypatch.setattr(backend, 'get', counting_get)
+    monkeypatch.setattr(backend, 'search', no_search)
+    answer = api_client.get('/api/doc/d1').json()
+    assert answer['identifier'] == 'd1' and answer['title'] == 'Influenza vaccine trials in children'
+    assert answer['terms'][0] == ['influenza', 3, 0.9]
+    assert [call['id'] for call in calls] == ['d1'] and calls[0]['realtime']
+    # the second time the document comes from the document cache
+    assert api_client.get('/api/doc/d1').json() == answer
+    assert len(calls) == 1
+    assert api_client.get('/api/doc/nope').json() == {}
+
+
+def test_raw_document(api_client):
+    answer = api_client.get('/api/rawdoc/d4').json()
+    assert answer['hits']['total'] == {'value': 1, 'relation': 'eq'}
+    assert [hit['_id'] for hit in answer['hits']['hits']] == ['d4']
+    assert answer['hits']['hits'][0]['_source']['title'] == 'Water on Mars'
+    assert api_client.get('/api/rawdoc/nope').json()['hits']['hits'] == []
+
+
+def test_raw_document_is_not_changed_by_reading_the_document(api_client):
+    api_client.get('/api/doc/d4')
+    source = api_client.get('/api/rawdoc/d4').json()['hits']['hits'][0]['_source']
+    # the terms are stored as strings and the document keeps its own copy
+    assert all(isinstance(freq, str) and isinstance(tfidf, str)
+               for _, freq, tfidf in source['terms'])
+
+
+def test_export(api_client, backend, monkeypatch):
+    monkeypatch.setattr(config, 'EXPORT_BATCH_SIZE', 2)
+    params = {'query': 'water', 'fields': 'identifier,title'}
+    response = api_client.get('/api/export', params=params)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    # in order of score, over several batches
+    hits = backend.search(index=config.ELASTIC_INDEX, query=search_query(None, 'water'))
+    assert [doc['identifier'] for doc in lines] == [hit['_id'] for hit in hits['hits']['hits']]
+    assert len(lines) == 3
+    assert {'identifier': 'd4', 'title': 'Water on Mars'} in lines
+    # the point in time is closed when the export is done
+    assert backend.pits == {}
+    tagged = api_client.get('/api/export', params={**params, 'tags': 'geoarchive'})
+    assert sorted(json.loads(line)['identifier'] for line in tagged.text.splitlines()) == ['d5', 'd6']
+
+
+def test_export_fails_before_the_response_starts(api_client, backend, monkeypatch):
+    from memory_backend import BackendError
+
+    def failing_search(**kwargs):
+        raise BackendError('search failed', status=503, type='search_phase_execution_exception')
+
+    monkeypatch.setattr(backend, 'search', failing_search)
+    response = api_client.get('/api/export', params={'query': 'water'})
+    assert response.status_code == 503
+    assert response.json()['details']['elastic_details']['reason'] == 'search failed'
+    assert backend.pits == {}
+
+
+def test_questions(api_client, backend, monkeypatch):
+    from memory_backend import BackendError
+    calls = []
+    msearch = backend.msearch
+    search = backend.search
+
+    def recording_msearch(**kwargs):
+        calls.append(kwargs['searches'][1::2])
+        return msearch(**kwargs)
+
+    def failing_search(**kwargs):
+        if 'boom' in json.dumps(kwargs.get('body')):
+            raise BackendError('cannot search for boom')
+        return search(**kwargs)
+
+    monkeypatch.setattr(backend, 'msearch', recording_msearch)
+    monkeypatch.setattr(backend, 'search', failing_search)
+    # the first question is in the search cache after this
+    single = api_client.post('/api/question', params={'query': 'flu'}).json()
+    questions = [{'query': 'flu'}, {'query': 'boom'}, {'query': 'water', 'tags': 'mars'}]
+    response = api_client.post('/api/questions', json=questions)
+    assert response.status_code == 200
+    flu, boom, water = response.json()['questions']
+    assert flu == single
+    assert boom == {'query': {'question': 'boom'}, 'error': {
+        'status': 400, 'type': 'illegal_argument_exception', 'reason': 'cannot search for boom'}}
+    assert sorted(doc['identifier'] for doc in water['documents']) == ['d4', 'd5']
+    # one request for the questions that were not cached
+    assert len(calls) == 1 and len(calls[0]) == 2
+    too_many = [{'query': 'flu'}] * (config.MAX_QUESTIONS + 1)
+    assert api_client.post('/api/questions', json=too_many).status_code == 400
+
+
+def test_related_documents_are_searched_once(api_client, backend, monkeypatch):
+    searches = []
+    search = backend.search
+
+    def recording_search(**kwargs):
+        searches.append(kwargs)
+        return search(**kwargs)
+
+    def no_get(**kwargs):
+        raise AssertionError('the document is given to more_like_this by reference')
+
+    def small_index_query(doc_id, index):
+        # the default min_doc_freq of 5 leaves no terms with six documents
+        query = related_query(doc_id, index)
+        query['more_like_this']['min_doc_freq'] = 1
+        return query
+
+    monkeypatch.setattr(backend, 'search', recording_search)
+    monkeypatch.setattr(backend, 'get', no_get)
+    monkeypatch.setattr(elastic_async, 'related_query', small_index_query)
+    answer = api_client.get('/api/related/d4').json()
+    assert answer['query'] == {'doc_id': 'd4', 'precomputed': False}
+    identifiers = [doc['identifier'] for doc in answer['documents']]
+    assert identifiers[0] == 'd5' and 'd4' not in identifiers
+    like = searches[0]['query']['more_like_this']['like']
+    assert like == [{'_index': config.ELASTIC_INDEX, '_id': 'd4'}]
+    assert api_client.get('/api/related/d4').json() == answer
+    assert len(searches) == 1
+    # other fields are another cache entry
+    fields = api_client.get('/api/related/d4', params={'fields': 'identifier'}).json()
+    assert fields['documents'][0] == {'identifier': 'd5'}
+    assert len(searches) == 2
@@ -0,0 +1,43 @@
+from benchmark import parse_server_timing, make_requests, label_cold, report_rows
+
+
+QUESTIONS = [('flu vaccine', []), ('water on mars', ['mars'])]
+WEIGHTS = {'question': 4, 'doc': 2, 'related': 1, 'set': 1}
+
+
+def test_parse_server_timing():
+    header = 'es-client;dur=12.30, app;dur=50.00, cache;desc="hit"'
+    assert parse_server_timing(header) == {'es-client': 12.3, 'app': 50.0}
+    assert parse_server_timing('') == {}
+
+
+def test_requests_are_reproducible():
+    first = make_requests(7, 50, WEIGHTS, QUESTIONS, ['d1', 'd2', 'd3'])
+    assert first == make_requests(7, 50, WEIGHTS, QUESTIONS, ['d1', 'd2', 'd3'])
+    assert first != make_requests(8, 50, WEIGHTS, QUESTIONS, ['d1', 'd2', 'd3'])
+    # without documents only questions can be asked
+    assert {request[0] for request in make_requests(7, 50, WEIGHTS, QUESTIONS, [])} == {'question'}
+
+
+def test_label_cold():
+    requests = [
+        ('question', 'GET', '/api/question', {'query': 'flu', 'page': 1}),
+        ('question', 'GET', '/api/question', {'page': 1, 'query': 'flu'}),
+        ('question', 'GET', '/api/question', {'query': 'flu', 'page': 2}),
+        ('doc', 'GET', '/api/doc/d1', {}),
+        ('set', 'GET', '/api/set', {'ids': 'd1,d2'}),
+        ('set', 'GET', '/api/set', {'ids': 'd2,d1'}),
+        ('related', 'GET', '/api/related/d1', {}),
+    ]
+    assert label_cold(requests) == [True, False, True, True, True, False, True]
+    assert label_cold(requests, no_cache=True) == [True] * len(requests)
+
+
+def test_report_rows():
+    summary = {'requests': 1}
+    results = {'endpoints': {'doc': summary}, 'total': summary,
+               'caches': {'cold': {'doc': summary, 'total': summary}}}
+    assert [name for name, _ in report_rows(results)] == ['doc', 'total', 'doc cold', 'total cold']
+    # results saved before the split have no cold and warm rows
+    del results['caches']
+    assert [name for name, _ in report_rows(results)] == ['doc', 'total']
@@ -0,0 +1,136 @@
+import asyncio
+
+from cache import LRUCache, TTLCache, DocumentCache, MISS, FRESH, STALE
+
+
+def age(ttl_cache: TTLCache, key, seconds: float):
+    """Make the entry for the key older by the number of seconds."""
+    value, stored_at = ttl_cache.data[key]
+    ttl_cache.data[key] = (value, stored_at - seconds)
+
+
+def test_lru_evicts_least_recently_used():
+    lru = LRUCache(2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert 'b' not in lru
+    assert lru.get('a') == 1 and lru.get('c') == 3
+
+
+def test_lru_with_size_zero_stores_nothing():
+    lru = LRUCache(0)
+    lru.put('a', 1)
+    assert len(lru) == 0
+
+
+def test_set_generation_clears_entries():
+    lru = LRUCache(10)
+    lru.set_generation('g1')
+    lru.put('a', 1)
+    lru.set_generation('g1')
+    assert lru.get('a') == 1
+    lru.set_generation('g2')
+    assert lru.get('a') is None
+
+
+def test_ttl_states():
+    ttl_cache = TTLCache(10, ttl=10, stale=20)
+    assert ttl_cache.lookup('a') == (None, MISS)
+    ttl_cache.put('a', 1)
+    assert ttl_cache.lookup('a') == (1, FRESH)
+    age(ttl_cache, 'a', 15)
+    assert ttl_cache.lookup('a') == (1, STALE)
+    age(ttl_cache, 'a', 20)
+    assert ttl_cache.lookup('a') == (None, MISS)
+    assert 'a' not in ttl_cache
+
+
+def test_concurrent_misses_compute_once():
+    ttl_cache = TTLCache(10, ttl=10)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def main():
+        return await asyncio.gather(*[ttl_cache.get_or_compute('a', compute) for _ in range(5)])
+
+    assert asyncio.run(main()) == ['value'] * 5
+    assert len(calls) == 1
+    assert ttl_cache.lookup('a') == ('value', FRESH)
+
+
+def test_stale_entry_is_served_while_refreshing():
+    ttl_cache = TTLCache(10, ttl=10, stale=20)
+    ttl_cache.put('a', 'old')
+    age(ttl_cache, 'a', 15)
+
+    async def compute():
+        return 'new'
+
+    async def main():
+        value = await ttl_cache.get_or_compute('a', compute)
+        await asyncio.gather(*ttl_cache.pending.values())
+        return value
+
+    assert asyncio.run(main()) == 'old'
+    assert ttl_cache.lookup('a') == ('new', FRESH)
+
+
+def test_uncacheable_values_are_not_stored():
+    ttl_cache = TTLCache(10, ttl=10)
+
+    async def compute():
+        return 'partial'
+
+    value = asyncio.run(ttl_cache.get_or_compute('a', compute, cacheable=lambda v: False))
+    assert value == 'partial'
+    assert 'a' not in ttl_cache
+
+
+def test_values_from_an_older_generation_are_not_stored():
+    ttl_cache = TTLCache(10, ttl=10)
+    ttl_cache.set_generation('g1')
+
+    async def compute():
+        # the index changes while the value is computed
+        ttl_cache.set_generation('g2')
+        return 'value'
+
+    assert asyncio.run(ttl_cache.get_or_compute('a', compute)) == 'value'
+    assert 'a' not in ttl_cache
+
+
+
+def test_document_cache_tiers(tmp_path):
+    hit = {'_id': 'd1', '_source': {'title': 'Title', 'terms': [['flu', '1', '0.5']]}}
+    path = str(tmp_path / 'docs.db')
+    documents = DocumentCache(10, path)
+    documents.set_generation('g1')
+    documents.put_many([hit, {'_id': 'nope', 'found': False}])
+    assert list(asyncio.run(documents.get_many(['d1', 'nope']))) == ['d1']
+    documents.flush()
+    # another process only has the documents on disk
+    other = DocumentCache(10, path)
+    other.set_generation('g1')
+    assert asyncio.run(other.get('d1')).title == 'Title'
+    assert len(other) == 1
+    other.set_generation('g2')
+    assert asyncio.run(other.get('d1')) is None
+
+
+def test_document_cache_uses_the_database_from_one_thread(tmp_path):
+    documents = DocumentCache(10, str(tmp_path / 'docs.db'))
+    documents.set_generation('g1')
+    documents.put_many([{'_id': f'd{i}', '_source': {'title': str(i)}} for i in range(5)])
+    documents.memory.clear()
+
+    async def main():
+        return await asyncio.gather(*[documents.get(f'd{i}') for i in range(5)])
+
+    assert [doc.title for doc in asyncio.run(main())] == ['0', '1', '2', '3', '4']
+    assert documents._executor._max_workers == 1
@@ -0,0 +1,76 @@
+import inspect
+
+import pytest
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+
+import clients
+import config
+import memory_backend
+from clients import SearchBackend, Indices
+from utils import encode_page_token
+
+
+def interface(protocol) -> dict:
+    """Return the methods of the protocol with their keyword arguments."""
+    return {name: [parameter.name for parameter in inspect.signature(function).parameters.values()
+                   if parameter.kind == parameter.KEYWORD_ONLY]
+            for name, function in vars(protocol).items()
+            if not name.startswith('_') and inspect.isfunction(function)}
+
+
+def accepts(function, names: list) -> list:
+    """Return the names that cannot be passed to the function as keywords."""
+    parameters = inspect.signature(function).parameters
+    if any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+        return []
+    return [name for name in names if name not in parameters]
+
+
+@pytest.mark.parametrize('client', [
+    Elasticsearch('http://localhost:9200'), AsyncElasticsearch('http://localhost:9200'),
+    memory_backend.MemoryClient()])
+def test_clients_provide_the_backend_interface(client):
+    # creating the ElasticSearch clients does not connect to ElasticSearch
+    for name, keywords in interface(SearchBackend).items():
+        assert accepts(getattr(type(client), name), keywords) == [], name
+    for name, keywords in interface(Indices).items():
+        assert accepts(getattr(type(client.indices), name), keywords) == [], name
+
+
+def test_memory_clients_are_search_backends(backend):
+    assert isinstance(backend, SearchBackend)
+    assert isinstance(clients.client(), SearchBackend)
+    assert isinstance(clients.async_client('search'), SearchBackend)
+
+
+def test_memory_backend_errors_are_askme_errors(api_client):
+    import api
+    state = {'query': api.query_digest(None, 'flu', None), 'page': 2, 'pit': 'nosuch', 'after': [1.0, 1]}
+    response = api_client.post(
+        '/api/question', params={'query': 'flu', 'page_token': encode_page_token(state)})
+    assert response.status_code == 404
+    answer = response.json()
+    assert answer['message'] == 'AskMe Exception: No search context found for id [nosuch]'
+    assert answer['details']['elastic_details']['type'] == 'search_context_missing_exception'
+
+
+def test_one_client_with_timeouts_for_each_api(monkeypatch):
+    monkeypatch.setattr(config, 'SEARCH_BACKEND', 'elasticsearch')
+    monkeypatch.setattr(config, 'ELASTIC_HOSTS', ['http://es1:9200', 'http://es2:9200'])
+    monkeypatch.setattr(config, 'ELASTIC_CONNECTIONS_PER_NODE', 3)
+    monkeypatch.setattr(config, 'ELASTIC_TIMEOUTS', {'search': 7.0})
+    monkeypatch.setattr(clients, '_CLIENT', None)
+    es = clients.client()
+    assert isinstance(es, Elasticsearch) and clients.client() is es
+    nodes = es.transport.node_pool.all()
+    assert sorted(str(node.base_url) for node in nodes) == ['http://es1:9200', 'http://es2:9200']
+    assert all(node.config.connections_per_node == 3 for node in nodes)
+    assert clients.client('search')._request_timeout == 7.0
+    # APIs without a timeout of their own use the client as it is
+    assert clients.client('get') is es
+    es.close()
+
+
+def test_memory_backend_stands_in_for_both_clients(backend):
+    assert clients.client() is backend
+    assert isinstance(clients.async_client(), SearchBackend)
@@ -0,0 +1,107 @@
+import asyncio
+
+import config
+import elastic_async
+
+
+def test_generation_changes_when_documents_are_indexed_again(backend, monkeypatch):
+    monkeypatch.setattr(config, 'INDEX_GENERATION_INTERVAL', 0)
+    index = backend.index(config.ELASTIC_INDEX)
+
+    async def main():
+        first = await elastic_async.index_generation()
+        # same identifier and same document count
+        index.add('d1', dict(index.sources[index.numbers['d1']]))
+        second = await elastic_async.index_generation()
+        index.delete('d2')
+        third = await elastic_async.index_generation()
+        return first, second, third
+
+    first, second, third = asyncio.run(main())
+    assert len({first, second, third}) == 3
+
+
+def test_generation_is_checked_once_for_concurrent_requests(backend, monkeypatch):
+    calls = []
+    stats = backend.indices.stats
+
+    def counted_stats(**kwargs):
+        calls.append(kwargs)
+        return stats(**kwargs)
+
+    monkeypatch.setattr(backend.indices, 'stats', counted_stats)
+
+    async def main():
+        return await asyncio.gather(*[elastic_async.index_generation() for _ in range(10)])
+
+    generations = asyncio.run(main())
+    assert len(set(generations)) == 1
+    assert len(calls) == 1
+    # within the interval the cached generation is used
+    asyncio.run(main())
+    assert len(calls) == 1
+
+
+def test_failed_generation_check_keeps_the_last_generation(api_client, backend, monkeypatch):
+    from memory_backend import BackendError
+    monkeypatch.setattr(config, 'INDEX_GENERATION_INTERVAL', 0)
+    stats = backend.indices.stats
+
+    def forbidden_stats(**kwargs):
+        raise BackendError('action [indices:monitor/stats] is unauthorized',
+                           status=403, type='security_exception')
+
+    monkeypatch.setattr(backend.indices, 'stats', forbidden_stats)
+    # without a generation requests are still answered
+    assert asyncio.run(elastic_async.index_generation()) is None
+    assert api_client.get('/api/doc/d4').status_code == 200
+    monkeypatch.setattr(backend.indices, 'stats', stats)
+    generation = asyncio.run(elastic_async.index_generation())
+    assert generation is not None
+    monkeypatch.setattr(backend.indices, 'stats', forbidden_stats)
+    assert asyncio.run(elastic_async.index_generation()) == generation
+    response = api_client.post('/api/question', params={'query': 'water'})
+    assert response.status_code == 200
+
+
+def collect(doc_ids: list, source_fields: list = None):
+
+    async def main():
+        return [chunk async for chunk in elastic_async.iter_documents(doc_ids, source_fields)]
+
+    return asyncio.run(main())
+
+
+def test_iter_documents_keeps_the_order_of_the_identifiers(backend, monkeypatch):
+    monkeypatch.setattr(config, 'MGET_CHUNK_SIZE', 2)
+    # some documents are cached already
+    collect(['d5', 'd2'])
+    doc_ids = ['d6', 'd2', 'nope', 'd1', 'd5', 'd3', 'd4']
+    chunks = collect(doc_ids)
+    assert len(chunks) == 4
+    assert [doc.identifier for docs, _ in chunks for doc in docs] == [
+        'd6', 'd2', 'd1', 'd5', 'd3', 'd4']
+    errors = [error for _, chunk_errors in chunks for error in chunk_errors]
+    assert errors == [{'id': 'nope', 'type': 'not_found', 'reason': 'document does not exist'}]
+
+
+def test_iter_documents_with_source_fields(backend):
+    (docs, errors), = collect(['d1', 'd4'], ['title'])
+    assert [doc.title for doc in docs] == ['Influenza vaccine trials in children', 'Water on Mars']
+    assert docs[0].terms == []
+    # partial documents are not cached
+    assert len(elastic_async.DOCUMENTS) == 0
+
+
+def test_concurrent_searches(backend):
+
+    async def main():
+        return await asyncio.gather(
+            elastic_async.search(None, 'flu'),
+            elastic_async.search(['mars'], 'water'),
+            elastic_async.search(None, 'glacier'))
+
+    flu, water, glacier = asyncio.run(main())
+    assert sorted(doc.identifier for doc in flu.docs) == ['d1', 'd2']
+    assert sorted(doc.identifier for doc in water.docs) == ['d4', 'd5']
+    assert [doc.identifier for doc in glacier.docs] == ['d6']
@@ -0,0 +1,101 @@
+import math
+
+import pytest
+
+import api
+import config
+import expansions
+from conftest import write_bulk
+
+
+def terms(*names):
+    return [[name, '1', '0.5'] for name in names]
+
+
+DOCUMENTS = {
+    'x1': {'title': 'x1', 'tags': ['geo'], 'terms': terms('Earthquake', 'fault', 'tremor')},
+    'x2': {'title': 'x2', 'tags': ['geo'], 'terms': terms('earthquakes', 'fault')},
+    'x3': {'title': 'x3', 'tags': ['geo'], 'terms': terms('earthquake', 'tremor', 'magnitude')},
+    'x4': {'title': 'x4', 'tags': ['bio'], 'terms': terms('heart attack', 'heart-attack', 'diet')},
+    'x5': {'title': 'x5', 'tags': ['bio'], 'terms': terms('heart attacks', 'diet', 'fault')},
+    'x6': {'title': 'x6', 'tags': ['bio', 'geo'], 'terms': terms('earthquake', 'diet')},
+}
+
+
+def related_terms(term: str, tag: str) -> dict:
+    # cosine similarities of the sets of documents that have the terms
+    docs = {}
+    for doc_id, source in DOCUMENTS.items():
+        if tag == expansions.ALL or tag in source['tags']:
+            for name, _, _ in source['terms']:
+                docs.setdefault(name.lower(), set()).add(doc_id)
+    related = {}
+    for other, other_docs in docs.items():
+        common = len(docs[term] & other_docs)
+        if other != term and common:
+            related[other] = common / math.sqrt(len(docs[term]) * len(other_docs))
+    return related
+
+
+@pytest.fixture
+def bulk_file(tmp_path):
+    return write_bulk(tmp_path / 'bulk.json', DOCUMENTS)
+
+
+@pytest.fixture
+def expansion_index(backend, tmp_path):
+    path = str(tmp_path / 'expansions')
+    expansions.build(path, config.ELASTIC_INDEX, k=10, min_df=1, max_terms=100,
+                     processes=2, block_size=2, batch_size=4)
+    return expansions.load(path)
+
+
+def test_related_terms_match_document_overlap(expansion_index):
+    for tag in ('geo', 'bio', expansions.ALL):
+        for term in ('earthquake', 'fault', 'diet'):
+            found = expansion_index.related(term, tag)
+            expected = related_terms(term, tag)
+            assert dict(found) == pytest.approx(expected, rel=1e-5), (term, tag)
+            scores = [score for _, score in found]
+            assert scores == sorted(scores, reverse=True)
+    assert len(expansion_index.related('earthquake', 'geo', k=1)) == 1
+    # in the geo documents diet only occurs with earthquake
+    assert expansion_index.related('diet', 'geo') == [('earthquake', pytest.approx(1 / math.sqrt(3)))]
+
+
+def test_synonyms_and_prefixes(expansion_index):
+    assert expansion_index.synonyms('earthquake', 'geo') == ['earthquakes']
+    assert expansion_index.synonyms('Heart Attack', 'bio') == ['heart-attack', 'heart attacks']
+    assert expansion_index.synonyms('tremor', 'geo') == []
+    assert expansion_index.synonyms('tremor', 'bio') == []
+    assert expansion_index.complete('heart', 'bio') == ['heart attack', 'heart attacks', 'heart-attack']
+    assert expansion_index.complete('heart', 'geo') == []
+    assert expansion_index.complete('e', limit=1) == ['earthquake']
+
+
+def test_expand(expansion_index):
+    expanded = expansion_index.expand('Earthquake', ['geo'], k=2)
+    assert expanded[0] == 'earthquakes'
+    assert len(expanded) == 3 and 'earthquake' not in expanded
+    # a query that is not a term is expanded word by word, with one related term
+    # for each word
+    assert expansion_index.expand('tremor diet', ['geo']) == ['earthquake']
+    # terms that no tag has are looked up in the tables for all documents
+    assert expansion_index.expand('heart attack', ['geo'], k=1) == ['heart-attack', 'heart attacks']
+    assert expansion_index.expand('nothing', ['geo']) == []
+
+
+def test_min_df(backend, tmp_path):
+    path = str(tmp_path / 'expansions')
+    expansions.build(path, config.ELASTIC_INDEX, k=10, min_df=2, max_terms=100,
+                     processes=1, block_size=10, batch_size=10)
+    expansion_index = expansions.load(path)
+    assert expansion_index.row('magnitude', 'geo') is None
+    assert expansion_index.row('tremor', 'geo') is not None
+
+
+def test_expansions_endpoint(api_client, expansion_index, monkeypatch):
+    monkeypatch.setattr(api, 'EXPANSIONS', expansion_index)
+    response = api_client.get('/api/expansions', params={'term': 'earthquake', 'tags': 'geo'})
+    assert response.status_code == 200
+    assert response.json()['expansions'][0] == 'earthquakes'
@@ -0,0 +1,89 @@
+import math
+
+import pytest
+
+from conftest import DOCUMENTS
+from memory_backend import MemoryClient, BackendError, analyze, K1, B
+
+
+def ids(response: dict) -> list:
+    return [hit['_id'] for hit in response['hits']['hits']]
+
+
+@pytest.fixture
+def memory(bulk_file):
+    client = MemoryClient('xdd')
+    client.load_bulk(bulk_file)
+    return client
+
+
+def test_match_scores_are_bm25(memory):
+    response = memory.search(index='xdd', query={'match': {'title': 'mars'}})
+    assert ids(response) == ['d4', 'd5']
+    # both titles have mars once, the shorter title scores higher
+    lengths = [len(analyze(DOCUMENTS[d]['title'])) for d in DOCUMENTS]
+    average = sum(lengths) / len(lengths)
+    idf = math.log(1 + (len(DOCUMENTS) - 2 + 0.5) / (2 + 0.5))
+    for hit in response['hits']['hits']:
+        length = len(analyze(DOCUMENTS[hit['_id']]['title']))
+        expected = idf * (K1 + 1) / (1 + K1 * (1 - B + B * length / average))
+        assert hit['_score'] == pytest.approx(expected, rel=1e-5)
+
+
+def test_phrase_matches_consecutive_tokens(memory):
+    assert ids(memory.search(query={'match_phrase': {'content': 'mars rover'}})) == ['d4']
+    assert ids(memory.search(query={'match_phrase': {'content': 'rover mars'}})) == []
+
+
+def test_bool_query_with_tag_filter(memory):
+    query = {'bool': {'must': {'multi_match': {'query': 'water', 'fields': ['title', 'abstract', 'content']}},
+                      'filter': {'terms': {'tags': ['geoarchive']}}}}
+    assert sorted(ids(memory.search(query=query))) == ['d5', 'd6']
+    assert memory.count(query=query) == {'count': 2}
+
+
+def test_point_in_time_pages_have_all_hits_once(memory):
+    query = {'multi_match': {'query': 'water mars flu', 'fields': ['title', 'abstract', 'content']}}
+    expected = ids(memory.search(query=query, size=10))
+    pit = memory.open_point_in_time(index='xdd', keep_alive='1m')['id']
+    found = []
+    after = None
+    while True:
+        response = memory.search(query=query, size=2, pit={'id': pit}, sort=['_score', '_shard_doc'],
+                                 search_after=after)
+        if not response['hits']['hits']:
+            break
+        found.extend(ids(response))
+        after = response['hits']['hits'][-1]['sort']
+    assert found == expected
+    memory.close_point_in_time(id=pit)
+    with pytest.raises(BackendError) as error:
+        memory.search(query=query, pit={'id': pit})
+    assert error.value.status == 404
+
+
+def test_more_like_this_leaves_out_the_document(memory):
+    query = {'more_like_this': {'fields': ['title', 'abstract'], 'like': [{'_index': 'xdd', '_id': 'd4'}],
+                                'min_term_freq': 1, 'min_doc_freq': 1}}
+    found = ids(memory.search(query=query))
+    assert 'd4' not in found and found[0] == 'd5'
+
+
+def test_terms_aggregation(memory):
+    response = memory.search(query={'match_all': {}}, size=0,
+                             aggs={'tags': {'terms': {'field': 'tags'}}})
+    buckets = response['aggregations']['tags']['buckets']
+    assert buckets[0] == {'key': 'biomedical', 'doc_count': 3}
+
+
+def test_mget_and_source_filtering(memory):
+    docs = memory.mget(index='xdd', ids=['d1', 'nope'], source_includes=['title'])['docs']
+    assert docs[0]['_source'] == {'title': DOCUMENTS['d1']['title']}
+    assert docs[1] == {'_index': 'xdd', '_id': 'nope', 'found': False}
+
+
+def test_unsupported_queries_raise_backend_errors(memory):
+    with pytest.raises(BackendError) as error:
+        memory.search(query={'fuzzy': {'title': 'mars'}})
+    assert error.value.status == 400
+    assert error.value.details == {'type': 'illegal_argument_exception', 'reason': 'Unsupported query: fuzzy'}
@@ -0,0 +1,94 @@
+import asyncio
+
+import cache
+import metrics
+from metrics import Histogram, Metrics
+
+
+def test_stages_are_recorded_in_the_current_timings():
+    timings = {}
+    token = metrics._TIMINGS.set(timings)
+    try:
+        with metrics.stage('parse'):
+            pass
+        metrics.record('rerank', 0.5)
+        metrics.record('rerank', 0.25)
+    finally:
+        metrics._TIMINGS.reset(token)
+    assert set(timings) == {'parse', 'rerank'}
+    assert timings['rerank'] == 0.75
+    # without timings nothing is recorded
+    with metrics.stage('parse'):
+        metrics.record('rerank', 1)
+
+
+def test_elastic_records_client_and_server_time():
+
+    async def request():
+        return {'took': 12}
+
+    async def main():
+        timings = {}
+        metrics._TIMINGS.set(timings)
+        await metrics.elastic(request())
+        return timings
+
+    timings = asyncio.run(main())
+    assert timings['es-server'] == 0.012
+    assert timings['es-client'] >= 0
+
+
+def test_server_timing_header():
+    header = metrics.server_timing({'es-client': 0.0123, 'app': 0.05})
+    assert header == b'es-client;dur=12.30, app;dur=50.00'
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2]
+    assert histogram.lines('h', 'endpoint="x"') == [
+        'h_bucket{endpoint="x",le="0.1"} 1',
+        'h_bucket{endpoint="x",le="1.0"} 2',
+        'h_bucket{endpoint="x",le="+Inf"} 3',
+        'h_sum{endpoint="x"} 5.55',
+        'h_count{endpoint="x"} 3']
+
+
+def test_prometheus_output():
+    collected = Metrics((1.0,))
+    collected.observe('/api/question', 0.2, {'rerank': 0.1})
+    text = collected.prometheus()
+    assert 'askme_request_duration_seconds_count{endpoint="/api/question"} 1' in text
+    assert 'askme_stage_duration_seconds_count{endpoint="/api/question",stage="rerank"} 1' in text
+
+
+def test_background_refresh_is_not_timed_in_the_request():
+    ttl_cache = cache.TTLCache(10, ttl=10, stale=20)
+    ttl_cache.put('a', 'old')
+    value, stored_at = ttl_cache.data['a']
+    ttl_cache.data['a'] = (value, stored_at - 15)
+
+    async def compute():
+        metrics.record('es-client', 1.0)
+        return 'new'
+
+    async def main():
+        timings = {}
+        metrics._TIMINGS.set(timings)
+        assert await ttl_cache.get_or_compute('a', compute) == 'old'
+        await asyncio.gather(*ttl_cache.pending.values())
+        return timings
+
+    assert asyncio.run(main()) == {}
+    assert ttl_cache.lookup('a') == ('new', cache.FRESH)
+
+
+def test_responses_have_server_timing_headers(api_client):
+    response = api_client.post('/api/question', params={'query': 'flu'})
+    assert response.status_code == 200
+    stages = [metric.split(';')[0] for metric in response.headers['server-timing'].split(', ')]
+    assert {'es-client', 'parse', 'rerank', 'app'} <= set(stages)
+    assert 'askme_request_duration_seconds_count{endpoint="/api/question"}' in (
+        api_client.get('/api/metrics').text)
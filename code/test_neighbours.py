@@ -0,0 +1,64 @@
+import math
+
+import pytest
+
+import api
+import config
+import neighbours
+from conftest import DOCUMENTS
+
+
+def cosine_neighbours(doc_id: str, k: int) -> list:
+    # the neighbours computed one pair of documents at a time
+    vectors = {}
+    for identifier, source in DOCUMENTS.items():
+        vector = {}
+        for term, _, tfidf in source['terms']:
+            vector[term.lower()] = vector.get(term.lower(), 0) + float(tfidf)
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        vectors[identifier] = {term: value / norm for term, value in vector.items()}
+    similarities = []
+    for identifier, vector in vectors.items():
+        if identifier != doc_id:
+            similarity = sum(value * vector.get(term, 0) for term, value in vectors[doc_id].items())
+            if similarity > 0:
+                similarities.append((identifier, similarity))
+    return sorted(similarities, key=lambda pair: -pair[1])[:k]
+
+
+@pytest.fixture
+def neighbour_index(backend, tmp_path):
+    # small blocks and batches so that the build uses several of each
+    path = str(tmp_path / 'neighbours')
+    neighbours.build(path, config.ELASTIC_INDEX, k=2, processes=2, block_size=2, batch_size=4)
+    return neighbours.load(path)
+
+
+def test_lookup_matches_pairwise_similarities(neighbour_index):
+    assert len(neighbour_index) == len(DOCUMENTS)
+    for doc_id in DOCUMENTS:
+        found = neighbour_index.lookup(doc_id)
+        expected = cosine_neighbours(doc_id, 2)
+        assert [identifier for identifier, _ in found] == [identifier for identifier, _ in expected]
+        assert [score for _, score in found] == pytest.approx([score for _, score in expected], rel=1e-5)
+
+
+def test_unknown_documents(neighbour_index, tmp_path):
+    # d3 has no terms in common with any other document
+    assert neighbour_index.lookup('d3') == []
+    assert neighbour_index.lookup('nope') is None
+    assert 'd1' in neighbour_index and 'nope' not in neighbour_index
+    assert neighbours.load(None) is None
+    assert neighbours.load(str(tmp_path / 'nothing')) is None
+
+
+def test_related_uses_the_precomputed_neighbours(api_client, neighbour_index, monkeypatch):
+    monkeypatch.setattr(api, 'NEIGHBOURS', neighbour_index)
+    answer = api_client.get('/api/related/d1').json()
+    assert answer['query'] == {'doc_id': 'd1', 'precomputed': True}
+    expected = cosine_neighbours('d1', 2)
+    assert [doc['identifier'] for doc in answer['documents']] == [i for i, _ in expected]
+    assert answer['documents'][0]['score'] == pytest.approx(expected[0][1], rel=1e-5)
+    # documents without neighbours fall back to a search
+    monkeypatch.setattr(api, 'NEIGHBOURS', None)
+    assert api_client.get('/api/related/d4').json()['query']['precomputed'] is False
@@ -0,0 +1,60 @@
+import pytest
+
+import nlpcache
+import ranking
+
+spacy = pytest.importorskip('spacy')
+
+
+@pytest.fixture
+def nlp(monkeypatch):
+    nlp = spacy.blank('en')
+    monkeypatch.setattr(ranking, 'nlp', nlp)
+    return nlp
+
+
+def test_cache_key_changes_with_the_summary():
+    assert nlpcache.cache_key('d1', 'Flu.') == nlpcache.cache_key('d1', 'Flu.')
+    assert nlpcache.cache_key('d1', 'Flu.') != nlpcache.cache_key('d1', 'Flu!')
+    assert nlpcache.cache_key('d1', 'Flu.').startswith('d1:')
+
+
+def test_parses_survive_in_the_database(nlp, tmp_path):
+    path = str(tmp_path / 'parses.db')
+    parses = nlpcache.ParseCache(path, maxsize=100)
+    parses.put_many([('k1', nlp('Water on Mars.')), ('k2', nlp('Flu.'))])
+    # another process only has the parses in the database
+    other = nlpcache.ParseCache(path, maxsize=100)
+    found = other.get_many(['k1', 'k3'], nlp.vocab)
+    assert list(found) == ['k1']
+    assert [token.text for token in found['k1']] == ['Water', 'on', 'Mars', '.']
+    assert len(other) == 2 and len(other.memory) == 1
+
+
+def test_least_recently_used_parses_are_evicted(nlp, tmp_path):
+    parses = nlpcache.ParseCache(str(tmp_path / 'parses.db'), maxsize=2)
+    for key in ('k1', 'k2', 'k3'):
+        parses.put_many([(key, nlp(key))])
+    parses.memory.clear()
+    parses.get_many(['k1'], nlp.vocab)
+    parses.evict()
+    assert len(parses) == 2
+    parses.memory.clear()
+    assert sorted(parses.get_many(['k1', 'k2', 'k3'], nlp.vocab)) == ['k1', 'k3']
+
+
+def test_only_uncached_summaries_are_parsed(nlp, tmp_path, monkeypatch):
+    monkeypatch.setattr(ranking, 'PARSES', nlpcache.ParseCache(str(tmp_path / 'parses.db'), 100))
+    parsed = []
+    parse = ranking.parse
+
+    def recording_parse(texts):
+        parsed.append(texts)
+        return parse(texts)
+
+    monkeypatch.setattr(ranking, 'parse', recording_parse)
+    first = ranking.parse_summaries([('d1', 'Flu.'), ('d2', 'Mars.')])
+    second = ranking.parse_summaries([('d2', 'Mars.'), ('d1', 'Flu cases.'), ('d3', 'Water.')])
+    assert parsed == [['Flu.', 'Mars.'], ['Flu cases.', 'Water.']]
+    assert [doc.text for doc in first] == ['Flu.', 'Mars.']
+    assert [doc.text for doc in second] == ['Mars.', 'Flu cases.', 'Water.']
@@ -0,0 +1,44 @@
+import pytest
+
+import config
+from exceptions import AskmeException
+from projection import parse_fields, source_includes
+
+
+def test_parse_fields():
+    allowed = config.FIELDS_FOR_MULTIPLE_DOCS
+    assert parse_fields(None, allowed) == allowed
+    assert parse_fields('', allowed) == allowed
+    assert parse_fields(' title, identifier,title ', allowed) == ('title', 'identifier')
+    with pytest.raises(AskmeException) as info:
+        parse_fields('title,_source,terms', allowed)
+    assert info.value.status == 400
+    assert info.value.message == 'Unknown field(s): _source, terms'
+
+
+def test_source_includes():
+    # identifier and score are not in the source
+    assert source_includes(('identifier', 'score', 'title')) == ['title']
+    assert source_includes(('identifier',)) == []
+    assert source_includes(('title', 'year'), ('terms',), ('title', 'summary')) == [
+        'title', 'year', 'terms', 'summary']
+
+
+def test_only_the_needed_source_fields_are_requested(api_client, backend, monkeypatch):
+    requests = []
+    search = backend.search
+
+    def recording_search(**kwargs):
+        requests.append(kwargs)
+        return search(**kwargs)
+
+    monkeypatch.setattr(backend, 'search', recording_search)
+    response = api_client.post('/api/question', params={'query': 'flu', 'fields': 'identifier,title'})
+    assert all(doc.keys() == {'identifier', 'title'} for doc in response.json()['documents'])
+    # the terms are needed for reranking
+    assert requests[-1]['source_includes'] == ['title', 'terms']
+    # without query terms there is nothing to rerank
+    api_client.post('/api/question', params={'query': '?', 'fields': 'identifier'})
+    assert requests[-1]['source'] is False
+    response = api_client.post('/api/question', params={'query': 'flu', 'fields': 'text'})
+    assert response.status_code == 400
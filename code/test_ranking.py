@@ -0,0 +1,192 @@
+import random
+import asyncio
+
+import numpy as np
+import pytest
+
+import ranking
+from aggregation import VOCABULARY
+from document import Document
+from ranking import TermVectorRanker, query_terms
+
+
+WEIGHTS = {'elastic': 1.0, 'cosine': 0.5, 'coverage': 0.5}
+
+
+def doc(identifier: str, score: float, terms: list) -> Document:
+    return Document({'_id': identifier, '_score': score, '_source': {'terms': terms}})
+
+
+def loop_weights(docs: list, qterms: list) -> np.ndarray:
+    # the weights as they were computed before they were vectorized
+    weights = np.zeros((len(docs), len(qterms)), dtype=np.float32)
+    for i, d in enumerate(docs):
+        term_weights = {term.lower(): tfidf for term, _, tfidf in d.terms}
+        for j, qterm in enumerate(qterms):
+            weights[i, j] = term_weights.get(qterm, 0)
+    return weights
+
+
+def test_weights_match_the_term_by_term_computation():
+    rng = random.Random(7)
+    vocabulary = ['flu', 'Flu', 'vaccine', 'heart disease', 'mars', 'water', 'rover', 'diet']
+    docs = [doc(f'd{i}', rng.random(),
+                [[term, 1, round(rng.random(), 3)] for term in rng.sample(vocabulary, rng.randint(0, 6))])
+            for i in range(30)]
+    qterms = query_terms('flu heart disease unknownterm')
+    weights, norms = TermVectorRanker(WEIGHTS).weights(docs, qterms)
+    assert np.allclose(weights, loop_weights(docs, qterms))
+    expected_norms = [np.sqrt(sum(w * w for w in {t.lower(): w for t, _, w in d.terms}.values())) or 1
+                      for d in docs]
+    assert np.allclose(norms, expected_norms)
+
+
+def test_documents_with_the_query_terms_move_up():
+    docs = [doc('a', 3.0, [['diet', 1, 0.9]]),
+            doc('b', 2.9, [['flu', 2, 0.9], ['vaccine', 1, 0.5]]),
+            doc('c', 1.0, [])]
+    reranked = TermVectorRanker(WEIGHTS).rerank(docs, 'flu vaccine')
+    assert [d.identifier for d in reranked] == ['b', 'a', 'c']
+    assert reranked[0].nscore > reranked[1].nscore
+
+
+def test_ties_keep_the_elasticsearch_order():
+    docs = [doc(identifier, 1.0, [['flu', 1, 0.5]]) for identifier in 'abcd']
+    reranked = TermVectorRanker(WEIGHTS).rerank(docs, 'flu')
+    assert [d.identifier for d in reranked] == ['a', 'b', 'c', 'd']
+
+
+def test_queries_without_terms_are_not_reranked():
+    docs = [doc('a', 1.0, []), doc('b', 2.0, [['flu', 1, 0.5]])]
+    assert TermVectorRanker(WEIGHTS).rerank(docs, '') is docs
+    assert ranking.source_fields('') == ()
+    assert ranking.source_fields(None) == ()
+    assert ranking.source_fields('?!') == ()
+    assert 'terms' in ranking.source_fields('flu')
+
+
+@pytest.fixture
+def blank_nlp(monkeypatch):
+    # a blank English pipeline only tokenizes, which is enough to match tokens
+    spacy = pytest.importorskip('spacy')
+    nlp = spacy.blank('en')
+    monkeypatch.setattr(ranking, 'nlp', nlp)
+    return nlp
+
+
+def test_summaries_are_parsed_in_batches(blank_nlp, monkeypatch):
+    calls = []
+    pipe = blank_nlp.pipe
+
+    def recording_pipe(texts, batch_size, n_process):
+        texts = list(texts)
+        calls.append((len(texts), batch_size, n_process))
+        return pipe(texts, batch_size=batch_size)
+
+    monkeypatch.setattr(blank_nlp, 'pipe', recording_pipe)
+    monkeypatch.setattr(ranking, 'NLP_PROCESSES', 4)
+    monkeypatch.setattr(ranking, 'NLP_MULTIPROCESS_THRESHOLD', 3)
+    parsed = ranking.parse(['Flu vaccines.', 'Water on Mars.'])
+    assert [doc.text for doc in parsed] == ['Flu vaccines.', 'Water on Mars.']
+    ranking.parse(['a', 'b', 'c'])
+    assert calls == [(2, ranking.NLP_BATCH_SIZE, 1), (3, ranking.NLP_BATCH_SIZE, 4)]
+
+
+def test_summaries_of_several_requests_are_parsed_together(blank_nlp, monkeypatch):
+    parsed = []
+    parse = ranking.parse
+
+    def recording_parse(texts):
+        parsed.append(texts)
+        return parse(texts)
+
+    def summary_doc(identifier, summary):
+        return Document({'_id': identifier, '_score': 1.0, '_source': {'summary': summary}})
+
+    monkeypatch.setattr(ranking, 'parse', recording_parse)
+    monkeypatch.setattr(ranking, 'RERANK_NLP', True)
+    monkeypatch.setattr(ranking, 'RANKER', TermVectorRanker({'elastic': 1.0, 'summary': 1.0}))
+    requests = [
+        ([summary_doc('a', 'Heart disease.'), summary_doc('b', 'Flu and more flu.')], 'flu'),
+        ([summary_doc('c', 'Mars.'), summary_doc('d', 'Water on Mars.')], 'water')]
+    reranked = ranking.rerank_many(requests)
+    assert parsed == [['Heart disease.', 'Flu and more flu.', 'Mars.', 'Water on Mars.']]
+    assert [[d.identifier for d in docs] for docs in reranked] == [['b', 'a'], ['d', 'c']]
+    assert ranking.summary_match(blank_nlp('flu and Flu'), {'flu'}) == pytest.approx(2 / np.sqrt(3))
+    assert ranking.summary_match(blank_nlp(''), {'flu'}) == 0.0
+
+
+def test_collect_stops_at_the_deadline():
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        done, failed, pending, late = [loop.create_future() for _ in range(4)]
+        done.set_result([0.1, 0.2, 0.3])
+        failed.set_exception(RuntimeError('worker died'))
+        deadline = loop.time() + 0.01
+        first = await ranking.collect([(done, 1, 3), (pending, 0, 2)], deadline)
+        second = await ranking.collect([(done, 0, 1), (failed, 0, 1)], deadline)
+        third = await ranking.collect([(late, 0, 1)], loop.time() + 0.01, cancel=False)
+        return first, second, third, pending.cancelled(), late.cancelled()
+
+    first, second, third, pending_cancelled, late_cancelled = asyncio.run(main())
+    assert first.tolist() == pytest.approx([0.2, 0.3])
+    assert second.tolist() == pytest.approx([0.1])
+    assert third.tolist() == []
+    assert pending_cancelled and not late_cancelled
+
+
+def test_batcher_maps_requests_to_shared_chunks(monkeypatch):
+    monkeypatch.setattr(ranking, 'NLP_CHUNK_SIZE', 3)
+    submitted = []
+
+    def fake_submit(texts):
+        submitted.append(texts)
+        return [(f'chunk{i}', 0, len(texts[i:i+3])) for i in range(0, len(texts), 3)]
+
+    monkeypatch.setattr(ranking, 'submit', fake_submit)
+    batcher = ranking.Batcher(window=10, max_texts=7)
+
+    async def main():
+        return await asyncio.gather(batcher.submit(['a', 'b']), batcher.submit(list('cdefg')))
+
+    first, second = asyncio.run(main())
+    assert submitted == [list('abcdefg')]
+    assert first == [('chunk0', 0, 2)]
+    assert second == [('chunk0', 2, 3), ('chunk3', 0, 3), ('chunk6', 0, 1)]
+
+
+def test_documents_that_miss_the_deadline_keep_their_order(monkeypatch):
+    monkeypatch.setattr(ranking, 'RERANK_NLP', True)
+    monkeypatch.setattr(ranking, 'RERANK_BATCH_WINDOW', 0)
+    monkeypatch.setattr(ranking, 'NLP_CHUNK_SIZE', 2)
+    monkeypatch.setattr(ranking, 'RANKER', TermVectorRanker({'elastic': 1.0, 'summary': 1.0}))
+
+    def fake_submit(texts):
+        # the first chunk was parsed, the second one never finishes
+        loop = asyncio.get_running_loop()
+        parsed, stuck = loop.create_future(), loop.create_future()
+        parsed.set_result([0.0, 1.0])
+        return [(parsed, 0, 2), (stuck, 0, 2)]
+
+    monkeypatch.setattr(ranking, 'submit', fake_submit)
+    docs = [Document({'_id': identifier, '_score': 1.0, '_source': {'summary': 'flu'}})
+            for identifier in 'abcd']
+
+    async def main():
+        return await ranking.arerank(docs, 'flu', asyncio.get_running_loop().time() + 0.01)
+
+    reranked, complete = asyncio.run(main())
+    assert [d.identifier for d in reranked] == ['b', 'a', 'c', 'd']
+    assert complete is False
+
+
+def test_reranking_leaves_the_stored_terms_alone():
+    terms = [['Flu', '2', '0.9'], ['vaccine', '1', '0.4']]
+    d = Document({'_id': 'a', '_score': 1.0, '_source': {'terms': terms}})
+    size = len(VOCABULARY)
+    TermVectorRanker(WEIGHTS).rerank([d, doc('b', 2.0, [])], 'flu')
+    assert d.nscore > 0
+    # only the query terms are looked up, the terms are not converted or interned
+    assert terms == [['Flu', '2', '0.9'], ['vaccine', '1', '0.4']]
+    assert len(VOCABULARY) == size
@@ -0,0 +1,39 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import serialize
+from document import Document, DocumentSet
+
+
+def test_dumps_with_and_without_orjson():
+    content = {'title': 'Über Mars', 'year': 2021, 'scores': [0.5, 1.0], 'none': None,
+               'documents': DocumentSet([Document({'_id': 'd1', '_source': {'title': 'T'}})])}
+    expected = json.loads(serialize.dumps(content))
+    assert expected['documents']['documents'][0]['identifier'] == 'd1'
+    # the json module is used when orjson cannot be imported
+    code = ('import sys; sys.modules["orjson"] = None; import serialize; '
+            'sys.stdout.buffer.write(serialize.dumps({"title": "Über Mars", "year": 2021}))')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.stdout == '{"title":"Über Mars","year":2021}'.encode('utf8')
+
+
+def test_unknown_objects_are_not_serialized():
+    with pytest.raises(TypeError):
+        serialize.dumps({'value': object()})
+
+
+def test_serialized_documents_are_reused():
+    doc = Document({'_id': 'd1', '_score': 2.0, '_source': {'title': 'Flu', 'year': 2020}})
+    fields = ('identifier', 'title', 'nscore')
+    first = doc.json_bytes(fields)
+    assert json.loads(first) == doc.as_json(fields=fields)
+    assert doc.json_bytes(fields) is first
+    # reranking changes the nscore, which gives new JSON
+    doc.nscore = 0.5
+    assert json.loads(doc.json_bytes(fields))['nscore'] == 0.5
+    assert json.loads(doc.json_bytes(('identifier',))) == {'identifier': 'd1'}
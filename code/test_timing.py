@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+import subprocess
+
+import api
+import timing
+
+
+def test_timed_records_the_time():
+    with timing.timed('test step'):
+        time.sleep(0.01)
+    assert timing.TIMINGS['test step'] >= 0.01
+    timing.loaded('test resource')
+    assert timing.is_loaded('test resource') and not timing.is_loaded('nothing')
+
+
+def test_importing_the_api_loads_nothing_heavy():
+    code = ('import sys, api, clients, ranking; '
+            'print("spacy" in sys.modules, clients._CLIENT, clients._ASYNC_CLIENT, ranking.nlp)')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.stdout.split() == ['False', 'None', 'None', 'None']
+
+
+def test_ready_after_warming_up(backend, monkeypatch):
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(api, 'WARMED_UP', False)
+    monkeypatch.setattr(timing, 'LOADED', {})
+    with TestClient(api.app) as client:
+        for _ in range(100):
+            response = client.get('/api/ready')
+            if response.status_code == 200:
+                break
+            time.sleep(0.01)
+        assert response.status_code == 200
+        answer = response.json()
+        assert answer['ready'] is True
+        assert 'elasticsearch connection' in answer['loaded']
+        assert 'elasticsearch ping' in answer['timings']
+        monkeypatch.setattr(api, 'WARMED_UP', False)
+        response = client.get('/api/ready')
+        assert response.status_code == 503 and response.json()['ready'] is False
@@ -0,0 +1,25 @@
+import pytest
+
+from exceptions import AskmeException
+from utils import encode_page_token, decode_page_token
+
+
+def test_page_token_round_trip():
+    state = {'query': 'abc', 'page': 41, 'pit': 'pit-id==', 'after': [1.5, 'x/y']}
+    token = encode_page_token(state)
+    # tokens go into URLs without escaping
+    assert '=' not in token and '/' not in token and '+' not in token
+    assert decode_page_token(token) == state
+
+
+VALID_STATE = {'query': 'abc', 'page': 2, 'pit': None, 'after': None}
+
+
+@pytest.mark.parametrize('token', ['', 'not base64!', encode_page_token({'query': 'abc'})] + [
+    encode_page_token({**VALID_STATE, **change}) for change in (
+        {'page': 0}, {'page': '2'}, {'page': True}, {'page': 2.5}, {'query': 1},
+        {'pit': 42}, {'pit': ['x']}, {'after': 'x'}, {'after': {'a': 1}})])
+def test_invalid_page_tokens(token):
+    with pytest.raises(AskmeException) as info:
+        decode_page_token(token)
+    assert info.value.status == 400
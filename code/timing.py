@@ -0,0 +1,38 @@
+"""Start-up timings and readiness
+
+Keeps track of how long it took to import modules and to load heavy resources
+like the spaCy model and the ElasticSearch clients, and which of those resources
+are loaded. This is what the /api/ready endpoint reports.
+
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+# time in seconds it took to import or load something
+TIMINGS = {}
+
+# resources that are loaded, with the time they were loaded
+LOADED = {}
+
+
+@contextmanager
+def timed(name: str):
+    """Context manager that records how long the code inside it took."""
+    t0 = time.perf_counter()
+    yield
+    record(name, time.perf_counter() - t0)
+
+def record(name: str, seconds: float):
+    TIMINGS[name] = round(seconds, 4)
+    logger.info(f'{name} took {seconds:.4f} seconds')
+
+def loaded(resource: str):
+    LOADED[resource] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+def is_loaded(resource: str) -> bool:
+    return resource in LOADED
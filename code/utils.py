@@ -1,7 +1,10 @@
 import json
+import base64
+import binascii
 from fastapi import Response
 
 import config
+from exceptions import AskmeException
 
 
 def prettify(result_dict: dict) -> Response:
@@ -38,6 +41,31 @@ def get_valid_pages(total_hits: int, current_page: int) -> dict:
     return pages
 
 
+def encode_page_token(state: dict) -> str:
+    """Turn the state needed to get a page into an opaque URL-safe token."""
+    data = json.dumps(state, separators=(',', ':')).encode('utf8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_page_token(token: str) -> dict:
+    """Get the state back from a page token, raises an AskmeException with status
+    400 if the token is not valid."""
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        state = json.loads(data)
+        if not isinstance(state, dict) or not {'query', 'page', 'pit', 'after'} <= state.keys():
+            raise ValueError(token)
+        page = state['page']
+        if (not isinstance(state['query'], str)
+                or not isinstance(page, int) or isinstance(page, bool) or page < 1
+                or not isinstance(state['pit'], (str, type(None)))
+                or not isinstance(state['after'], (list, type(None)))):
+            raise ValueError(token)
+        return state
+    except (ValueError, binascii.Error):
+        raise AskmeException(message='Invalid page token', status=400)
+
+
 class color:
     PURPLE = '\033[95m'
     CYAN = '\033[96m'